@@ -0,0 +1,386 @@
+##########################################################################
+#                       ADB HOST PROTOCOL CLIENT                         #
+##########################################################################
+# Talks directly to the adb server (127.0.0.1:5037 by default) instead of spawning the adb binary for every
+# command. Host requests are a 4 hex digit length followed by the request; the server answers OKAY or FAIL
+# (followed by a 4 hex digit length and the error message).
+#   host:devices               list of "<serial>\t<state>" lines
+#   host-serial:<s>:features   features of a device (shell_v2 ...)
+#   host:transport:<serial>    binds the connection to a device, then a device service is requested:
+#   shell,v2,raw:<command>     shell protocol v2, output packets and the exit code of the command
+#   shell:<command>            legacy shell, raw output until the device closes the stream (no exit code)
+#   exec:<command>             binary output of the command, untouched by any terminal (adb exec-out)
+#   sync:                      file transfer session (SEND/RECV/STAT/QUIT requests)
+#   reboot:<mode>
+# Shell and reboot connections are consumed by their service; a streamed shell (ShellStream) hands its output
+# over as it arrives, and closing its connection ends the command on the device. Sync sessions stay open, so they are pooled per
+# device and reused for every push and pull.
+import os
+import socket
+import stat
+import struct
+import threading
+import time
+
+SYNC_DATA_MAX = 64 * 1024
+
+SHELL_STDOUT = 1
+SHELL_STDERR = 2
+SHELL_EXIT = 3
+
+
+class AdbError(Exception):
+    pass
+
+
+class AdbTimeout(AdbError):
+    pass
+
+
+class ShellStream:
+    """Output of a shell command read as it arrives. exit_code is set once the command is over (shell protocol v2
+    only), timed_out when it outlived its deadline and failed when the connection broke before the end"""
+    def __init__(self, client, sock, v2, deadline):
+        self.client = client
+        self.sock = sock
+        self.v2 = v2
+        self.deadline = deadline
+        self.exit_code = None
+        self.timed_out = False
+        self.failed = False
+        self.cancelled = False
+
+    def chunks(self):
+        try:
+            while True:
+                self.sock.settimeout(self.client._remaining(self.deadline))
+                if not self.v2:
+                    try:
+                        data = self.sock.recv(SYNC_DATA_MAX)
+                    except socket.timeout:
+                        raise AdbTimeout('adb request timed out')
+                    if not data:
+                        return
+                    yield data
+                    continue
+                (packet_id, length) = struct.unpack('<BI', self.client._recv_exactly(self.sock, 5))
+                data = self.client._recv_exactly(self.sock, length)
+                if packet_id in (SHELL_STDOUT, SHELL_STDERR):
+                    yield data
+                elif packet_id == SHELL_EXIT:
+                    self.exit_code = data[0]
+                    return
+        except AdbTimeout:
+            self.timed_out = True
+        except (AdbError, OSError):
+            self.failed = not self.cancelled
+        finally:
+            self.cancel()
+
+    @property
+    def success(self):
+        if self.timed_out or self.failed:
+            return False
+        return self.exit_code == 0 if self.v2 else True
+
+    def cancel(self):
+        self.cancelled = True
+        self.sock.close()
+
+
+class AdbClient:
+    def __init__(self, host='127.0.0.1', port=5037, pool_size=2):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.sync_pool = {}  # serial -> idle sync sessions
+        self.features_cache = {}
+
+    # ---- wire helpers ----
+
+    def _connect(self, deadline):
+        sock = socket.create_connection((self.host, self.port), timeout=self._remaining(deadline))
+        sock.settimeout(self._remaining(deadline))
+        return sock
+
+    @staticmethod
+    def _remaining(deadline):
+        if deadline is None:
+            return None
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise AdbTimeout('adb request timed out')
+        return remaining
+
+    @staticmethod
+    def _recv_exactly(sock, n):
+        data = bytearray()
+        while len(data) < n:
+            try:
+                chunk = sock.recv(n - len(data))
+            except socket.timeout:
+                raise AdbTimeout('adb request timed out')
+            if not chunk:
+                raise AdbError('adb connection closed')
+            data.extend(chunk)
+        return bytes(data)
+
+    def _request(self, sock, request):
+        payload = request.encode('utf-8')
+        sock.sendall(b'%04x' % len(payload) + payload)
+        status = self._recv_exactly(sock, 4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            length = int(self._recv_exactly(sock, 4), 16)
+            raise AdbError(self._recv_exactly(sock, length).decode('utf-8', 'backslashreplace'))
+        raise AdbError('unexpected adb server answer {!r}'.format(status))
+
+    def _transport(self, serial, service, deadline):
+        sock = self._connect(deadline)
+        try:
+            if serial is not None:
+                self._request(sock, 'host:transport:{}'.format(serial))
+            else:
+                self._request(sock, 'host:transport-any')
+            self._request(sock, service)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def _read_all(sock):
+        data = bytearray()
+        while True:
+            try:
+                chunk = sock.recv(SYNC_DATA_MAX)
+            except socket.timeout:
+                raise AdbTimeout('adb request timed out')
+            if not chunk:
+                return bytes(data)
+            data.extend(chunk)
+
+    # ---- host services ----
+
+    def devices(self, timeout_secs=10):
+        deadline = time.time() + timeout_secs
+        sock = self._connect(deadline)
+        try:
+            self._request(sock, 'host:devices')
+            length = int(self._recv_exactly(sock, 4), 16)
+            return self._recv_exactly(sock, length).decode('utf-8', 'backslashreplace')
+        finally:
+            sock.close()
+
+    def features(self, serial, timeout_secs=10):
+        if serial not in self.features_cache:
+            deadline = time.time() + timeout_secs
+            sock = self._connect(deadline)
+            try:
+                self._request(sock, 'host-serial:{}:features'.format(serial))
+                length = int(self._recv_exactly(sock, 4), 16)
+                features = self._recv_exactly(sock, length).decode('utf-8', 'backslashreplace')
+            finally:
+                sock.close()
+            self.features_cache[serial] = set(features.strip().split(','))
+        return self.features_cache[serial]
+
+    # ---- device services ----
+
+    def shell(self, serial, command, timeout_secs=None):
+        """Runs command on the device. Returns (exit code, output); the exit code is None when the device only
+        speaks the legacy shell protocol"""
+        deadline = time.time() + timeout_secs if timeout_secs is not None else None
+        if serial is not None and 'shell_v2' in self.features(serial, timeout_secs=self._remaining(deadline) or 10):
+            sock = self._transport(serial, 'shell,v2,raw:{}'.format(command), deadline)
+            try:
+                return self._shell_v2(sock)
+            finally:
+                sock.close()
+        sock = self._transport(serial, 'shell:{}'.format(command), deadline)
+        try:
+            return None, self._read_all(sock)
+        finally:
+            sock.close()
+
+    def shell_stream(self, serial, command, timeout_secs=None):
+        """Starts command on the device. Returns its ShellStream"""
+        deadline = time.time() + timeout_secs if timeout_secs is not None else None
+        v2 = serial is not None and 'shell_v2' in self.features(serial, timeout_secs=self._remaining(deadline) or 10)
+        service = 'shell,v2,raw:{}' if v2 else 'shell:{}'
+        return ShellStream(self, self._transport(serial, service.format(command), deadline), v2, deadline)
+
+    def exec_stream(self, serial, command, timeout_secs=None):
+        """Starts command on the device through exec. Returns its ShellStream, without exit code"""
+        deadline = time.time() + timeout_secs if timeout_secs is not None else None
+        return ShellStream(self, self._transport(serial, 'exec:{}'.format(command), deadline), False, deadline)
+
+    def _shell_v2(self, sock):
+        output = bytearray()
+        exit_code = None
+        while True:
+            try:
+                header = self._recv_exactly(sock, 5)
+            except AdbError as e:
+                if isinstance(e, AdbTimeout):
+                    raise
+                return exit_code, bytes(output)
+            (packet_id, length) = struct.unpack('<BI', header)
+            data = self._recv_exactly(sock, length)
+            if packet_id in (SHELL_STDOUT, SHELL_STDERR):
+                output.extend(data)
+            elif packet_id == SHELL_EXIT:
+                exit_code = data[0]
+                return exit_code, bytes(output)
+
+    def reboot(self, serial, mode='', timeout_secs=10):
+        deadline = time.time() + timeout_secs
+        sock = self._transport(serial, 'reboot:{}'.format(mode), deadline)
+        try:
+            return self._read_all(sock)
+        finally:
+            sock.close()
+
+    # ---- sync service ----
+
+    def _sync_acquire(self, serial, deadline):
+        with self.lock:
+            idle = self.sync_pool.get(serial, [])
+            sock = idle.pop() if idle else None
+        if sock is not None:
+            sock.settimeout(self._remaining(deadline))
+            return sock, True
+        return self._transport(serial, 'sync:', deadline), False
+
+    def _sync_release(self, serial, sock):
+        with self.lock:
+            idle = self.sync_pool.setdefault(serial, [])
+            if len(idle) < self.pool_size:
+                idle.append(sock)
+                return
+        sock.close()
+
+    def _sync(self, serial, timeout_secs, operation):
+        deadline = time.time() + timeout_secs if timeout_secs is not None else None
+        while True:
+            (sock, pooled) = self._sync_acquire(serial, deadline)
+            try:
+                result = operation(sock)
+            except AdbTimeout:
+                sock.close()
+                raise
+            except (AdbError, OSError):
+                sock.close()
+                if pooled:  # the device may have dropped an idle session (e.g. after a reboot), retry on a new one
+                    continue
+                raise
+            self._sync_release(serial, sock)
+            return result
+
+    @staticmethod
+    def _sync_request(sock, request_id, data):
+        sock.sendall(request_id + struct.pack('<I', len(data)) + data)
+
+    def _sync_fail(self, sock, length):
+        raise AdbError(self._recv_exactly(sock, length).decode('utf-8', 'backslashreplace'))
+
+    def push(self, serial, local, remote, mode=0o644, timeout_secs=None):
+        def operation(sock):
+            self._sync_request(sock, b'SEND', '{},{}'.format(remote, stat.S_IFREG | mode).encode('utf-8'))
+            with open(local, 'rb') as f:
+                for chunk in iter(lambda: f.read(SYNC_DATA_MAX), b''):
+                    self._sync_request(sock, b'DATA', chunk)
+            sock.sendall(b'DONE' + struct.pack('<I', int(os.path.getmtime(local))))
+            (status, length) = struct.unpack('<4sI', self._recv_exactly(sock, 8))
+            if status == b'FAIL':
+                self._sync_fail(sock, length)
+            return os.path.getsize(local)
+        return self._sync(serial, timeout_secs, operation)
+
+    def pull(self, serial, remote, local, timeout_secs=None):
+        """Receives into local.part, renamed to local once complete, so a failed pull leaves no file behind"""
+        def operation(sock):
+            self._sync_request(sock, b'RECV', remote.encode('utf-8'))
+            size = 0
+            with open(local + '.part', 'wb') as f:
+                while True:
+                    (status, length) = struct.unpack('<4sI', self._recv_exactly(sock, 8))
+                    if status == b'DONE':
+                        break
+                    if status == b'FAIL':
+                        self._sync_fail(sock, length)
+                    f.write(self._recv_exactly(sock, length))
+                    size += length
+            os.replace(local + '.part', local)
+            return size
+        try:
+            return self._sync(serial, timeout_secs, operation)
+        finally:
+            if os.path.exists(local + '.part'):
+                os.remove(local + '.part')
+
+    def install(self, serial, apk_file, args=None, timeout_secs=None):
+        """Pushes the APK to /data/local/tmp and installs it with pm install. Returns (exit code, output)"""
+        deadline = time.time() + timeout_secs if timeout_secs is not None else None
+        remote = '/data/local/tmp/{}'.format(os.path.basename(apk_file))
+        self.push(serial, apk_file, remote, timeout_secs=self._remaining(deadline))
+        args = ' '.join(args) + ' ' if args else ''
+        (exit_code, output) = self.shell(serial, 'pm install {}"{}"'.format(args, remote),
+                                         timeout_secs=self._remaining(deadline))
+        self.shell(serial, 'rm -f "{}"'.format(remote), timeout_secs=10)
+        return exit_code, output
+
+    def close(self):
+        with self.lock:
+            for idle in self.sync_pool.values():
+                for sock in idle:
+                    sock.close()
+            self.sync_pool = {}
+
+
+# Unit testing
+import unittest
+
+
+class Test_AdbClient(unittest.TestCase):
+    def setUp(self):
+        import standin
+        self.device = standin.FakeDevice('serial1')
+        self.legacy = standin.FakeDevice('serial2', shell_v2=False)
+        self.server = standin.AdbServer([self.device, self.legacy]).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_client(self):
+        import tempfile
+        client = AdbClient(self.server.host, self.server.port)
+        # Asserting device listing, shell output with exit code and legacy shell output
+        self.assertIn('serial1\tdevice', client.devices())
+        self.assertEqual(client.shell('serial1', 'getprop ro:a:b'), (0, b'getprop ro:a:b\n'))
+        self.assertEqual(client.shell('serial2', 'echo x'), (None, b'echo x\n'))
+        self.assertRaises(AdbError, client.shell, 'unknown', 'echo x')
+        # Asserting push and pull reuse a single pooled sync session
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'a'), 'wb') as f:
+                f.write(b'x' * 200000)
+            connections = self.server.connections
+            client.push('serial1', os.path.join(folder, 'a'), '/sdcard/a')
+            client.pull('serial1', '/sdcard/a', os.path.join(folder, 'b'))
+            self.assertEqual(self.server.connections - connections, 1, 'It does not reuse the sync session')
+            with open(os.path.join(folder, 'b'), 'rb') as f:
+                self.assertEqual(f.read(), b'x' * 200000)
+            # Asserting a failed pull leaves no file behind and keeps the one it was to replace
+            self.assertRaises(AdbError, client.pull, 'serial1', '/sdcard/missing',
+                              os.path.join(folder, 'c'))
+            self.assertRaises(AdbError, client.pull, 'serial1', '/sdcard/missing',
+                              os.path.join(folder, 'b'))
+            self.assertEqual(sorted(os.listdir(folder)), ['a', 'b'])
+            self.assertEqual(os.path.getsize(os.path.join(folder, 'b')), 200000)
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
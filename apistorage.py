@@ -1,20 +1,35 @@
+import collections
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import threading
 import requests
+import httppool
 
 SUCCESS = 0
 SOFT_FAIL = 1
 HARD_FAIL = 2
 
+NULL_SENTINEL = b'null\n'
+BUFFER_SIZE = 1024 * 1024
+RESUME_RETRIES = 3
+
 class Storage:
-    def __init__(self, server, port, app, version):
+    def __init__(self, server, port, app, version, cache=None):
         self.server = server
         self.port = port
         self.app = app
         self.version = version
+        self.cache = cache
+        self.sha256 = None
+        self.size = None
 
     def version(self):
         data = {}
         try:
-            res = requests.get('http://{}:{}/app/versioncode/{}'.format(self.server, self.port, self.app))
+            res = httppool.get(self.server, self.port, '/app/versioncode/{}'.format(self.app))
             data = res.text
             data = data[data.find("[")+1:data.find("]")]
         except Exception as e:
@@ -27,14 +42,14 @@ class Storage:
             apk_path = '{}/{}'.format(folder, self.app)
         else:
             apk_path = '{}'.format(self.app)
+        if self.cache is not None:
+            return self.cache.fetch(self, apk_path)
+        return self.download_apk(apk_path)
+
+    def download_apk(self, apk_path):
         try:
-            res = requests.get('http://{}:{}/app/apk/{}/{}'.format(self.server, self.port, self.app, self.version), stream=True)
-            res.raise_for_status()  # Raises a HTTPError if the status is 4xx, 5xxx
-            if res.content != b'null\n':  # Storage server returns 'null|n' when the APK is not available
-                with open(apk_path, 'wb') as f:
-                    for chunk in res.iter_content(chunk_size=128):
-                        f.write(chunk)
-            else:
+            # Storage server returns 'null|n' when the APK is not available
+            if not self.stream('/app/apk/{}/{}'.format(self.app, self.version), apk_path):
                 return SOFT_FAIL, 'Unavailable APK, "null" returned'
         except requests.exceptions.ConnectionError as e:
             return HARD_FAIL, str(e)
@@ -52,13 +67,8 @@ class Storage:
         else:
             path_policy = '{}'.format(self.app)
         try:
-            res = requests.get('http://{}:{}/app/privacypolicy/{}/{}/txt'.format(self.server, self.port, self.app,
-                                                                                 self.version), stream=True)
-            res.raise_for_status()  # Raises a HTTPError if the status is 4xx, 5xxx
-            if res.text != 'null\n':  # Storage server returns 'null|n' when the privacy policy is not available
-                with open(path_policy, 'w', encoding='utf-8') as f:
-                    f.write(res.text)
-            else:
+            # Storage server returns 'null|n' when the privacy policy is not available
+            if not self.stream('/app/privacypolicy/{}/{}/txt'.format(self.app, self.version), path_policy):
                 return SOFT_FAIL, 'Unavailable privacy policy, "null" returned'
         except requests.exceptions.ConnectionError as e:
             return HARD_FAIL, str(e)
@@ -69,6 +79,219 @@ class Storage:
         else:
             return SUCCESS, path_policy
 
+    def stream(self, resource, path, retries=RESUME_RETRIES):
+        """Streams a storage server resource into path without holding the body in memory, computing its sha256 and size on the fly
+        (left in self.sha256 and self.size). The body goes to path.part first: an interrupted transfer is
+        resumed with an HTTP Range request, also when a previous call left the part behind. Returns False when
+        the storage server answers with the "null" sentinel"""
+        part = path + '.part'
+        h = hashlib.sha256()
+        size = 0
+        if os.path.isfile(part):
+            with open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(BUFFER_SIZE), b''):
+                    h.update(chunk)
+                    size += len(chunk)
+        while True:
+            headers = {'Range': 'bytes={}-'.format(size)} if size > 0 else {}
+            try:
+                res = httppool.get(self.server, self.port, resource, headers=headers, stream=True)
+                if res.status_code == 416:  # the part already holds the whole body
+                    res.close()
+                    break
+                res.raise_for_status()  # Raises a HTTPError if the status is 4xx, 5xxx
+                if size > 0 and res.status_code != 206:  # Range not honoured, start again from scratch
+                    h = hashlib.sha256()
+                    size = 0
+                chunks = res.iter_content(chunk_size=BUFFER_SIZE)
+                head = b''
+                if size == 0:
+                    # Only the first bytes are sniffed for the sentinel, APKs start with the zip magic 'PK'
+                    for chunk in chunks:
+                        head += chunk
+                        if len(head) > len(NULL_SENTINEL):
+                            break
+                    if head == NULL_SENTINEL:
+                        res.close()
+                        return False
+                with open(part, 'ab' if size > 0 else 'wb') as f:
+                    for chunk in itertools.chain([head], chunks):
+                        f.write(chunk)
+                        h.update(chunk)
+                        size += len(chunk)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                if retries <= 0 or size == 0:
+                    if isinstance(e, requests.exceptions.ChunkedEncodingError):
+                        raise requests.exceptions.ConnectionError(str(e))
+                    raise
+                retries = retries - 1
+        os.replace(part, path)
+        self.sha256 = h.hexdigest()
+        self.size = size
+        return True
+
+
+class ApkCache:
+    """On-disk APK cache keyed by (app, version). APKs are stored once per sha256 under path, verified against
+    that hash on every hit, and evicted in least recently used order when they exceed max_bytes. Concurrent
+    requests for the same key wait for a single download"""
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # (app, version) -> (sha256, size), least recently used first
+        self.pending = {}
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'coalesced': 0}
+        os.makedirs(path, exist_ok=True)
+        self._prune()
+        self._load()
+
+    def _blob(self, sha256):
+        return os.path.join(self.path, '{}.apk'.format(sha256))
+
+    def _index(self):
+        return os.path.join(self.path, 'index.json')
+
+    def _load(self):
+        try:
+            with open(self._index(), 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = []
+        index = [x for x in index if os.path.isfile(self._blob(x['sha256']))]
+        index.sort(key=lambda x: os.path.getmtime(self._blob(x['sha256'])))
+        for x in index:
+            self.entries[(x['app'], x['version'])] = (x['sha256'], x['size'])
+
+    def _prune(self):
+        # Downloads left behind by a previous run are outside of the byte budget, they are started again
+        for name in os.listdir(self.path):
+            if name.endswith('.download.part') or name.endswith('.download') or name.endswith('.tmp'):
+                os.remove(os.path.join(self.path, name))
+
+    def _save(self):
+        index = [{'app': app, 'version': version, 'sha256': sha256, 'size': size}
+                 for (app, version), (sha256, size) in self.entries.items()]
+        tmp = self._index() + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(tmp, self._index())
+
+    def size(self):
+        return sum(dict(self.entries.values()).values())
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.size()
+        return stats
+
+    def _evict(self, keep):
+        while self.size() > self.max_bytes and len(self.entries) > 1:
+            key = next(iter(self.entries))
+            if key == keep:
+                self.entries.move_to_end(key)
+                key = next(iter(self.entries))
+            (sha256, size) = self.entries.pop(key)
+            self.counters['evictions'] += 1
+            if sha256 not in dict(self.entries.values()):
+                os.remove(self._blob(sha256))
+
+    def _drop(self, key, sha256):
+        # Called with the lock held when a cached blob does not match its hash anymore
+        if self.entries.get(key, (None,))[0] == sha256:
+            del self.entries[key]
+            if sha256 not in dict(self.entries.values()) and os.path.isfile(self._blob(sha256)):
+                os.remove(self._blob(sha256))
+            self._save()
+
+    @staticmethod
+    def _link(path, apk_path):
+        # Called without the lock, as it copies the whole APK on filesystems without hardlinks
+        if os.path.exists(apk_path):
+            os.remove(apk_path)
+        try:
+            os.link(path, apk_path)
+        except OSError:
+            shutil.copyfile(path, apk_path)
+
+    def fetch(self, storage, apk_path):
+        key = (storage.app, str(storage.version))
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    os.utime(self._blob(entry[0]))
+                else:
+                    download = self.pending.get(key)
+                    leader = download is None
+                    if leader:
+                        download = self.pending[key] = {'done': threading.Event(), 'result': None}
+                        self.counters['misses'] += 1
+                    else:
+                        self.counters['coalesced'] += 1
+            if entry is not None:
+                try:
+                    self._link(self._blob(entry[0]), apk_path)
+                except OSError:
+                    if os.path.isfile(self._blob(entry[0])):
+                        raise
+                    continue  # evicted since, downloaded again
+                if sha256_file(apk_path) == entry[0]:
+                    with self.lock:
+                        self.counters['hits'] += 1
+                    (storage.sha256, storage.size) = entry
+                    return SUCCESS, apk_path
+                with self.lock:
+                    self._drop(key, entry[0])
+                continue
+            if not leader:
+                download['done'].wait()
+                if download['result'][0] != SUCCESS:
+                    return download['result']
+                continue
+            try:
+                download['result'] = self._download(key, storage, apk_path)
+            except Exception as e:
+                download['result'] = (HARD_FAIL, str(e))  # the waiting requests fail with it
+                raise
+            finally:
+                with self.lock:
+                    del self.pending[key]
+                download['done'].set()
+            return download['result']
+
+    def _download(self, key, storage, apk_path):
+        # Only the leader of a key downloads it, so an interrupted download is resumed by the next request of
+        # this run
+        tmp = os.path.join(self.path, '{}-{}.download'.format(*key))
+        (code, value) = storage.download_apk(tmp)
+        if code != SUCCESS:
+            if code == SOFT_FAIL and os.path.isfile(tmp + '.part'):  # not coming back, nothing to resume
+                os.remove(tmp + '.part')
+            return code, value
+        sha256 = storage.sha256 if storage.sha256 is not None else sha256_file(tmp)
+        size = os.path.getsize(tmp)
+        self._link(tmp, apk_path)
+        with self.lock:
+            os.replace(tmp, self._blob(sha256))
+            self.entries[key] = (sha256, size)
+            self.entries.move_to_end(key)
+            self._evict(keep=key)
+            self._save()
+        return SUCCESS, apk_path
+
+
+def sha256_file(path, buffer_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(buffer_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
 
 # Unit testing
 import unittest
@@ -89,5 +312,102 @@ class Test_Storage(unittest.TestCase):
         # Asserting download of an available privacy policies
         exitcode, value = Storage(storage_ip, storage_port, app_test, version_test).apk()
         self.assertEqual(exitcode, SUCCESS, 'It does not download an available resource')
+
+class Test_ApkCache(unittest.TestCase):
+    class FakeStorage(Storage):
+        def __init__(self, app, version, content, cache):
+            Storage.__init__(self, None, None, app, version, cache)
+            self.content = content
+            self.downloads = 0
+
+        def download_apk(self, apk_path):
+            self.downloads += 1
+            if self.content is None:
+                return SOFT_FAIL, 'Unavailable APK, "null" returned'
+            with open(apk_path, 'wb') as f:
+                f.write(self.content)
+            return SUCCESS, apk_path
+
+    def test_cache(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as folder:
+            cache = ApkCache(os.path.join(folder, 'cache'), max_bytes=10)
+            first = self.FakeStorage('com.first', 1, b'123456', cache)
+            # Asserting a second request for the same app and version is served from the cache
+            self.assertEqual(first.apk(folder), (SUCCESS, '{}/com.first'.format(folder)))
+            self.assertEqual(first.apk(folder), (SUCCESS, '{}/com.first'.format(folder)))
+            self.assertEqual(first.downloads, 1, 'It downloads a cached APK again')
+            # Asserting a corrupted cached APK is detected and downloaded again
+            with open(cache._blob(sha256_file('{}/com.first'.format(folder))), 'r+b') as f:
+                f.write(b'X')
+            self.assertEqual(first.apk(folder)[0], SUCCESS)
+            self.assertEqual(first.downloads, 2, 'It serves a corrupted cached APK')
+            # Asserting the least recently used APK is evicted when the cache goes over its budget
+            second = self.FakeStorage('com.second', 1, b'abcdef', cache)
+            self.assertEqual(second.apk(folder)[0], SUCCESS)
+            self.assertEqual(cache.stats()['evictions'], 1, 'It does not evict over the byte budget')
+            self.assertEqual(list(cache.entries), [('com.second', '1')])
+            # Asserting unavailable APKs are neither cached nor hidden
+            self.assertEqual(self.FakeStorage('com.null', 1, None, cache).apk(folder)[0], SOFT_FAIL)
+            self.assertEqual(cache.stats()['hits'], 1)
+            # Asserting the downloads left behind by a previous run are removed when the cache opens
+            with open(os.path.join(folder, 'cache', 'com.third-1.download.part'), 'wb') as f:
+                f.write(b'x' * 100)
+            cache = ApkCache(os.path.join(folder, 'cache'), max_bytes=10)
+            self.assertEqual(sorted(os.listdir(os.path.join(folder, 'cache'))),
+                             sorted(['index.json', '{}.apk'.format(sha256_file('{}/com.second'.format(folder)))]))
+            self.assertEqual(list(cache.entries), [('com.second', '1')])
+
+    def test_leader_failure(self):
+        import tempfile
+        started = threading.Event()
+
+        class BrokenStorage(self.FakeStorage):
+            def download_apk(self, apk_path):
+                started.set()
+                threading.Event().wait(0.2)  # while the follower waits
+                raise OSError('disk full')
+        with tempfile.TemporaryDirectory() as folder:
+            cache = ApkCache(os.path.join(folder, 'cache'), max_bytes=10)
+            storage = BrokenStorage('com.broken', 1, b'123456', cache)
+            leader = threading.Thread(target=lambda: self.assertRaises(OSError, cache.fetch, storage,
+                                                                       os.path.join(folder, 'a')))
+            leader.start()
+            started.wait(5)
+            # Asserting a request waiting for a download that raised fails instead of crashing
+            self.assertEqual(cache.fetch(storage, os.path.join(folder, 'b')), (HARD_FAIL, 'disk full'))
+            leader.join()
+
+
+    def test_copy(self):
+        import tempfile
+        import unittest.mock
+        copyfile = shutil.copyfile
+        locked = []
+        evict = []
+
+        def copy(src, dst):
+            locked.append(cache.lock.locked())
+            if evict:  # another request evicts the blob between the hit and its copy
+                with cache.lock:
+                    del cache.entries[evict.pop()]
+                    os.remove(src)
+            return copyfile(src, dst)
+        with tempfile.TemporaryDirectory() as folder, \
+                unittest.mock.patch.object(os, 'link', side_effect=OSError('Operation not permitted')), \
+                unittest.mock.patch.object(shutil, 'copyfile', copy):
+            cache = ApkCache(os.path.join(folder, 'cache'), max_bytes=10)
+            storage = self.FakeStorage('com.first', 1, b'123456', cache)
+            self.assertEqual(storage.apk(folder)[0], SUCCESS)
+            self.assertEqual(storage.apk(folder)[0], SUCCESS)
+            # Asserting APKs are copied out of the cache without holding its lock
+            self.assertEqual(locked, [False, False])
+            # Asserting a hit evicted before its copy is downloaded again
+            evict.append(('com.first', '1'))
+            self.assertEqual(storage.apk(folder)[0], SUCCESS)
+            self.assertEqual(storage.downloads, 2)
+            with open(os.path.join(folder, 'com.first'), 'rb') as f:
+                self.assertEqual(f.read(), b'123456')
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,144 @@
+##########################################################################
+#                      PERSISTENT APK METADATA INDEX                     #
+##########################################################################
+# SQLite store of APK metadata keyed by the sha256 of the APK: package, version, permissions, size, launchable
+# activity and, when aapt had to be used, its badging output. Metadata is extracted once per APK content, so
+# redeliveries and new test campaigns never decode the same APK again, and schedulers can query APK sizes or
+# permission counts without touching the files.
+import json
+import os
+import sqlite3
+import threading
+import time
+import axml
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS apk (
+    sha256 TEXT PRIMARY KEY,
+    package TEXT,
+    version_code TEXT,
+    version_name TEXT,
+    permissions TEXT,
+    permission_count INTEGER,
+    launchable_activity TEXT,
+    size INTEGER,
+    badging TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS apk_package ON apk (package, version_code);
+'''
+
+COLUMNS = ('sha256', 'package', 'version_code', 'version_name', 'permissions', 'permission_count',
+           'launchable_activity', 'size', 'badging', 'updated')
+
+
+class ApkIndex:
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    @staticmethod
+    def _record(row):
+        record = dict(zip(COLUMNS, row))
+        record['permissions'] = json.loads(record['permissions']) if record['permissions'] is not None else []
+        return record
+
+    def get(self, sha256):
+        return self.get_many([sha256]).get(sha256)
+
+    def get_many(self, hashes):
+        """Bulk lookup, returns sha256 -> record for the hashes found in the index"""
+        hashes = list(hashes)
+        records = {}
+        with self.lock:
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                rows = self.db.execute('SELECT %s FROM apk WHERE sha256 IN (%s)' % (', '.join(COLUMNS),
+                                                                                   ', '.join('?' * len(chunk))),
+                                       chunk).fetchall()
+                for row in rows:
+                    records[row[0]] = self._record(row)
+        return records
+
+    def put(self, sha256, package=None, version_code=None, version_name=None, permissions=None,
+            launchable_activity=None, size=None, badging=None):
+        permissions = list(permissions) if permissions is not None else []
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO apk (%s) VALUES (%s)' % (', '.join(COLUMNS),
+                                                                            ', '.join('?' * len(COLUMNS))),
+                            (sha256, package, version_code, version_name, json.dumps(permissions),
+                             len(permissions), launchable_activity, size, badging, time.time()))
+            self.db.commit()
+
+    def set_badging(self, sha256, badging):
+        with self.lock:
+            self.db.execute('UPDATE apk SET badging = ?, updated = ? WHERE sha256 = ?', (badging, time.time(), sha256))
+            self.db.commit()
+
+    def find(self, package=None, version_code=None, max_size=None, max_permissions=None):
+        """Records matching all the given conditions"""
+        conditions = []
+        args = []
+        for column, operator, value in (('package', '=', package), ('version_code', '=', version_code),
+                                        ('size', '<=', max_size), ('permission_count', '<=', max_permissions)):
+            if value is not None:
+                conditions.append('{} {} ?'.format(column, operator))
+                args.append(str(value) if column == 'version_code' else value)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        with self.lock:
+            rows = self.db.execute('SELECT %s FROM apk%s' % (', '.join(COLUMNS), where), args).fetchall()
+        return [self._record(row) for row in rows]
+
+    def lookup(self, apk_file, sha256=None):
+        """Record of an APK file, extracted from its manifest and stored the first time its content is seen.
+        Raises axml.ManifestError when the manifest cannot be decoded"""
+        sha256 = sha256 if sha256 is not None else axml.apk_hash(apk_file)
+        record = self.get(sha256)
+        if record is None:
+            manifest = axml.manifest(apk_file, sha256=sha256)
+            self.put(sha256, manifest.package, manifest.version_code, manifest.version_name, manifest.permissions,
+                     manifest.launchable_activity, os.path.getsize(apk_file))
+            record = self.get(sha256)
+        return record
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# Unit testing
+import unittest
+
+
+class Test_ApkIndex(unittest.TestCase):
+    def test_index(self):
+        import tempfile
+        import zipfile
+        with tempfile.TemporaryDirectory() as folder:
+            apk = os.path.join(folder, 'app.apk')
+            with zipfile.ZipFile(apk, 'w') as z:
+                z.writestr('AndroidManifest.xml', axml.build([
+                    ('manifest', {'package': 'com.example.app', 'versionCode': 7}, 0),
+                    ('uses-permission', {'name': 'android.permission.INTERNET'}, 1)]))
+            index = ApkIndex(os.path.join(folder, 'index', 'apk.sqlite'))
+            record = index.lookup(apk)
+            self.assertEqual((record['package'], record['version_code'], record['permissions']),
+                             ('com.example.app', '7', ['android.permission.INTERNET']))
+            # Asserting metadata is persistent and served without reading the APK again
+            index.close()
+            os.remove(apk)
+            index = ApkIndex(os.path.join(folder, 'index', 'apk.sqlite'))
+            self.assertEqual(index.get_many([record['sha256'], 'missing']), {record['sha256']: record})
+            self.assertEqual(len(index.find(package='com.example.app', max_permissions=1)), 1)
+            self.assertEqual(len(index.find(max_size=10)), 0)
+            index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,311 @@
+##########################################################################
+#                     NATIVE APK MANIFEST READER                         #
+##########################################################################
+# Reads the binary AndroidManifest.xml (AXML) straight from the APK zip, replacing "aapt d badging" for the
+# fields the executor needs. An AXML file is a sequence of chunks (type u16, header size u16, chunk size u32):
+# a string pool, the resource ids of the attribute names, and start/end element chunks whose attributes point
+# into the string pool or carry typed values.
+import collections
+import hashlib
+import os
+import struct
+import threading
+import zipfile
+
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_TYPE = 0x0003
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_END_ELEMENT_TYPE = 0x0103
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+
+UTF8_FLAG = 0x100
+
+TYPE_REFERENCE = 0x01
+TYPE_STRING = 0x03
+TYPE_INT_DEC = 0x10
+TYPE_INT_HEX = 0x11
+TYPE_INT_BOOLEAN = 0x12
+
+NO_INDEX = 0xffffffff
+
+# android: attributes looked up by resource id, as obfuscated APKs may strip their names from the string pool
+ATTR_NAME = 0x01010003
+ATTR_VERSION_CODE = 0x0101021b
+ATTR_VERSION_NAME = 0x0101021c
+
+Manifest = collections.namedtuple('Manifest', ['package', 'version_code', 'version_name', 'permissions',
+                                               'launchable_activity'])
+
+
+class ManifestError(Exception):
+    pass
+
+
+def _string_pool(data, offset):
+    (header_size, size, count, style_count, flags, strings_start) = struct.unpack_from('<HIIIII', data, offset + 2)
+    offsets = struct.unpack_from('<%dI' % count, data, offset + header_size)
+    utf8 = flags & UTF8_FLAG
+    base = offset + strings_start
+    strings = []
+    for o in offsets:
+        p = base + o
+        if utf8:
+            # utf-16 length then utf-8 length, each on one or two bytes
+            p += 2 if data[p] & 0x80 else 1
+            length = data[p]
+            if length & 0x80:
+                length = ((length & 0x7f) << 8) | data[p + 1]
+                p += 1
+            p += 1
+            strings.append(data[p:p + length].decode('utf-8', 'replace'))
+        else:
+            (length,) = struct.unpack_from('<H', data, p)
+            p += 2
+            if length & 0x8000:
+                (low,) = struct.unpack_from('<H', data, p)
+                length = ((length & 0x7fff) << 16) | low
+                p += 2
+            strings.append(data[p:p + length * 2].decode('utf-16-le', 'replace'))
+    return strings
+
+
+def parse(data):
+    """Decodes an AXML document into a list of events: ('start', tag, {attribute: value}) and ('end', tag).
+    Attribute keys are the attribute names, or their resource id when the name is missing"""
+    (chunk_type, header_size, size) = struct.unpack_from('<HHI', data, 0)
+    if chunk_type != RES_XML_TYPE:
+        raise ManifestError('Not a binary XML document')
+    strings = []
+    resource_ids = []
+    events = []
+    offset = header_size
+    while offset + 8 <= min(size, len(data)):
+        (chunk_type, header_size, chunk_size) = struct.unpack_from('<HHI', data, offset)
+        if chunk_size < 8:
+            raise ManifestError('Corrupted chunk at offset %d' % offset)
+        if chunk_type == RES_STRING_POOL_TYPE:
+            strings = _string_pool(data, offset)
+        elif chunk_type == RES_XML_RESOURCE_MAP_TYPE:
+            resource_ids = struct.unpack_from('<%dI' % ((chunk_size - header_size) // 4), data, offset + header_size)
+        elif chunk_type == RES_XML_START_ELEMENT_TYPE:
+            (ns, name, attr_start, attr_size, attr_count) = struct.unpack_from('<IIHHH', data, offset + header_size)
+            attributes = {}
+            p = offset + header_size + attr_start
+            for i in range(attr_count):
+                (attr_ns, attr_name, raw, value_type, value) = struct.unpack_from('<IIIxxxBI', data, p)
+                p += attr_size
+                key = strings[attr_name] if attr_name < len(strings) and strings[attr_name] else None
+                if attr_name < len(resource_ids) and (key is None or resource_ids[attr_name] in
+                                                      (ATTR_NAME, ATTR_VERSION_CODE, ATTR_VERSION_NAME)):
+                    key = resource_ids[attr_name]
+                if value_type == TYPE_STRING:
+                    attributes[key] = strings[value]
+                elif value_type in (TYPE_INT_DEC, TYPE_INT_HEX):
+                    attributes[key] = value
+                elif value_type == TYPE_INT_BOOLEAN:
+                    attributes[key] = value != 0
+                elif value_type == TYPE_REFERENCE:
+                    attributes[key] = '@0x%08x' % value
+                elif raw != NO_INDEX:
+                    attributes[key] = strings[raw]
+                else:
+                    attributes[key] = value
+            events.append(('start', strings[name], attributes))
+        elif chunk_type == RES_XML_END_ELEMENT_TYPE:
+            (ns, name) = struct.unpack_from('<II', data, offset + header_size)
+            events.append(('end', strings[name]))
+        offset += chunk_size
+    return events
+
+
+def _attr(attributes, resource_id, name):
+    return attributes.get(resource_id, attributes.get(name))
+
+
+def read_manifest(data):
+    package = None
+    version_code = None
+    version_name = None
+    permissions = []
+    launchable = None
+    stack = []
+    component = None
+    actions = set()
+    categories = set()
+    for event in parse(data):
+        if event[0] == 'start':
+            (tag, attributes) = event[1:]
+            stack.append(tag)
+            if tag == 'manifest':
+                package = attributes.get('package')
+                version_code = _attr(attributes, ATTR_VERSION_CODE, 'versionCode')
+                version_name = _attr(attributes, ATTR_VERSION_NAME, 'versionName')
+            elif tag in ('uses-permission', 'uses-permission-sdk-23') and len(stack) == 2:
+                permission = _attr(attributes, ATTR_NAME, 'name')
+                if permission is not None and permission not in permissions:
+                    permissions.append(permission)
+            elif tag in ('activity', 'activity-alias'):
+                component = _attr(attributes, ATTR_NAME, 'name')
+            elif tag == 'intent-filter':
+                actions = set()
+                categories = set()
+            elif tag == 'action':
+                actions.add(_attr(attributes, ATTR_NAME, 'name'))
+            elif tag == 'category':
+                categories.add(_attr(attributes, ATTR_NAME, 'name'))
+        else:
+            tag = stack.pop() if stack else event[1]
+            if tag == 'intent-filter' and component is not None and launchable is None and \
+                    'android.intent.action.MAIN' in actions and 'android.intent.category.LAUNCHER' in categories:
+                launchable = component
+            elif tag in ('activity', 'activity-alias'):
+                component = None
+    if package is None:
+        raise ManifestError('No package name in the manifest')
+    if launchable is not None and launchable.startswith('.'):
+        launchable = package + launchable
+    elif launchable is not None and '.' not in launchable:
+        launchable = package + '.' + launchable
+    return Manifest(package, str(version_code) if version_code is not None else None,
+                    str(version_name) if version_name is not None else None, permissions, launchable)
+
+
+_cache = collections.OrderedDict()
+_hashes = {}  # (path, size, mtime) -> sha256, so an APK is hashed once per version of the file
+_lock = threading.Lock()
+CACHE_SIZE = 256
+
+
+def file_hash(apk_file, buffer_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(apk_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(buffer_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def apk_hash(apk_file):
+    """sha256 of an APK, memoized by path, size and modification time"""
+    st = os.stat(apk_file)
+    key = (os.path.abspath(apk_file), st.st_size, st.st_mtime_ns)
+    with _lock:
+        sha256 = _hashes.get(key)
+    if sha256 is None:
+        sha256 = file_hash(apk_file)
+        with _lock:
+            if len(_hashes) >= CACHE_SIZE:
+                _hashes.clear()
+            _hashes[key] = sha256
+    return sha256
+
+
+def manifest(apk_file, sha256=None):
+    """Manifest record of an APK, memoized by the sha256 of the file"""
+    sha256 = sha256 if sha256 is not None else apk_hash(apk_file)
+    with _lock:
+        if sha256 in _cache:
+            _cache.move_to_end(sha256)
+            return _cache[sha256]
+    try:
+        with zipfile.ZipFile(apk_file) as z:
+            data = z.read('AndroidManifest.xml')
+    except (zipfile.BadZipFile, KeyError) as e:
+        raise ManifestError(str(e))
+    try:
+        record = read_manifest(data)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ManifestError('Corrupted manifest: %s' % e)
+    with _lock:
+        _cache[sha256] = record
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return record
+
+
+# Unit testing
+import unittest
+
+
+def build(elements, utf8=False):
+    """Encodes [(tag, {attribute: value}, depth)...] into AXML. Attribute names in RESOURCE_IDS get their
+    resource id; str values are strings, int values decimal integers. Used by the unit tests"""
+    # attribute names with a resource id come first in the string pool, as the resource map is indexed by them
+    resource_names = sorted(RESOURCE_IDS_BY_NAME, key=lambda k: RESOURCE_IDS_BY_NAME[k])
+    strings = list(resource_names)
+
+    def index(s):
+        if s not in strings:
+            strings.append(s)
+        return strings.index(s)
+
+    body = b''
+    stack = []
+    for (tag, attributes, depth) in elements:
+        while len(stack) > depth:
+            body += struct.pack('<HHIIIII', RES_XML_END_ELEMENT_TYPE, 16, 24, 0, NO_INDEX, NO_INDEX,
+                                index(stack.pop()))
+        attrs = b''
+        for name, value in attributes.items():
+            if isinstance(value, str):
+                attrs += struct.pack('<IIIHBBI', NO_INDEX, index(name), index(value), 8, 0, TYPE_STRING, index(value))
+            else:
+                attrs += struct.pack('<IIIHBBI', NO_INDEX, index(name), NO_INDEX, 8, 0, TYPE_INT_DEC, value)
+        body += struct.pack('<HHIIIIIHHHHHH', RES_XML_START_ELEMENT_TYPE, 16, 36 + len(attrs), 0, NO_INDEX,
+                            NO_INDEX, index(tag), 20, 20, len(attributes), 0, 0, 0) + attrs
+        stack.append(tag)
+    while stack:
+        body += struct.pack('<HHIIIII', RES_XML_END_ELEMENT_TYPE, 16, 24, 0, NO_INDEX, NO_INDEX, index(stack.pop()))
+    pool = b''
+    offsets = []
+    for s in strings:
+        offsets.append(len(pool))
+        if utf8:
+            encoded = s.encode('utf-8')
+            pool += bytes([len(s), len(encoded)]) + encoded + b'\x00'
+        else:
+            pool += struct.pack('<H', len(s)) + s.encode('utf-16-le') + b'\x00\x00'
+    pool += b'\x00' * (-len(pool) % 4)
+    header = 28 + 4 * len(strings)
+    pool = struct.pack('<HHIIIIII', RES_STRING_POOL_TYPE, 28, header + len(pool), len(strings), 0,
+                       UTF8_FLAG if utf8 else 0, header, 0) + struct.pack('<%dI' % len(offsets), *offsets) + pool
+    ids = [RESOURCE_IDS_BY_NAME[name] for name in resource_names]
+    resource_map = struct.pack('<HHI', RES_XML_RESOURCE_MAP_TYPE, 8, 8 + 4 * len(ids)) + \
+        struct.pack('<%dI' % len(ids), *ids)
+    document = pool + resource_map + body
+    return struct.pack('<HHI', RES_XML_TYPE, 8, 8 + len(document)) + document
+
+
+RESOURCE_IDS_BY_NAME = {'name': ATTR_NAME, 'versionCode': ATTR_VERSION_CODE, 'versionName': ATTR_VERSION_NAME}
+
+
+class Test_Manifest(unittest.TestCase):
+    def test_manifest(self):
+        import tempfile
+        elements = [('manifest', {'package': 'com.example.app', 'versionCode': 42, 'versionName': '1.2'}, 0),
+                    ('uses-permission', {'name': 'android.permission.INTERNET'}, 1),
+                    ('uses-permission', {'name': 'android.permission.CAMERA'}, 1),
+                    ('application', {}, 1),
+                    ('activity', {'name': '.Settings'}, 2),
+                    ('activity', {'name': '.Main'}, 2),
+                    ('intent-filter', {}, 3),
+                    ('action', {'name': 'android.intent.action.MAIN'}, 4),
+                    ('category', {'name': 'android.intent.category.LAUNCHER'}, 4)]
+        expected = Manifest('com.example.app', '42', '1.2', ['android.permission.INTERNET',
+                                                              'android.permission.CAMERA'], 'com.example.app.Main')
+        # Asserting both string pool encodings are decoded
+        self.assertEqual(read_manifest(build(elements)), expected)
+        self.assertEqual(read_manifest(build(elements, utf8=True)), expected)
+        # Asserting the manifest is read from the APK and memoized by its hash
+        with tempfile.TemporaryDirectory() as folder:
+            apk = os.path.join(folder, 'app.apk')
+            with zipfile.ZipFile(apk, 'w') as z:
+                z.writestr('AndroidManifest.xml', build(elements))
+            self.assertEqual(manifest(apk), expected)
+            self.assertIn(file_hash(apk), _cache)
+            with open(os.path.join(folder, 'bad.apk'), 'wb') as f:
+                f.write(b'not a zip')
+            self.assertRaises(ManifestError, manifest, os.path.join(folder, 'bad.apk'))
+
+
+if __name__ == '__main__':
+    unittest.main()
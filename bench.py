@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+##########################################################################
+#                    OFFLINE END-TO-END BENCHMARK                        #
+##########################################################################
+# Drives queue_receive, testing and traffico end to end without phones nor servers: a StorageServer serving
+# synthetic APKs, one TestingServer per device with configurable latencies and failure rates, adb and aapt
+# stand-ins (plus a fake adb server for the scheduled reboots) and an in-process broker in place of RabbitMQ.
+# Reports apps/hour, the latency of every pipeline stage and the memory of the process.
+#
+#   python3 bench.py --apps 200 --devices 4 --apk-size-kb 2048 --failure-rate phase-one=0.05
+#   python3 bench.py --json --min-apps-per-hour 20000   # CI: exits 1 below the throughput floor
+import argparse
+import collections
+import configparser
+import contextlib
+import itertools
+import json
+import logging
+import os
+import queue
+import resource
+import sys
+import tempfile
+import time
+import metrics
+import queue_receive as q
+import settings
+import standin
+import traffico
+
+# phase timeouts of the benchmark config, a phase lasts its timeout times phase_scale
+PHASE_ONE_TIMEOUT = 20
+PHASE_TWO_TIMEOUT = 40
+
+Method = collections.namedtuple('Method', ['delivery_tag', 'redelivered'])
+
+
+class Broker(q.Consumer):
+    """In-process queue in place of RabbitMQ. Messages are delivered on the thread calling run with the prefetch
+    credit of the consumer, and the acks sent from the workers run on that thread as on the pika ioloop"""
+    def __init__(self, bodies, prefetch_count):
+        super().__init__(None, prefetch_count)
+        self.pending = collections.deque(bodies)
+        self.callbacks = queue.Queue()
+        self.tags = itertools.count(1)
+        self.unacked = set()
+        self.acked = 0
+        # the broker is its own connection, ioloop and channel
+        self.connection = self
+        self.ioloop = self
+        self.channel = self
+        self.is_open = True
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.put(callback)
+
+    def basic_ack(self, delivery_tag):
+        self.unacked.discard(delivery_tag)
+        self.acked += 1
+
+    def run(self, timeout=None):
+        """Delivers every message and returns once all of them are acked, or after timeout seconds. Returns
+        whether every message was acked"""
+        started = time.time()
+        while self.pending or self.unacked:
+            while self.pending and len(self.unacked) < self.prefetch_count:
+                tag = next(self.tags)
+                self.unacked.add(tag)
+                self.on_message(self, Method(tag, False), None, self.pending.popleft())
+            remaining = None if timeout is None else timeout - (time.time() - started)
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                callback = self.callbacks.get(timeout=remaining)
+            except queue.Empty:
+                return False
+            callback()
+        return True
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def stage_report(before, after):
+    """count, mean and bucket bound of the p50 and p95 of every stage observed between two snapshots of
+    metrics.STAGES, over every device and outcome"""
+    totals = {}
+    for (values, series) in after.items():
+        previous = before.get(values, [0] * len(series))
+        delta = [a - b for a, b in zip(series, previous)]
+        total = totals.setdefault(values[0], [0] * len(series))
+        for i, value in enumerate(delta):
+            total[i] += value
+    report = {}
+    for (stage, series) in sorted(totals.items()):
+        count = series[-2]
+        if count == 0:
+            continue
+
+        def quantile(share):
+            for bound, cumulative in zip(metrics.STAGES.buckets, series):
+                if cumulative >= share * count:
+                    return bound
+            return float('inf')
+        report[stage] = {'count': count, 'mean_secs': round(series[-1] / count, 4),
+                         'p50_le_secs': quantile(0.5), 'p95_le_secs': quantile(0.95)}
+    return report
+
+
+def write_config(folder, storage, servers, adb_server, sdk, lookahead, cache_mb, overlap_sanitize, combined_setup,
+                 reboot_every, compression, artifacts):
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config['testing_env'] = {'testing_server_ip': servers[0].host, 'testing_server_port': str(servers[0].port),
+                             'testing_terminal': 'bench0',
+                             'testing_terminals': ', '.join('bench{}'.format(i) for i in range(len(servers))),
+                             'testing_server_ports': ', '.join(str(s.port) for s in servers),
+                             'force_reboot': str(reboot_every > 0), 'reboot_timeout': str(int(reboot_every)),
+                             'abnormal_threshold': '1000000'}
+    config['testing'] = {'phase-one_timeout': str(PHASE_ONE_TIMEOUT), 'phase-two_timeout': str(PHASE_TWO_TIMEOUT),
+                         'permissions': 'False', 'reboot': 'False', 'monkey': 'True', 'testing_label': 'bench',
+                         'async_phases': 'False', 'phase_grace': '120', 'sanitize_deadline': '5',
+                         'overlap_sanitize': str(overlap_sanitize), 'combined_setup': str(combined_setup)}
+    config['rabbitmq'] = {'username': 'bench', 'password': 'bench', 'server_ip': 'localhost', 'server_port': '5672',
+                          'queue': 'bench', 'exchange': 'bench'}
+    config['base'] = {'base_path': folder, 'results_output': os.path.join(folder, 'results')}
+    config['storage'] = {'ip': storage.host, 'port': str(storage.port)}
+    config['prefetch'] = {'staging_path': os.path.join(folder, 'staging'), 'lookahead': str(lookahead)}
+    config['cache'] = {'path': os.path.join(folder, 'apk-cache'), 'size_mb': str(cache_mb)}
+    config['index'] = {'path': os.path.join(folder, 'apk-index', 'apk.sqlite')}
+    config['journal'] = {'path': os.path.join(folder, 'journal', 'inflight.sqlite')}
+    config['sdk'] = {'ADBPath': sdk[0], 'AAPTPath': sdk[1], 'ADBServer': '{}:{}'.format(*adb_server)}
+    config['results'] = {'compression': compression}
+    config['artifacts'] = {'names': ', '.join(artifacts)}
+    path = os.path.join(folder, 'executor.config')
+    with open(path, 'w') as f:
+        config.write(f)
+    return path
+
+
+def run(apps=50, devices=2, apk_size=256 * 1024, lookahead=1, phase_scale=0.001, storage_latency=0,
+        unavailable_rate=0, latencies=None, failure_rates=None, overlap_sanitize=False, combined_setup=False,
+        cache_mb=0, reboot_every=0, result_records=100, compression='none', artifacts=(), artifact_size=0, seed=0,
+        timeout=600, verbose=False):
+    """Tests apps synthetic apps on devices stand-in devices, returns the report"""
+    with tempfile.TemporaryDirectory() as folder:
+        (storage, servers, adb_server) = (None, [], None)
+        try:
+            storage = standin.StorageServer(apk_size=apk_size, latency=storage_latency,
+                                            unavailable_rate=unavailable_rate, seed=seed).start()
+            for i in range(devices):
+                servers.append(standin.TestingServer(phase_scale=phase_scale, latencies=latencies,
+                                                     failure_rates=failure_rates, seed=seed + i,
+                                                     result_records=result_records,
+                                                     artifact_size=artifact_size).start())
+            adb_server = standin.AdbServer([standin.FakeDevice('bench{}'.format(i))
+                                            for i in range(devices)]).start()
+            path = write_config(folder, storage, servers, (adb_server.host, adb_server.port),
+                                standin.write_fake_sdk(os.path.join(folder, 'sdk')), lookahead, cache_mb,
+                                overlap_sanitize, combined_setup, reboot_every, compression, artifacts)
+            q.configure(settings.init(path))
+            logger = logging.getLogger('bench')
+            logger.propagate = False
+            if not logger.handlers:
+                logger.addHandler(logging.StreamHandler(sys.stderr) if verbose else logging.NullHandler())
+            q.logger = logger
+
+            bodies = [json.dumps({'apk': 'com.bench.app{}'.format(i), 'version': 1}).encode('utf-8')
+                      for i in range(apps)]
+            before = metrics.STAGES.snapshot()
+            rss_before = rss_mb()
+            started = time.time()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+                dispatcher = q.start()
+                q.consumer = Broker(bodies, q.device_pool.size + q.LOOKAHEAD)
+                finished = q.consumer.run(timeout)
+                elapsed = time.time() - started
+                if finished:
+                    q.stop(dispatcher)
+                # else the workers still busy are abandoned, their threads are daemons
+            report = {'apps': apps, 'devices': devices, 'apk_size': apk_size, 'lookahead': lookahead,
+                      'finished': finished, 'acked': q.consumer.acked, 'elapsed_secs': round(elapsed, 3),
+                      'apps_per_hour': round(q.consumer.acked / elapsed * 3600, 1),
+                      'stages': stage_report(before, metrics.STAGES.snapshot()),
+                      'storage_requests': len(storage.requests),
+                      'reboots': sum(d.commands.count('reboot') for d in adb_server.devices.values()),
+                      'memory': {'rss_before_mb': round(rss_before, 1), 'rss_after_mb': round(rss_mb(), 1),
+                                 'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}}
+            return report
+        finally:
+            for server in servers + [storage, adb_server]:
+                if server is not None:
+                    server.stop()
+
+
+def print_report(report):
+    print('{apps} apps on {devices} devices in {elapsed_secs} s: {apps_per_hour} apps/hour, {acked} acked{0}'.format(
+        '' if report['finished'] else ' (timed out)', **report))
+    print('{:<14}{:>8}{:>12}{:>12}{:>12}'.format('stage', 'count', 'mean s', 'p50 <= s', 'p95 <= s'))
+    for (stage, values) in report['stages'].items():
+        print('{:<14}{count:>8}{mean_secs:>12}{p50_le_secs:>12}{p95_le_secs:>12}'.format(stage, **values))
+    print('memory: rss {rss_before_mb} -> {rss_after_mb} MB, max rss {max_rss_mb} MB'.format(**report['memory']))
+
+
+def rates(values):
+    """['phase-one=0.1', ...] -> {'phase-one': 0.1, ...}"""
+    return {k: float(v) for k, v in (value.split('=', 1) for value in values or [])}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark of the executor pipeline')
+    parser.add_argument('--apps', type=int, default=50)
+    parser.add_argument('--devices', type=int, default=2)
+    parser.add_argument('--apk-size-kb', type=int, default=256)
+    parser.add_argument('--lookahead', type=int, default=1)
+    parser.add_argument('--phase-scale', type=float, default=0.001,
+                        help='phase duration as a share of its configured timeout')
+    parser.add_argument('--storage-latency', type=float, default=0)
+    parser.add_argument('--unavailable-rate', type=float, default=0, help='share of APKs the storage lacks')
+    parser.add_argument('--latency', action='append', metavar='ENDPOINT=SECS',
+                        help='added latency of a testing server endpoint, e.g. upload=0.05')
+    parser.add_argument('--failure-rate', action='append', metavar='ENDPOINT=SHARE',
+                        help='share of failed requests of a testing server endpoint, e.g. phase-one=0.1')
+    parser.add_argument('--overlap-sanitize', action='store_true')
+    parser.add_argument('--combined-setup', action='store_true')
+    parser.add_argument('--cache-mb', type=int, default=0)
+    parser.add_argument('--reboot-every', type=int, default=0, help='scheduled device reboots, in seconds')
+    parser.add_argument('--result-records', type=int, default=100, help='lines of the PII report of every app')
+    parser.add_argument('--compression', choices=('none', 'gzip', 'zstd'), default='none')
+    parser.add_argument('--artifact', action='append', default=[], choices=sorted(traffico.ARTIFACTS),
+                        help='artifact fetched after every app')
+    parser.add_argument('--artifact-size-kb', type=int, default=512)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--json', action='store_true', help='prints the report as JSON')
+    parser.add_argument('--min-apps-per-hour', type=float, default=None,
+                        help='exits 1 when the throughput is below this floor')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    report = run(args.apps, args.devices, args.apk_size_kb * 1024, args.lookahead, args.phase_scale,
+                 args.storage_latency, args.unavailable_rate, rates(args.latency), rates(args.failure_rate),
+                 args.overlap_sanitize, args.combined_setup, args.cache_mb, args.reboot_every, args.result_records,
+                 args.compression, args.artifact, args.artifact_size_kb * 1024, args.seed, args.timeout, args.verbose)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    if not report['finished']:
+        return 1
+    if args.min_apps_per_hour is not None and report['apps_per_hour'] < args.min_apps_per_hour:
+        return 1
+    return 0
+
+
+# Unit testing
+import unittest
+
+
+class Test_Benchmark(unittest.TestCase):
+    def test_benchmark(self):
+        report = run(apps=12, devices=3, apk_size=64 * 1024, failure_rates={'phase-one': 0.25},
+                     unavailable_rate=0.2, timeout=60)
+        # Asserting every app went through the pipeline and was acked, failed and unavailable ones included
+        self.assertTrue(report['finished'])
+        self.assertEqual(report['acked'], 12)
+        self.assertEqual(report['stages']['download']['count'], 12)
+        self.assertEqual(report['stages']['test']['count'], report['stages']['configure']['count'])
+        self.assertGreater(report['apps_per_hour'], 0)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        unittest.main(argv=sys.argv[:1] + sys.argv[2:])
+    else:
+        sys.exit(main())
@@ -0,0 +1,217 @@
+##########################################################################
+#                     EVENT-DRIVEN COMMAND ENGINE                        #
+##########################################################################
+# Runs external commands (adb, aapt ...) as plain child processes. A single selector thread reads the output
+# of every running command and enforces their deadlines, so many commands across devices run at the same time
+# without a helper process or a polling loop per command.
+import heapq
+import os
+import queue
+import selectors
+import subprocess
+import threading
+import time
+
+# how often the commands whose output ended are polled for their exit status, and how long they are given to
+# exit before they are killed
+REAP_INTERVAL = 0.01
+EXIT_GRACE = 1
+
+
+class Command:
+    def __init__(self, engine, argv, timeout_secs, tag, stream=False):
+        self.engine = engine
+        self.argv = argv
+        self.tag = tag
+        self.timeout_secs = timeout_secs
+        self.started = time.time()
+        self.deadline = self.started + timeout_secs if timeout_secs is not None else None
+        self.finished = None
+        self.output = bytearray()
+        self.returncode = None
+        self.timed_out = False
+        self.cancelled = False
+        self.done = threading.Event()
+        self.proc = None
+        # streamed commands hand their output to the caller as it is read instead of keeping it
+        self.stream = queue.Queue() if stream else None
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+    def cancel(self):
+        self.engine.cancel(self)
+
+    def chunks(self):
+        """Output of a command submitted with stream=True, as it is read"""
+        while True:
+            data = self.stream.get()
+            if data is None:
+                return
+            yield data
+
+    @property
+    def success(self):
+        return self.returncode == 0 and not self.timed_out and not self.cancelled
+
+    @property
+    def latency(self):
+        return (self.finished if self.finished is not None else time.time()) - self.started
+
+    def text(self):
+        return self.output.decode('UTF-8', 'backslashreplace')
+
+
+class CommandEngine:
+    def __init__(self, read_size=65536):
+        self.read_size = read_size
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.deadlines = []
+        self.running = {}
+        # commands whose output ended, waiting for their exit status: (exit deadline, command)
+        self.exiting = []
+        self.metrics = {}
+        self.thread = None
+        (self.wakeup_r, self.wakeup_w) = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+
+    def submit(self, argv, timeout_secs=None, tag=None, stream=False):
+        cmd = Command(self, argv, timeout_secs, tag if tag is not None else os.path.basename(argv[0]), stream)
+        try:
+            cmd.proc = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        except OSError as e:
+            cmd.output.extend(str(e).encode('UTF-8'))
+            cmd.returncode = -1
+            with self.lock:
+                self._record(cmd)
+            return cmd
+        fd = cmd.proc.stdout.fileno()
+        os.set_blocking(fd, False)
+        with self.lock:
+            self.running[fd] = cmd
+            self.selector.register(fd, selectors.EVENT_READ, cmd)
+            if cmd.deadline is not None:
+                heapq.heappush(self.deadlines, (cmd.deadline, id(cmd), cmd))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+        self._wakeup()
+        return cmd
+
+    def run(self, argv, timeout_secs=None, tag=None):
+        cmd = self.submit(argv, timeout_secs, tag)
+        cmd.wait()
+        return cmd
+
+    def cancel(self, cmd):
+        with self.lock:
+            if cmd.done.is_set():
+                return
+            cmd.cancelled = True
+            self._kill(cmd)
+
+    def stats(self):
+        """Per tag: commands run, failed and timed out, and their total and maximum latency in seconds"""
+        with self.lock:
+            return {tag: dict(m) for tag, m in self.metrics.items()}
+
+    def _wakeup(self):
+        os.write(self.wakeup_w, b'x')
+
+    def _kill(self, cmd):
+        # Called with the lock held. The pipe is closed right away, as a grandchild could keep it open
+        try:
+            cmd.proc.kill()
+        except OSError:
+            pass
+        self._finish(cmd)
+
+    def _finish(self, cmd):
+        # Called with the lock held, it never waits for the process: one still running is reaped by _reap
+        if cmd.proc.stdout.closed:
+            return
+        fd = cmd.proc.stdout.fileno()
+        if fd in self.running:
+            del self.running[fd]
+            self.selector.unregister(fd)
+        cmd.proc.stdout.close()
+        self.exiting.append((time.time() + EXIT_GRACE, cmd))
+        self._reap()
+
+    def _reap(self):
+        # Called with the lock held
+        now = time.time()
+        exiting = []
+        for (deadline, cmd) in self.exiting:
+            cmd.returncode = cmd.proc.poll()
+            if cmd.returncode is not None:
+                self._record(cmd)
+                continue
+            if now > deadline:  # the output was closed by a command that keeps running
+                try:
+                    cmd.proc.kill()
+                except OSError:
+                    pass
+            exiting.append((deadline, cmd))
+        self.exiting = exiting
+
+    def record(self, tag, latency, success, timed_out=False):
+        """Adds to the metrics a command that was run outside the engine"""
+        with self.lock:
+            self._metric(tag, latency, success, timed_out)
+
+    def _metric(self, tag, latency, success, timed_out):
+        m = self.metrics.setdefault(tag, {'count': 0, 'failures': 0, 'timeouts': 0, 'total_secs': 0.0,
+                                          'max_secs': 0.0})
+        m['count'] += 1
+        m['failures'] += 0 if success else 1
+        m['timeouts'] += 1 if timed_out else 0
+        m['total_secs'] += latency
+        m['max_secs'] = max(m['max_secs'], latency)
+
+    def _record(self, cmd):
+        cmd.finished = time.time()
+        self._metric(cmd.tag, cmd.latency, cmd.success, cmd.timed_out)
+        cmd.done.set()
+        if cmd.stream is not None:
+            cmd.stream.put(None)
+
+    def _loop(self):
+        while True:
+            with self.lock:
+                timeout = max(0, self.deadlines[0][0] - time.time()) if self.deadlines else None
+                if self.exiting:
+                    timeout = REAP_INTERVAL if timeout is None else min(timeout, REAP_INTERVAL)
+            events = self.selector.select(timeout)
+            with self.lock:
+                for key, mask in events:
+                    cmd = key.data
+                    if cmd is None:
+                        try:
+                            os.read(self.wakeup_r, self.read_size)
+                        except BlockingIOError:
+                            pass
+                        continue
+                    if cmd.done.is_set():
+                        continue
+                    try:
+                        data = os.read(key.fd, self.read_size)
+                    except BlockingIOError:
+                        continue
+                    if data and cmd.stream is not None:
+                        cmd.stream.put(data)
+                    elif data:
+                        cmd.output.extend(data)
+                    else:
+                        self._finish(cmd)
+                self._reap()
+                now = time.time()
+                while self.deadlines and (self.deadlines[0][0] <= now or self.deadlines[0][2].done.is_set()):
+                    (deadline, _, cmd) = heapq.heappop(self.deadlines)
+                    if not cmd.done.is_set():
+                        cmd.timed_out = True
+                        self._kill(cmd)
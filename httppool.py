@@ -0,0 +1,107 @@
+##########################################################################
+#                     POOLED KEEP-ALIVE HTTP SESSIONS                    #
+##########################################################################
+# traffico.Traffic and apistorage.Storage share one requests.Session per (server, port), so every call to the
+# testing server or the storage server reuses a kept-alive connection instead of opening a new one.
+import threading
+import requests
+import requests.adapters
+import settings
+
+POOL_SIZE = 10
+CONNECT_TIMEOUT = 10
+# Read timeouts per endpoint (first path component). None waits as long as the server needs, which is what the
+# phase endpoints do, as they only answer when the remote phase is over
+READ_TIMEOUTS = {}
+DEFAULT_READ_TIMEOUT = None
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def configure(pool_size=None, connect_timeout=None, read_timeouts=None, default_read_timeout=None):
+    global POOL_SIZE, CONNECT_TIMEOUT, READ_TIMEOUTS, DEFAULT_READ_TIMEOUT
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+    if connect_timeout is not None:
+        CONNECT_TIMEOUT = connect_timeout
+    if read_timeouts is not None:
+        READ_TIMEOUTS = dict(read_timeouts)
+    if default_read_timeout is not None:
+        DEFAULT_READ_TIMEOUT = default_read_timeout
+
+
+def apply(settings):
+    """Applies the http section of a settings.Settings"""
+    if settings.http is not None:
+        configure(pool_size=settings.http.pool_size, connect_timeout=settings.http.connect_timeout,
+                  read_timeouts=dict(settings.http.read_timeouts), default_read_timeout=settings.http.read_timeout)
+
+
+settings.on_reload(apply)
+
+
+def session(server, port):
+    key = (str(server), str(port))
+    with _lock:
+        s = _sessions.get(key)
+        if s is None:
+            s = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            s.mount('http://', adapter)
+            _sessions[key] = s
+    return s
+
+
+def timeout(path):
+    endpoint = path.strip('/').split('/')[0]
+    return CONNECT_TIMEOUT, READ_TIMEOUTS.get(endpoint, DEFAULT_READ_TIMEOUT)
+
+
+def get(server, port, path, **kwargs):
+    kwargs.setdefault('timeout', timeout(path))
+    return session(server, port).get('http://{}:{}{}'.format(server, port, path), **kwargs)
+
+
+def post(server, port, path, **kwargs):
+    kwargs.setdefault('timeout', timeout(path))
+    return session(server, port).post('http://{}:{}{}'.format(server, port, path), **kwargs)
+
+
+def stats():
+    """Connection reuse per (server, port): requests sent, connections opened and requests that reused an
+    already open connection"""
+    result = {}
+    with _lock:
+        sessions = dict(_sessions)
+    for (server, port), s in sessions.items():
+        pools = s.get_adapter('http://').poolmanager.pools
+        pools = [pools[k] for k in pools.keys()]
+        n_requests = sum(pool.num_requests for pool in pools)
+        n_connections = sum(pool.num_connections for pool in pools)
+        result['{}:{}'.format(server, port)] = {'requests': n_requests, 'connections': n_connections,
+                                                'reused': n_requests - n_connections}
+    return result
+
+
+# Unit testing
+import unittest
+
+
+class Test_HttpPool(unittest.TestCase):
+    def setUp(self):
+        import standin
+        self.server = standin.TestingServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+        with _lock:
+            _sessions.pop((str(self.server.host), str(self.server.port)), None)
+
+    def test_reuse(self):
+        (host, port) = (self.server.host, self.server.port)
+        for _ in range(5):
+            self.assertEqual(get(host, port, '/ready').status_code, 200)
+        self.assertIs(session(host, port), session(host, str(port)))
+        # Asserting every request after the first went through the connection it opened
+        self.assertEqual(stats()['{}:{}'.format(host, port)], {'requests': 5, 'connections': 1, 'reused': 4})
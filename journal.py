@@ -0,0 +1,127 @@
+##########################################################################
+#                        IN-FLIGHT TEST JOURNAL                          #
+##########################################################################
+# SQLite journal of the (app, version, testing label) items taken from the queue. An item is recorded as
+# running when its delivery is accepted and as done, with its exit code, once its test is over and before its
+# ack is sent. When the broker connection drops after a test ended but before its ack went through, the
+# redelivered message is found done here and acked at once instead of being tested again.
+# The journal is also the completion index of the consumer: a new delivery of an item already done is skipped,
+# tested again only when its last run failed, or always tested, depending on the policy.
+import os
+import sqlite3
+import threading
+import time
+
+RUNNING = 'running'
+DONE = 'done'
+
+SKIP = 'skip'
+RERUN_FAILED = 'rerun-failed'
+FORCE = 'force'
+POLICIES = (SKIP, RERUN_FAILED, FORCE)
+SUCCESS = 0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS item (
+    app TEXT,
+    version TEXT,
+    label TEXT,
+    state TEXT,
+    code INTEGER,
+    attempts INTEGER,
+    updated REAL,
+    PRIMARY KEY (app, version, label)
+);
+'''
+
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def start(self, app, version, label):
+        with self.lock:
+            self.db.execute('INSERT INTO item VALUES (?, ?, ?, ?, NULL, 1, ?) ON CONFLICT (app, version, label) DO '
+                            'UPDATE SET state = excluded.state, code = NULL, attempts = attempts + 1, '
+                            'updated = excluded.updated', (app, str(version), label, RUNNING, time.time()))
+            self.db.commit()
+
+    def finish(self, app, version, label, code):
+        with self.lock:
+            self.db.execute('UPDATE item SET state = ?, code = ?, updated = ? WHERE app = ? AND version = ? AND '
+                            'label = ?', (DONE, code, time.time(), app, str(version), label))
+            self.db.commit()
+
+    def state(self, app, version, label):
+        """(state, exit code, attempts) of an item, None when it was never taken"""
+        with self.lock:
+            return self.db.execute('SELECT state, code, attempts FROM item WHERE app = ? AND version = ? AND '
+                                   'label = ?', (app, str(version), label)).fetchone()
+
+    def completed(self, app, version, label, policy=SKIP, redelivered=False):
+        """(state, exit code, attempts) of an item that does not need to be tested again under policy, None
+        when it has to be tested. A redelivery of an item done is always completed, its ack was lost"""
+        assert policy in POLICIES, 'Unknown policy %s' % policy
+        state = self.state(app, version, label)
+        if state is None or state[0] != DONE:
+            return None
+        if redelivered or policy == SKIP or (policy == RERUN_FAILED and state[1] == SUCCESS):
+            return state
+        return None
+
+    def running(self):
+        """Items whose test was interrupted, or is still going on"""
+        with self.lock:
+            return self.db.execute('SELECT app, version, label FROM item WHERE state = ?', (RUNNING,)).fetchall()
+
+    def prune(self, max_age_secs):
+        """Forgets the items done more than max_age_secs ago"""
+        with self.lock:
+            self.db.execute('DELETE FROM item WHERE state = ? AND updated < ?', (DONE, time.time() - max_age_secs))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# Unit testing
+import unittest
+
+
+class Test_Journal(unittest.TestCase):
+    def test_journal(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as folder:
+            journal = Journal(os.path.join(folder, 'journal', 'inflight.sqlite'))
+            self.assertIsNone(journal.state('app', 1, 'label'))
+            journal.start('app', 1, 'label')
+            self.assertEqual(journal.state('app', 1, 'label'), (RUNNING, None, 1))
+            journal.finish('app', 1, 'label', 0)
+            # Asserting the state survives a restart of the consumer
+            journal.close()
+            journal = Journal(os.path.join(folder, 'journal', 'inflight.sqlite'))
+            self.assertEqual(journal.state('app', '1', 'label'), (DONE, 0, 1))
+            journal.start('app', 1, 'label')
+            self.assertEqual(journal.state('app', 1, 'label'), (RUNNING, None, 2))
+            self.assertEqual(journal.running(), [('app', '1', 'label')])
+            journal.finish('app', 1, 'label', 1)
+            # Asserting the policies on a failed run
+            self.assertEqual(journal.completed('app', 1, 'label', SKIP), (DONE, 1, 2))
+            self.assertIsNone(journal.completed('app', 1, 'label', RERUN_FAILED))
+            self.assertIsNone(journal.completed('app', 1, 'label', FORCE))
+            self.assertEqual(journal.completed('app', 1, 'label', FORCE, redelivered=True), (DONE, 1, 2))
+            journal.prune(-1)
+            self.assertIsNone(journal.state('app', 1, 'label'))
+            journal.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
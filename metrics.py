@@ -0,0 +1,197 @@
+##########################################################################
+#                       PIPELINE LATENCY METRICS                         #
+##########################################################################
+# Histograms of the time spent in every stage of the pipeline (download, configure, upload, phases, analysis,
+# result, sanitization, ack) and in every adb command, labelled by device and outcome. They are exported in the
+# Prometheus text format by a local HTTP endpoint (serve) and/or a textfile for the node exporter
+# (write_textfile), together with the gauges of the registered sources (worker pools, devices ...).
+import http.server
+import os
+import threading
+import time
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+SUCCESS = 'success'
+FAILURE = 'failure'
+TIMEOUT = 'timeout'
+
+
+class Histogram:
+    def __init__(self, name, description, labels, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}  # label values -> [bucket counts..., count, sum]
+
+    def observe(self, seconds, *values):
+        values = tuple(str(v) if v is not None else '' for v in values)
+        with self.lock:
+            series = self.series.setdefault(values, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return {values: list(series) for values, series in self.series.items()}
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        for values, series in sorted(self.snapshot().items()):
+            labels = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in zip(self.labels, values))
+            sep = ',' if labels else ''
+            for bound, count in zip(self.buckets, series):
+                lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(self.name, labels, sep, bound, count))
+            lines.append('{}_bucket{{{}{}le="+Inf"}} {}'.format(self.name, labels, sep, series[-2]))
+            lines.append('{}_count{{{}}} {}'.format(self.name, labels, series[-2]))
+            lines.append('{}_sum{{{}}} {:.6f}'.format(self.name, labels, series[-1]))
+        return '\n'.join(lines)
+
+
+class Timer:
+    """Times a block into a histogram. The outcome is success unless set on the timer or an exception is
+    raised in the block"""
+    def __init__(self, histogram, *values):
+        self.histogram = histogram
+        self.values = values
+        self.outcome = SUCCESS
+        self.started = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.time() - self.started
+        outcome = self.outcome if exc_type is None else FAILURE
+        self.histogram.observe(self.elapsed, *(self.values + (outcome,)))
+        return False
+
+
+STAGES = Histogram('executor_stage_seconds', 'Time spent in every stage of the pipeline',
+                   ('stage', 'device', 'outcome'))
+ADB_COMMANDS = Histogram('executor_adb_command_seconds', 'Time spent in adb commands', ('command', 'device', 'outcome'))
+
+_gauges = []
+_lock = threading.Lock()
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def stage(name, device=None):
+    """with stage('download') as timer: ... times a stage, timer.outcome may be set to FAILURE"""
+    return Timer(STAGES, name, device)
+
+
+def observe_stage(name, seconds, device=None, outcome=SUCCESS):
+    STAGES.observe(seconds, name, device, outcome)
+
+
+def observe_adb(command, seconds, device=None, outcome=SUCCESS):
+    ADB_COMMANDS.observe(seconds, command, device, outcome)
+
+
+def register_gauges(source):
+    """source() returns name -> number, exported as executor_<name> gauges"""
+    with _lock:
+        _gauges.append(source)
+
+
+def render():
+    parts = [STAGES.render(), ADB_COMMANDS.render()]
+    with _lock:
+        sources = list(_gauges)
+    for source in sources:
+        try:
+            values = source()
+        except Exception:
+            continue
+        for name, value in sorted(values.items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            parts.append('# TYPE executor_{0} gauge\nexecutor_{0} {1}'.format(name, value))
+    return '\n'.join(parts) + '\n'
+
+
+def write_textfile(path):
+    """Writes the metrics atomically, for the textfile collector of the node exporter"""
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+def write_periodically(path, interval=15):
+    def loop():
+        while True:
+            try:
+                write_textfile(path)
+            except OSError:
+                pass
+            time.sleep(interval)
+    th = threading.Thread(target=loop, daemon=True)
+    th.start()
+    return th
+
+
+def serve(port, host='0.0.0.0'):
+    """Serves GET /metrics from a background thread. Returns the server"""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            data = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    th = threading.Thread(target=httpd.serve_forever, daemon=True)
+    th.start()
+    return httpd
+
+
+# Unit testing
+import unittest
+
+
+class Test_Metrics(unittest.TestCase):
+    def test_metrics(self):
+        import urllib.request
+        histogram = Histogram('test_seconds', 'Test', ('stage', 'device', 'outcome'), buckets=(1, 10))
+        histogram.observe(0.5, 'download', 'd1', SUCCESS)
+        histogram.observe(5, 'download', 'd1', SUCCESS)
+        with Timer(histogram, 'upload', 'd1') as timer:
+            timer.outcome = FAILURE
+        text = histogram.render()
+        self.assertIn('test_seconds_bucket{stage="download",device="d1",outcome="success",le="1"} 1', text)
+        self.assertIn('test_seconds_bucket{stage="download",device="d1",outcome="success",le="10"} 2', text)
+        self.assertIn('test_seconds_count{stage="upload",device="d1",outcome="failure"} 1', text)
+        # Asserting the endpoint exports stages and gauges
+        observe_stage('configure', 0.2, 'd1')
+        register_gauges(lambda: {'testing_busy': 2})
+        httpd = serve(0, '127.0.0.1')
+        text = urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(httpd.server_address[1])).read().decode()
+        self.assertIn('executor_stage_seconds_count{stage="configure",device="d1",outcome="success"} 1', text)
+        self.assertIn('executor_testing_busy 2', text)
+        httpd.shutdown()
+        httpd.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
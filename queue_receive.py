@@ -1,17 +1,27 @@
 #!/usr/bin/env python3
 import importlib.util
+import collections
 import pika
 import sys
-import functools
 import os
 import importlib
+import queue
 import testing as t
 import threading
-import configparser
+import settings
+import metrics
 import apistorage as st
+import apkindex
+import axml
 import json
+import shutil
+import zipfile
 from datetime import datetime, timedelta
 import tools
+import workers
+import journal as jn
+import itertools
+import time
 import subprocess
 
 BASE_PATH = None
@@ -28,35 +38,54 @@ RABBIT_EXCHANGE = None
 
 STORAGE_SERVER = None
 STORAGE_PORT = None
+STAGING_PATH = 'staging'
+LOOKAHEAD = 0
+CACHE_PATH = None
+CACHE_SIZE_MB = 0
+apk_cache = None
+INDEX_PATH = None
+apk_index = None
+JOURNAL_PATH = None
+JOURNAL_RETENTION_DAYS = 0
+# what to do with an app already tested under the testing label: skip, rerun-failed or force
+RESULT_POLICY = jn.SKIP
+journal = None
+consumer = None
+# broker reconnection backoff, in seconds
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 60
 
 TESTING_LABEL = None
 CONTAINER = 'traffic'
 
 TOOLS_FILE = '/app/scripts/testing.config'
 DEVICE = None
+DEVICES = []
+device_pool = None
+# fixed worker pools sized to the broker credit: APK staging and device testing
+staging_pool = None
+testing_pool = None
+prefetcher = None
 REBOOT_TIMEOUT = 3600
 FORCE_REBOOT = True
-end_time = 0
 
 SUCCESS = 0
 SOFT_FAIL = 1
 HARD_FAIL = 2
 
 ABNORMAL_SOFT_THRESHOLD = 3
-abnormal_soft_count = 0
+# metric outcome of the exit codes
+OUTCOMES = {SUCCESS: metrics.SUCCESS, SOFT_FAIL: 'soft_fail', HARD_FAIL: 'hard_fail'}
 N_DEVICES = 5
 
 
 def parse_config(config_file):
-    global BASE_PATH, FILE_LOGS, HELPER_JSON_LOGGER, logger, RABBIT_PASSWORD, RABBIT_USERNAME, \
-        RABBIT_EXCHANGE, RABBIT_QUEUE, RABBIT_SERVER, RABBIT_PORT, STORAGE_SERVER, STORAGE_PORT, \
-        TESTING_LABEL, DEVICE, FORCE_REBOOT, REBOOT_TIMEOUT, ABNORMAL_SOFT_THRESHOLD, end_time
+    global FILE_LOGS, HELPER_JSON_LOGGER, logger
 
-    config = configparser.ConfigParser()
-    config.read(config_file)
-
-    BASE_PATH = config['base']['base_path']
-    assert os.path.isdir(BASE_PATH), 'directory %s not valid' % BASE_PATH
+    # settings shared with testing and tools, the sdk section may come from the tools config file
+    config = settings.init(config_file, TOOLS_FILE)
+    configure(config)
+    settings.on_reload(apply_settings)
     FILE_LOGS = os.path.join(BASE_PATH, 'logging/log/executor.privapp.log')
     HELPER_JSON_LOGGER = os.path.join(BASE_PATH, 'logging-master/agent/helper/log.py')
 
@@ -66,31 +95,99 @@ def parse_config(config_file):
     log.loader.exec_module(log_module)
     logger = log_module.init_logger(FILE_LOGS)
 
-    RABBIT_PASSWORD = config['rabbitmq']['password']
-    RABBIT_USERNAME = config['rabbitmq']['username']
-    RABBIT_SERVER = config['rabbitmq']['server_ip']
-    RABBIT_PORT = config['rabbitmq']['server_port']
-    RABBIT_QUEUE = config['rabbitmq']['queue']
-    RABBIT_EXCHANGE = config['rabbitmq']['exchange']
-    STORAGE_SERVER = config['storage']['ip']
-    STORAGE_PORT = config['storage']['port']
-    TESTING_LABEL = config['testing']['testing_label']
-    # these were used to reboot devices after REBOOT_TIMEOUT seconds. In order to avoid restarting all devices
-    # at the same time, we added an offset
-    DEVICE = config['testing_env']['testing_terminal']
-    FORCE_REBOOT = True if config['testing_env']['force_reboot'] == "True" else False
-    REBOOT_TIMEOUT = int(config['testing_env']['reboot_timeout'])
-    ABNORMAL_SOFT_THRESHOLD = int(config['testing_env']['abnormal_threshold'])
-    offset = int(config['testing_env']['testing_server_port'][-1])
-    end_time = datetime.now() + timedelta(seconds=REBOOT_TIMEOUT) + timedelta(
-        seconds=offset * REBOOT_TIMEOUT / (N_DEVICES + 1))
-
-
-def ack_message(channel, delivery_tag):
-    if channel.is_open:
-        channel.basic_ack(delivery_tag)
-    else:
-        logger.error("Ack cannot be delivered!")
+
+def configure(config):
+    """Takes the consumer values of a settings.Settings"""
+    global BASE_PATH, RABBIT_PASSWORD, RABBIT_USERNAME, RABBIT_EXCHANGE, RABBIT_QUEUE, RABBIT_SERVER, RABBIT_PORT, \
+        STORAGE_SERVER, STORAGE_PORT, STAGING_PATH, LOOKAHEAD, CACHE_PATH, CACHE_SIZE_MB, INDEX_PATH, JOURNAL_PATH, \
+        DEVICE, DEVICES, FORCE_REBOOT
+
+    BASE_PATH = config.base.base_path
+    assert os.path.isdir(BASE_PATH), 'directory %s not valid' % BASE_PATH
+    RABBIT_PASSWORD = config.rabbitmq.password
+    RABBIT_USERNAME = config.rabbitmq.username
+    RABBIT_SERVER = config.rabbitmq.server_ip
+    RABBIT_PORT = config.rabbitmq.server_port
+    RABBIT_QUEUE = config.rabbitmq.queue
+    RABBIT_EXCHANGE = config.rabbitmq.exchange
+    STORAGE_SERVER = config.storage.ip
+    STORAGE_PORT = config.storage.port
+    # APKs of the messages taken ahead are downloaded here while the devices are busy
+    STAGING_PATH = config.prefetch.staging_path
+    LOOKAHEAD = config.prefetch.lookahead
+    # local APK cache, so redeliveries and re-runs under a new label do not download the same APK again
+    CACHE_PATH = config.cache.path
+    CACHE_SIZE_MB = config.cache.size_mb
+    # persistent APK metadata index, keyed by the sha256 of the APK
+    INDEX_PATH = config.index.path
+    # items taken from the queue and whether their test is over, so redeliveries of finished tests are acked
+    JOURNAL_PATH = config.journal.path
+    DEVICE = config.testing_env.terminal
+    FORCE_REBOOT = config.testing_env.force_reboot
+    # device-pool mode: a single consumer drives every terminal listed in testing_terminals
+    apply_settings(config)
+    DEVICES = [Device(terminal.serial, terminal.port) for terminal in config.testing_env.terminals]
+
+
+def apply_settings(config):
+    """Takes the values that can be tuned while the consumer runs, on startup and on every settings reload.
+    The broker, storage, devices and paths need a restart"""
+    global TESTING_LABEL, REBOOT_TIMEOUT, ABNORMAL_SOFT_THRESHOLD, RESULT_POLICY, JOURNAL_RETENTION_DAYS
+    TESTING_LABEL = config.testing.label
+    RESULT_POLICY = config.journal.policy
+    JOURNAL_RETENTION_DAYS = config.journal.retention_days
+    # these are used to reboot devices after REBOOT_TIMEOUT seconds (see Device.reset_reboot_timer)
+    REBOOT_TIMEOUT = config.testing_env.reboot_timeout
+    ABNORMAL_SOFT_THRESHOLD = config.testing_env.abnormal_threshold
+
+
+class Device:
+    """Testing terminal and its testing server port, with the state the consumer tracks for it"""
+    def __init__(self, serial, port):
+        self.serial = serial
+        self.port = port
+        self.abnormal_soft_count = 0
+        self.end_time = None
+        # tools.AdbDevice driving the terminal, set when scheduled reboots are enabled
+        self.adb = None
+        self.reset_reboot_timer()
+
+    def reset_reboot_timer(self):
+        # In order to avoid restarting all devices at the same time, we add an offset
+        offset = int(self.port[-1])
+        self.end_time = datetime.now() + timedelta(seconds=REBOOT_TIMEOUT) + timedelta(
+            seconds=offset * REBOOT_TIMEOUT / (N_DEVICES + 1))
+
+
+class DevicePool:
+    """Idle devices waiting for a delivery. The channel prefetch is the pool size, so a message only
+    arrives when an idle device is available to take it"""
+    def __init__(self, devices):
+        self.size = len(devices)
+        self.idle = queue.Queue()
+        for device in devices:
+            self.idle.put(device)
+
+    def acquire(self):
+        return self.idle.get()
+
+    def release(self, device):
+        self.idle.put(device)
+
+    def retire(self, device):
+        # A device in critical state keeps its delivery unacked, so it is not given back to the pool and the
+        # broker credit it holds stays locked with it
+        self.size -= 1
+        logger.error('Device retired from the pool', extra={'device': device.serial, 'container': CONTAINER,
+                                                             'testing_label': TESTING_LABEL,
+                                                             'available_devices': self.size})
+
+
+def settle(body, code):
+    """Records the item of a delivery as done and acks it"""
+    body_json = json.loads(body)
+    journal.finish(body_json['apk'], str(body_json['version']), consumer.label(body), code)
+    consumer.ack(body)
 
 
 def call_sh(command):
@@ -103,67 +200,684 @@ def call_sh(command):
     return success, result
 
 
-def testing(connection, channel, delivery_tag, body):
-    global abnormal_soft_count, end_time, DEVICE, TOOLS_FILE, FORCE_REBOOT
+def stage(delivery_id, body):
+    """Downloads and validates the APK of a delivery into its own staging folder. Returns the path of the
+    ready-to-install APK, or None when the delivery has already been dealt with"""
     print(" [x] Received {}".format(body.decode('utf-8')))
-    print(" [x] Started app analysis {}".format(body.decode('utf-8')))
-
     body_json = json.loads(body)
     app = body_json['apk']
     version = body_json['version']
-    storage = st.Storage(STORAGE_SERVER, STORAGE_PORT, app, version)
-    code, value = storage.apk('.')
+    folder = os.path.join(STAGING_PATH, str(delivery_id))
+    os.makedirs(folder, exist_ok=True)
+    storage = st.Storage(STORAGE_SERVER, STORAGE_PORT, app, version, cache=apk_cache)
+    started = time.time()
+    code, value = storage.apk(folder)
+    if code == SUCCESS and not zipfile.is_zipfile(value):
+        code, value = SOFT_FAIL, 'Downloaded APK is not a valid zip archive'
+    metrics.observe_stage('download', time.time() - started, outcome=OUTCOMES[code])
     if code == SUCCESS:
-        apk_path = value
-        logger.debug("Apk recovered from the Storage server", extra={'apk': app, 'version': version,
-                                                                     'testing_label': TESTING_LABEL,
-                                                                     'container': CONTAINER, 'device': DEVICE})
-        exit_code = t.traffic_testing(apk_path, str(version), app, logger)
-        if exit_code == SOFT_FAIL:
-            abnormal_soft_count += 1
-        elif exit_code == SUCCESS:
-            abnormal_soft_count = 0
-        os.remove(apk_path)
-
-        if exit_code == SUCCESS or (exit_code == SOFT_FAIL and abnormal_soft_count < ABNORMAL_SOFT_THRESHOLD):
-            cb = functools.partial(ack_message, channel, delivery_tag)
-            connection.add_callback_threadsafe(cb)
-            logger.debug(" App removed from queue", extra={'apk': app, 'version': version, 'container': CONTAINER,
-                                                           'testing_label': TESTING_LABEL, 'device': DEVICE})
-            if FORCE_REBOOT and datetime.now() > end_time:
-                logger.debug("Rebooting device",
-                             extra={'reason': 'Scheduled device reboot', 'apk': app, 'version': version,
-                                    'container': CONTAINER,
-                                    'testing_label': TESTING_LABEL, 'device': DEVICE})
-                tools.init(TOOLS_FILE, DEVICE)
-                tools.adb_reboot(wait=False, unlock=False)
-        else:
-            logger.error("Critical state, locking out rabbit ACK!",
-                         extra={'reason': 'Device not connected or multiple app installation failed', 'apk': app, 'version': version,
-                                'container': CONTAINER, 'testing_label': TESTING_LABEL,
-                                'device': DEVICE})
-    elif code == SOFT_FAIL:
+        extra = {'apk': app, 'version': version, 'testing_label': TESTING_LABEL, 'container': CONTAINER}
+        if apk_cache is not None:
+            extra.update({'cache_{}'.format(k): v for k, v in apk_cache.stats().items()})
+        if apk_index is not None:
+            # metadata is extracted here, while the APK is staged, and never again for the same content
+            try:
+                record = apk_index.lookup(value, sha256=storage.sha256)
+                extra.update({'apk_size': record['size'], 'permission_count': record['permission_count']})
+            except (axml.ManifestError, OSError) as e:
+                extra['index_error'] = str(e)
+        logger.debug("Apk recovered from the Storage server", extra=extra)
+        return value
+    shutil.rmtree(folder, ignore_errors=True)
+    if code == SOFT_FAIL:
         logger.error("Couldn't get the apk from the Storage server", extra={'exception_message': value,
                                                                             'apk': app, 'version': version,
                                                                             'testing_label': TESTING_LABEL,
-                                                                            'container': CONTAINER, 'device': DEVICE})
-        cb = functools.partial(ack_message, channel, delivery_tag)
-        connection.add_callback_threadsafe(cb)
+                                                                            'container': CONTAINER})
+        settle(body, code)
         logger.debug(" App removed from queue", extra={'apk': app, 'version': version, 'container': CONTAINER,
-                                                       'testing_label': TESTING_LABEL, 'device': DEVICE})
+                                                       'testing_label': TESTING_LABEL})
     else:  # RabbitMQ will be locked in, as the storage server is not responding
         logger.error("Storage server is not responding!", extra={'exception_message': value,
                                                                  'apk': app, 'version': version,
                                                                  'testing_label': TESTING_LABEL,
                                                                  'container': CONTAINER})
+        consumer.release(body)
+    return None
 
 
-def on_message(channel, method_frame, header_frame, body, args):
-    (connection, threads) = args
-    delivery_tag = method_frame.delivery_tag
-    th = threading.Thread(target=testing, args=(connection, channel, delivery_tag, body))
-    th.start()
-    threads.append(th)
+def testing(delivery_id, body, apk_path, device=None):
+    device = device if device is not None else DEVICES[0]
+    print(" [x] Started app analysis {} on {}".format(body.decode('utf-8'), device.serial))
+
+    body_json = json.loads(body)
+    app = body_json['apk']
+    version = body_json['version']
+    # whatever raises, the device goes back to the pool and the delivery is settled or released
+    (returned, settled) = (False, False)
+    try:
+        started = time.time()
+        exit_code = t.session(logger, device=device.serial, port=device.port).run(apk_path, str(version), app)
+        metrics.observe_stage('test', time.time() - started, device.serial,
+                              OUTCOMES.get(exit_code, metrics.FAILURE))
+        if exit_code == SOFT_FAIL:
+            device.abnormal_soft_count += 1
+        elif exit_code == SUCCESS:
+            device.abnormal_soft_count = 0
+
+        if exit_code == SUCCESS or (exit_code == SOFT_FAIL and
+                                    device.abnormal_soft_count < ABNORMAL_SOFT_THRESHOLD):
+            if FORCE_REBOOT and datetime.now() > device.end_time:
+                logger.debug("Rebooting device",
+                             extra={'reason': 'Scheduled device reboot', 'apk': app, 'version': version,
+                                    'container': CONTAINER,
+                                    'testing_label': TESTING_LABEL, 'device': device.serial})
+                t.session(logger, device=device.serial, port=device.port).wait_sanitized()
+                device.adb.reboot(wait=False, unlock=False)
+                device.reset_reboot_timer()
+            # the device is given back before the ack, so the next delivery always finds an idle device
+            device_pool.release(device)
+            returned = True
+            settle(body, exit_code)
+            settled = True
+            logger.debug(" App removed from queue", extra={'apk': app, 'version': version, 'container': CONTAINER,
+                                                           'testing_label': TESTING_LABEL, 'device': device.serial})
+        else:
+            logger.error("Critical state, locking out rabbit ACK!",
+                         extra={'reason': 'Device not connected or multiple app installation failed', 'apk': app,
+                                'version': version, 'container': CONTAINER, 'testing_label': TESTING_LABEL,
+                                'device': device.serial})
+            device_pool.retire(device)
+            returned = True
+    finally:
+        shutil.rmtree(os.path.dirname(apk_path), ignore_errors=True)
+        if not returned:
+            device_pool.release(device)
+        if not settled:
+            consumer.release(body)
+
+
+class Prefetcher:
+    """Lookahead pipeline. The channel prefetch is the pool size plus LOOKAHEAD, so while the devices are busy
+    the APKs of the next LOOKAHEAD messages are downloaded in the background, and the staging area never holds
+    more APKs than the broker credit. Ready APKs are dispatched to the next idle device in arrival order"""
+    def __init__(self):
+        self.order = queue.Queue()
+
+    def submit(self, delivery_id, body):
+        # Downloads run concurrently, but every delivery keeps its arrival turn in the dispatch order
+        slot = queue.Queue(maxsize=1)
+        self.order.put(slot)
+        staging_pool.submit(self._stage, slot, delivery_id, body)
+
+    def _stage(self, slot, delivery_id, body):
+        apk_path = None
+        try:
+            apk_path = stage(delivery_id, body)
+        except Exception as e:
+            logger.error("APK staging failed", extra={'exception_message': str(e), 'container': CONTAINER,
+                                                      'testing_label': TESTING_LABEL})
+            shutil.rmtree(os.path.join(STAGING_PATH, str(delivery_id)), ignore_errors=True)
+            consumer.release(body)
+        finally:
+            slot.put((delivery_id, body, apk_path))
+
+    def dispatch(self):
+        while True:
+            slot = self.order.get()
+            if slot is None:
+                break
+            (delivery_id, body, apk_path) = slot.get()
+            if apk_path is None:
+                continue
+            device = device_pool.acquire()
+            testing_pool.submit(testing, delivery_id, body, apk_path, device)
+            logger.debug("Delivery dispatched", extra=dict(gauges(), device=device.serial, container=CONTAINER,
+                                                           testing_label=TESTING_LABEL))
+
+    def stop(self):
+        self.order.put(None)
+
+
+def gauges():
+    """Queue depth and utilization of the worker pools, and the idle devices"""
+    values = {'idle_devices': device_pool.idle.qsize(), 'available_devices': device_pool.size,
+              'dispatch_queued': prefetcher.order.qsize() if prefetcher is not None else 0}
+    values.update(staging_pool.gauges())
+    values.update(testing_pool.gauges())
+    return values
+
+
+class Consumer:
+    """Event-driven broker consumer. The connection runs on the pika ioloop of the main thread, so heartbeats
+    are answered while the tests run on the workers, and it is opened again with an exponential backoff when it
+    drops. Delivery tags die with their channel: the tags of an item on closed channels are dropped on every
+    reconnection, and a redelivery, or a duplicate, of an item being tested adds its tag to the ones acked when
+    its test ends. Deliveries are checked against the journal before anything is downloaded, and the items that
+    RESULT_POLICY does not test again, or whose test is done but not acked, are acked at once"""
+    def __init__(self, parameters, prefetch_count):
+        self.parameters = parameters
+        self.prefetch_count = prefetch_count
+        self.connection = None
+        self.channel = None
+        self.stopping = False
+        self.delay = RECONNECT_DELAY
+        self.ids = itertools.count(1)
+        # (app, version) -> ([(channel, delivery tag)...] the ack of the item goes to, its testing label)
+        self.inflight = {}
+        # items settled or given up by the workers, waiting for the ioloop: (key, requested time, ack)
+        self.settled = queue.Queue()
+
+    @staticmethod
+    def key(body):
+        body_json = json.loads(body)
+        return body_json['apk'], str(body_json['version'])
+
+    def run(self):
+        while not self.stopping:
+            self.connection = pika.SelectConnection(self.parameters, on_open_callback=self.on_open,
+                                                    on_open_error_callback=self.on_open_error,
+                                                    on_close_callback=self.on_closed)
+            try:
+                self.connection.ioloop.start()
+            except KeyboardInterrupt:
+                self.stop()
+            if not self.stopping:
+                logger.error('Broker connection lost, reconnecting', extra={'retry_in': self.delay,
+                                                                            'container': CONTAINER,
+                                                                            'testing_label': TESTING_LABEL})
+                time.sleep(self.delay)
+                self.delay = min(self.delay * 2, RECONNECT_MAX_DELAY)
+
+    def stop(self):
+        self.stopping = True
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+            self.connection.ioloop.start()  # runs until the connection is closed
+
+    def on_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_open_error(self, connection, error):
+        logger.error('Broker connection failed', extra={'exception_message': str(error), 'container': CONTAINER,
+                                                        'testing_label': TESTING_LABEL})
+        connection.ioloop.stop()
+
+    def on_closed(self, connection, reason):
+        self.channel = None
+        connection.ioloop.stop()
+
+    def on_channel_open(self, channel):
+        self.channel = channel
+        channel.exchange_declare(exchange=RABBIT_EXCHANGE, exchange_type="fanout", passive=False, durable=True,
+                                 auto_delete=False, callback=lambda frame: channel.queue_declare(
+                                     queue=RABBIT_QUEUE, durable=True, auto_delete=False,
+                                     arguments={"x-queue-type": "quorum"}, callback=self.on_queue_declared))
+
+    def on_queue_declared(self, frame):
+        self.channel.queue_bind(queue=frame.method.queue, exchange=RABBIT_EXCHANGE,
+                                callback=lambda _: self.channel.basic_qos(prefetch_count=self.prefetch_count,
+                                                                          callback=self.on_qos))
+
+    def on_qos(self, frame):
+        # the tags of the previous connection are gone, their items are found in the journal on redelivery
+        for (key, (tags, label)) in list(self.inflight.items()):
+            tags[:] = [(channel, tag) for (channel, tag) in tags if channel.is_open]
+            state = journal.state(key[0], key[1], label)
+            if not tags and (state is None or state[0] == jn.DONE):
+                del self.inflight[key]
+        self._flush()
+        self.channel.basic_consume(queue=RABBIT_QUEUE, on_message_callback=self.on_message)
+        self.delay = RECONNECT_DELAY
+        logger.debug('Consuming from the broker', extra={'container': CONTAINER, 'testing_label': TESTING_LABEL,
+                                                         'inflight': len(self.inflight)})
+
+    def label(self, body):
+        """Testing label an in-flight item was taken under, the label may be changed by a settings reload"""
+        return self.inflight.get(self.key(body), (None, TESTING_LABEL))[1]
+
+    def on_message(self, channel, method_frame, header_frame, body):
+        settings.current()  # picks up a changed configuration
+        key = self.key(body)
+        state = journal.completed(key[0], key[1], TESTING_LABEL, RESULT_POLICY, method_frame.redelivered)
+        if key in self.inflight:
+            (tags, label) = self.inflight[key]
+            tags.append((channel, method_frame.delivery_tag))
+            done = journal.state(key[0], key[1], label)
+            if done is not None and done[0] == jn.DONE:  # its ack is still on its way, or was lost
+                self._ack(key, time.time())
+            else:  # redelivered after a reconnection, or published again, while its test goes on
+                logger.debug('Delivery of an app being tested', extra={'apk': key[0], 'version': key[1],
+                                                                       'redelivered': method_frame.redelivered,
+                                                                       'container': CONTAINER,
+                                                                       'testing_label': TESTING_LABEL})
+        elif state is not None:
+            channel.basic_ack(method_frame.delivery_tag)
+            logger.debug('App already tested, acked', extra={'apk': key[0], 'version': key[1], 'exitcode': state[1],
+                                                             'attempts': state[2], 'policy': RESULT_POLICY,
+                                                             'redelivered': method_frame.redelivered,
+                                                             'container': CONTAINER, 'testing_label': TESTING_LABEL})
+        else:
+            self.inflight[key] = ([(channel, method_frame.delivery_tag)], TESTING_LABEL)
+            journal.start(key[0], key[1], TESTING_LABEL)
+            prefetcher.submit(next(self.ids), body)
+
+    def ack(self, body):
+        """Acks the deliveries of an item, can be called from any thread. Sent by the next reconnection when the
+        connection is down"""
+        self.settled.put((self.key(body), time.time(), True))
+        self.connection.ioloop.add_callback_threadsafe(self._flush)
+
+    def release(self, body):
+        """Forgets the deliveries of an item left unacked, so that its redelivery is tested again. Can be called
+        from any thread"""
+        self.settled.put((self.key(body), time.time(), False))
+        self.connection.ioloop.add_callback_threadsafe(self._flush)
+
+    def _flush(self):
+        while True:
+            try:
+                (key, requested, ack) = self.settled.get_nowait()
+            except queue.Empty:
+                return
+            if not ack:
+                self.inflight.pop(key, None)
+            elif key in self.inflight:
+                self._ack(key, requested)
+
+    def _ack(self, key, requested):
+        (tags, label) = self.inflight.pop(key)
+        tags = [(channel, delivery_tag) for (channel, delivery_tag) in tags if channel.is_open]
+        for (channel, delivery_tag) in tags:
+            channel.basic_ack(delivery_tag)
+        if tags:
+            metrics.observe_stage('ack', time.time() - requested)
+        else:
+            metrics.observe_stage('ack', time.time() - requested, outcome=metrics.FAILURE)  # its redelivery will be found done in the journal
+            logger.error("Ack cannot be delivered!", extra={'apk': key[0], 'version': key[1],
+                                                            'container': CONTAINER, 'testing_label': TESTING_LABEL})
+
+
+def start():
+    """Opens the local stores and starts the staging and testing pipeline. Returns the dispatcher thread"""
+    global apk_cache, apk_index, journal, device_pool, staging_pool, testing_pool, prefetcher
+    if CACHE_PATH is not None and CACHE_SIZE_MB > 0:
+        apk_cache = st.ApkCache(CACHE_PATH, CACHE_SIZE_MB * 1024 * 1024)
+    if INDEX_PATH is not None:
+        apk_index = apkindex.ApkIndex(INDEX_PATH)
+        tools.apk_index = apk_index
+    journal = jn.Journal(JOURNAL_PATH)
+    if JOURNAL_RETENTION_DAYS > 0:
+        journal.prune(JOURNAL_RETENTION_DAYS * 24 * 3600)
+    interrupted = journal.running()
+    if interrupted:
+        logger.debug('Apps whose test was interrupted will be tested again on redelivery',
+                     extra={'interrupted': len(interrupted), 'container': CONTAINER, 'testing_label': TESTING_LABEL})
+
+    if FORCE_REBOOT:
+        assert settings.current().sdk is not None, 'Scheduled reboots need the sdk section of %s' % TOOLS_FILE
+        tools.configure(settings.current().sdk)
+        for device in DEVICES:
+            device.adb = tools.device(device.serial)
+
+    # one in-flight message per idle device, plus the messages whose APK is prefetched. Every delivery has a
+    # staging worker and every device a testing worker, so the broker only gives credit for work a worker can
+    # take right away
+    device_pool = DevicePool(DEVICES)
+    staging_pool = workers.WorkerPool(device_pool.size + LOOKAHEAD, 'staging', logger)
+    testing_pool = workers.WorkerPool(device_pool.size, 'testing', logger)
+
+    prefetcher = Prefetcher()
+    metrics.register_gauges(gauges)
+    if settings.current().metrics.port is not None:
+        metrics.serve(settings.current().metrics.port)
+    if settings.current().metrics.textfile is not None:
+        metrics.write_periodically(settings.current().metrics.textfile)
+    # a daemon like the pool workers, a pipeline abandoned without stop() does not keep the process alive
+    dispatcher = threading.Thread(target=prefetcher.dispatch, daemon=True)
+    dispatcher.start()
+    return dispatcher
+
+
+def stop(dispatcher):
+    """Lets the deliveries taken finish, then closes the pipeline"""
+    prefetcher.stop()
+    dispatcher.join()
+    staging_pool.stop()
+    testing_pool.stop()
+    journal.close()
+
+
+# Unit testing
+import unittest
+
+
+class PipelineTestCase(unittest.TestCase):
+    """Journal, logger and pool of two devices of the pipeline, with a consumer recording acks and releases"""
+    class FakeConsumer:
+        def __init__(self):
+            (self.acked, self.released) = ([], [])
+
+        def label(self, body):
+            return TESTING_LABEL
+
+        def ack(self, body):
+            self.acked.append(body)
+
+        def release(self, body):
+            self.released.append(body)
+
+    def setUp(self):
+        import logging
+        import tempfile
+        global logger, consumer, journal, device_pool, FORCE_REBOOT, TESTING_LABEL
+        self.saved = (logger, consumer, journal, device_pool, FORCE_REBOOT, TESTING_LABEL)
+        TESTING_LABEL = 'label'
+        logger = logging.getLogger('queue_receive-test')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        self.folder = tempfile.TemporaryDirectory()
+        journal = jn.Journal(os.path.join(self.folder.name, 'journal.sqlite'))
+        consumer = self.FakeConsumer()
+        self.devices = [Device('serial1', '4001'), Device('serial2', '4002')]
+        device_pool = DevicePool(self.devices)
+        FORCE_REBOOT = False
+
+    def tearDown(self):
+        global logger, consumer, journal, device_pool, FORCE_REBOOT, TESTING_LABEL
+        journal.close()
+        self.folder.cleanup()
+        (logger, consumer, journal, device_pool, FORCE_REBOOT, TESTING_LABEL) = self.saved
+
+    @staticmethod
+    def message(app):
+        return json.dumps({'apk': app, 'version': 1}).encode('utf-8')
+
+
+class Test_Scheduler(PipelineTestCase):
+    class FakeSession:
+        def __init__(self, outcome):
+            self.outcome = outcome
+            self.sanitized = 0
+
+        def run(self, apk, version, app):
+            if isinstance(self.outcome, Exception):
+                raise self.outcome
+            return self.outcome
+
+        def wait_sanitized(self):
+            self.sanitized += 1
+
+    class FakeAdb:
+        def __init__(self):
+            self.reboots = []
+
+        def reboot(self, wait=True, unlock=True):
+            self.reboots.append((wait, unlock))
+
+    def setUp(self):
+        super().setUp()
+        self.body = self.message('com.example.app')
+
+    def run_test(self, outcome):
+        """testing() of the delivery on the first idle device, the session ending with outcome. Returns the
+        session and the device"""
+        import unittest.mock
+        apk = os.path.join(self.folder.name, 'staging', '1', 'com.example.app')
+        os.makedirs(os.path.dirname(apk), exist_ok=True)
+        journal.start('com.example.app', '1', TESTING_LABEL)
+        session = self.FakeSession(outcome)
+        device = device_pool.acquire()
+        with unittest.mock.patch.object(t, 'session', lambda *args, **kwargs: session):
+            testing(1, self.body, apk, device)
+        self.assertFalse(os.path.exists(os.path.dirname(apk)), 'It leaves the staged APK behind')
+        return session, device
+
+    def test_pool(self):
+        # Asserting idle devices are handed out in turn, given back, and retired for good
+        (a, b) = (device_pool.acquire(), device_pool.acquire())
+        self.assertEqual((a.serial, b.serial, device_pool.idle.qsize()), ('serial1', 'serial2', 0))
+        device_pool.release(a)
+        self.assertIs(device_pool.acquire(), a)
+        device_pool.retire(b)
+        device_pool.release(a)
+        self.assertEqual((device_pool.size, device_pool.idle.qsize()), (1, 1))
+
+    def test_testing(self):
+        # Asserting a tested app is settled and its device given back
+        self.run_test(SUCCESS)
+        self.assertEqual((consumer.acked, device_pool.idle.qsize()), ([self.body], 2))
+        self.assertEqual(journal.state('com.example.app', '1', TESTING_LABEL)[:2], (jn.DONE, SUCCESS))
+        # Asserting a session that raises gives its device back and releases its delivery unacked
+        self.assertRaises(RuntimeError, self.run_test, RuntimeError('adb went away'))
+        self.assertEqual((len(consumer.acked), consumer.released, device_pool.idle.qsize()), (1, [self.body], 2))
+        # Asserting a device in critical state is retired and its delivery released
+        (session, device) = self.run_test(HARD_FAIL)
+        self.assertEqual((device_pool.size, device_pool.idle.qsize(), len(consumer.released)), (1, 1, 2))
+
+    def test_scheduled_reboot(self):
+        global FORCE_REBOOT
+        FORCE_REBOOT = True
+        for device in self.devices:
+            device.adb = self.FakeAdb()
+        self.devices[0].end_time = datetime.now() - timedelta(seconds=1)
+        # Asserting a device past its reboot time is rebooted once sanitized, then its timer starts again
+        (session, device) = self.run_test(SUCCESS)
+        self.assertEqual((session.sanitized, device.adb.reboots), (1, [(False, False)]))
+        self.assertGreater(device.end_time, datetime.now())
+        self.assertEqual(consumer.acked, [self.body])
+        # Asserting a device not due is not rebooted
+        (session, device) = self.run_test(SUCCESS)
+        self.assertEqual((device.serial, session.sanitized, device.adb.reboots), ('serial2', 0, []))
+
+
+
+class Test_Prefetcher(PipelineTestCase):
+    LOOKAHEAD = 4
+
+    class FakeStorage:
+        """The APK of app<n> takes longer to download the smaller n is, so downloads end in reverse order"""
+        def __init__(self, server, port, app, version, cache=None):
+            (self.app, self.sha256) = (app, None)
+
+        def apk(self, folder):
+            time.sleep(0.02 * (10 - int(self.app[len('app'):])))
+            if self.app == 'app2':
+                return HARD_FAIL, 'Storage server not responding'
+            if self.app == 'app3':
+                raise OSError('No space left on device')
+            if self.app == 'app4':
+                return SOFT_FAIL, 'Unavailable APK, "null" returned'
+            path = os.path.join(folder, self.app)
+            with zipfile.ZipFile(path, 'w') as f:
+                f.writestr('AndroidManifest.xml', b'')
+            return SUCCESS, path
+
+    def setUp(self):
+        super().setUp()
+        global STAGING_PATH, staging_pool, testing_pool, prefetcher
+        self.saved_pipeline = (STAGING_PATH, staging_pool, testing_pool, prefetcher)
+        STAGING_PATH = os.path.join(self.folder.name, 'staging')
+        staging_pool = workers.WorkerPool(device_pool.size + self.LOOKAHEAD, 'staging-test', logger)
+        testing_pool = self
+        prefetcher = Prefetcher()
+        self.tested = []
+
+    def tearDown(self):
+        global STAGING_PATH, staging_pool, testing_pool, prefetcher
+        staging_pool.stop()
+        (STAGING_PATH, staging_pool, testing_pool, prefetcher) = self.saved_pipeline
+        super().tearDown()
+
+    def submit(self, function, delivery_id, body, apk_path, device):
+        # testing pool of the test: the APK is taken and the device given back at once
+        self.tested.append(json.loads(body)['apk'])
+        shutil.rmtree(os.path.dirname(apk_path))
+        device_pool.release(device)
+
+    def gauges(self):
+        return {'testing_tested': len(self.tested)}
+
+    def test_prefetch(self):
+        import unittest.mock
+        bodies = [self.message('app{}'.format(n)) for n in range(device_pool.size + self.LOOKAHEAD)]
+        dispatcher = threading.Thread(target=prefetcher.dispatch)
+        dispatcher.start()
+        with unittest.mock.patch.object(st, 'Storage', self.FakeStorage):
+            for (n, body) in enumerate(bodies):
+                prefetcher.submit(n, body)
+            prefetcher.stop()
+            dispatcher.join(10)
+        # Asserting the APKs are dispatched in arrival order, whatever order their downloads end in
+        self.assertEqual(self.tested, ['app0', 'app1', 'app5'])
+        # Asserting every abandoned delivery is settled or released, and leaves nothing staged
+        self.assertEqual(consumer.acked, [bodies[4]])
+        self.assertEqual(sorted(consumer.released), [bodies[2], bodies[3]])
+        self.assertEqual(os.listdir(STAGING_PATH), [])
+        self.assertEqual((prefetcher.order.qsize(), device_pool.idle.qsize()), (0, 2))
+
+
+class Test_Consumer(PipelineTestCase):
+    class FakeChannel:
+        def __init__(self):
+            self.is_open = True
+            self.acks = []
+
+        def basic_ack(self, delivery_tag):
+            self.acks.append(delivery_tag)
+
+        def basic_consume(self, queue, on_message_callback):
+            pass
+
+    class FakeConnection:
+        """Connection and its ioloop, whose callbacks only run when the test says so"""
+        def __init__(self):
+            self.ioloop = self
+            self.callbacks = []
+
+        def add_callback_threadsafe(self, callback):
+            self.callbacks.append(callback)
+
+        def run_callbacks(self):
+            (callbacks, self.callbacks) = (self.callbacks, [])
+            for callback in callbacks:
+                callback()
+
+    Method = collections.namedtuple('Method', ['delivery_tag', 'redelivered'])
+
+    def setUp(self):
+        import unittest.mock
+        super().setUp()
+        global consumer, prefetcher, RESULT_POLICY
+        self.saved_consumer = (prefetcher, RESULT_POLICY)
+        prefetcher = self
+        self.submitted = []
+        consumer = Consumer(None, 2)
+        self.reconnect()
+        self.patch = unittest.mock.patch.object(settings, 'current')
+        self.patch.start()
+
+    def tearDown(self):
+        global prefetcher, RESULT_POLICY
+        self.patch.stop()
+        (prefetcher, RESULT_POLICY) = self.saved_consumer
+        super().tearDown()
+
+    def submit(self, delivery_id, body):
+        self.submitted.append(body)
+
+    def reconnect(self):
+        """A new connection and channel, the previous channel being closed"""
+        if consumer.channel is not None:
+            consumer.channel.is_open = False
+        (consumer.connection, consumer.channel) = (self.FakeConnection(), self.FakeChannel())
+        consumer.on_qos(None)
+        return consumer.channel
+
+    def deliver(self, body, tag, redelivered=False):
+        consumer.on_message(consumer.channel, self.Method(tag, redelivered), None, body)
+
+    def test_ack_across_reconnection(self):
+        body = self.message('com.example.app')
+        first = consumer.channel
+        self.deliver(body, 1)
+        # Asserting a duplicate publish is not tested again and is acked along with the first delivery
+        self.deliver(body, 2)
+        self.assertEqual(self.submitted, [body])
+        connection = consumer.connection
+        settle(body, SUCCESS)
+        connection.run_callbacks()
+        self.assertEqual(first.acks, [1, 2])
+        # Asserting a test ending while the connection is down is acked on its redelivery, found done
+        self.deliver(body, 3, redelivered=True)
+        journal.start('com.example.app', '1', TESTING_LABEL)
+        self.submitted = []
+        other = self.message('com.example.other')
+        self.deliver(other, 4)
+        settle(other, SUCCESS)  # its ack goes to the ioloop of a connection that never runs again
+        second = self.reconnect()
+        self.assertEqual((first.acks, consumer.inflight), ([1, 2, 3], {}))
+        self.deliver(other, 1, redelivered=True)
+        self.assertEqual((second.acks, self.submitted), ([1], [other]))
+
+    def test_redelivery_while_tested(self):
+        body = self.message('com.example.app')
+        self.deliver(body, 1)
+        # Asserting the tag of a closed channel is dropped and the redelivery acked once the test ends
+        second = self.reconnect()
+        self.assertEqual(consumer.inflight[('com.example.app', '1')][0], [])
+        self.deliver(body, 5, redelivered=True)
+        self.assertEqual(self.submitted, [body])
+        settle(body, SUCCESS)
+        consumer.connection.run_callbacks()
+        self.assertEqual((second.acks, consumer.inflight), ([5], {}))
+
+    def test_release(self):
+        body = self.message('com.example.app')
+        self.deliver(body, 1)
+        consumer.release(body)
+        consumer.connection.run_callbacks()
+        # Asserting a released item is tested again on its redelivery
+        self.reconnect()
+        self.deliver(body, 1, redelivered=True)
+        self.assertEqual(self.submitted, [body, body])
+
+    def test_policy(self):
+        global RESULT_POLICY
+        RESULT_POLICY = jn.FORCE
+        body = self.message('com.example.app')
+        journal.start('com.example.app', '1', TESTING_LABEL)
+        journal.finish('com.example.app', '1', TESTING_LABEL, SUCCESS)
+        # Asserting the redelivered flag reaches the journal: a redelivery of an item done is acked, a new
+        # delivery is tested again under the force policy
+        self.deliver(body, 1, redelivered=True)
+        self.assertEqual((consumer.channel.acks, self.submitted), ([1], []))
+        self.deliver(body, 2)
+        self.assertEqual((consumer.channel.acks, self.submitted), ([1], [body]))
+
+    def test_backoff(self):
+        import unittest.mock
+
+        class FailingConnection(self.FakeConnection):
+            def __init__(self, parameters, on_open_callback, on_open_error_callback, on_close_callback):
+                super().__init__()
+                self.on_open_error = on_open_error_callback
+
+            def start(self):
+                if len(delays) == 3:
+                    consumer.stopping = True
+                self.on_open_error(self, 'Connection refused')
+
+            def stop(self):
+                pass
+        delays = []
+        with unittest.mock.patch.object(pika, 'SelectConnection', FailingConnection), \
+                unittest.mock.patch.object(time, 'sleep', delays.append):
+            consumer.run()
+        # Asserting the connection is opened again with an exponential backoff, reset once consuming
+        self.assertEqual(delays, [RECONNECT_DELAY, RECONNECT_DELAY * 2, RECONNECT_DELAY * 4])
+        consumer.on_qos(None)
+        self.assertEqual(consumer.delay, RECONNECT_DELAY)
 
 
 if __name__ == '__main__':
@@ -178,32 +892,16 @@ if __name__ == '__main__':
         logger.debug('Filebeat agent started successfully', extra={'testing_label': TESTING_LABEL,
                                                                    'container': CONTAINER})
     logger.debug('Starting traffic analysis module', extra={'testing_label': TESTING_LABEL,
-                                                            'container': CONTAINER})
+                                                            'container': CONTAINER,
+                                                            'device': ','.join(d.serial for d in DEVICES)})
+
+    dispatcher = start()
 
     credentials = pika.PlainCredentials(RABBIT_USERNAME, RABBIT_PASSWORD)
     parameters = pika.ConnectionParameters(RABBIT_SERVER, RABBIT_PORT, credentials=credentials, heartbeat=5)
-    connection = pika.BlockingConnection(parameters)
-
-    channel = connection.channel()
-    channel.exchange_declare(exchange=RABBIT_EXCHANGE, exchange_type="fanout", passive=False, durable=True,
-                             auto_delete=False)
-    result = channel.queue_declare(queue=RABBIT_QUEUE, durable=True, auto_delete=False,
-                                   arguments={"x-queue-type": "quorum"})
-    channel.queue_bind(queue=result.method.queue, exchange=RABBIT_EXCHANGE)
-
-    channel.basic_qos(prefetch_count=1)
-
-    threads = []
-    on_message_callback = functools.partial(on_message, args=(connection, threads))
-    channel.basic_consume(on_message_callback=on_message_callback, queue=result.method.queue)
+    consumer = Consumer(parameters, device_pool.size + LOOKAHEAD)
 
     print(' [*] Waiting for messages. To exit press CTRL+C')
+    consumer.run()
 
-    try:
-        channel.start_consuming()
-    except KeyboardInterrupt:
-        channel.stop_consuming()
-
-    for thread in threads:
-        thread.join()
-    connection.close()
+    stop(dispatcher)
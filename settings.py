@@ -0,0 +1,255 @@
+##########################################################################
+#                      SHARED EXECUTOR SETTINGS                          #
+##########################################################################
+# executor.config is read and validated once into an immutable Settings (namedtuples per section, values
+# already converted), shared by queue_receive, testing and tools. current() watches the mtime of the files and
+# swaps in a new Settings when they change, so timeouts and labels can be tuned without restarting the
+# consumer. A file that fails validation is reported and the previous Settings stays in use.
+#
+# The sdk section (adb and aapt paths) can live in executor.config or in the tools config file.
+import collections
+import configparser
+import os
+import threading
+import time
+from datetime import datetime
+
+CHECK_INTERVAL = 5
+
+Base = collections.namedtuple('Base', ['base_path', 'results_output'])
+Terminal = collections.namedtuple('Terminal', ['serial', 'port'])
+TestingEnv = collections.namedtuple('TestingEnv', ['server_ip', 'server_port', 'terminal', 'terminals',
+                                                   'force_reboot', 'reboot_timeout', 'abnormal_threshold'])
+Testing = collections.namedtuple('Testing', ['phase_one_timeout', 'phase_two_timeout', 'permissions', 'reboot',
+                                             'monkey', 'label', 'async_phases', 'phase_grace', 'sanitize_deadline',
+                                             'overlap_sanitize', 'combined_setup'])
+Rabbit = collections.namedtuple('Rabbit', ['username', 'password', 'server_ip', 'server_port', 'queue', 'exchange'])
+Storage = collections.namedtuple('Storage', ['ip', 'port'])
+Prefetch = collections.namedtuple('Prefetch', ['staging_path', 'lookahead'])
+Cache = collections.namedtuple('Cache', ['path', 'size_mb'])
+Index = collections.namedtuple('Index', ['path'])
+Journal = collections.namedtuple('Journal', ['path', 'policy', 'retention_days'])
+Http = collections.namedtuple('Http', ['pool_size', 'connect_timeout', 'read_timeout', 'read_timeouts'])
+Sdk = collections.namedtuple('Sdk', ['adb_path', 'aapt_path', 'adb_server'])
+Metrics = collections.namedtuple('Metrics', ['port', 'textfile'])
+Results = collections.namedtuple('Results', ['compression'])
+Artifacts = collections.namedtuple('Artifacts', ['names', 'workers'])
+Settings = collections.namedtuple('Settings', ['path', 'sdk_path', 'mtime', 'base', 'testing_env', 'testing',
+                                               'rabbitmq', 'storage', 'prefetch', 'cache', 'index', 'journal',
+                                               'http', 'sdk', 'metrics', 'results', 'artifacts'])
+
+_current = None
+_checked = 0
+_lock = threading.Lock()
+_listeners = []
+
+
+class SettingsError(Exception):
+    pass
+
+
+def log(tag, message):
+    print('(%s) %s -- %s' % (tag, datetime.utcnow().strftime('%Y-%m-%d-%H:%M:%S'), message))
+
+
+def _mtime(path, sdk_path):
+    return max(os.path.getmtime(p) if p is not None and os.path.isfile(p) else 0 for p in (path, sdk_path))
+
+
+def _flag(value):
+    return value == 'True'
+
+
+def _list(value):
+    return [x.strip() for x in value.split(',') if x.strip()]
+
+
+def load(path, sdk_path=None):
+    """Reads and validates the configuration files. Raises SettingsError naming the first missing or invalid
+    value"""
+    if not os.path.isfile(path):
+        raise SettingsError('%s is not a valid file or path to file' % path)
+    mtime = _mtime(path, sdk_path)
+    config = configparser.ConfigParser()
+    config.read(path)
+    try:
+        base_path = config['base']['base_path']
+        env = config['testing_env']
+        # device-pool mode: every terminal of testing_terminals is paired with the testing server port at the
+        # same position in testing_server_ports
+        if 'testing_terminals' in env:
+            (serials, ports) = (_list(env['testing_terminals']), _list(env['testing_server_ports']))
+            if len(serials) != len(ports):
+                raise SettingsError('testing_terminals and testing_server_ports must have the same length')
+            terminals = tuple(Terminal(s, p) for s, p in zip(serials, ports))
+        else:
+            terminals = (Terminal(env['testing_terminal'], env['testing_server_port']),)
+        testing_env = TestingEnv(env['testing_server_ip'], env['testing_server_port'], env['testing_terminal'],
+                                 terminals, _flag(env['force_reboot']), int(env['reboot_timeout']),
+                                 int(env['abnormal_threshold']))
+        section = config['testing']
+        testing = Testing(int(section['phase-one_timeout']), int(section['phase-two_timeout']),
+                          _flag(section['permissions']), _flag(section['reboot']), _flag(section['monkey']),
+                          section['testing_label'], config.getboolean('testing', 'async_phases', fallback=False),
+                          config.getint('testing', 'phase_grace', fallback=120),
+                          config.getfloat('testing', 'sanitize_deadline', fallback=20),
+                          config.getboolean('testing', 'overlap_sanitize', fallback=False),
+                          config.getboolean('testing', 'combined_setup', fallback=False))
+        section = config['rabbitmq']
+        rabbitmq = Rabbit(section['username'], section['password'], section['server_ip'], section['server_port'],
+                          section['queue'], section['exchange'])
+        storage = Storage(config['storage']['ip'], config['storage']['port'])
+        prefetch = Prefetch(config.get('prefetch', 'staging_path', fallback=os.path.join(base_path, 'staging')),
+                            config.getint('prefetch', 'lookahead', fallback=0))
+        cache = Cache(config.get('cache', 'path', fallback=None), config.getint('cache', 'size_mb', fallback=0))
+        index = Index(config.get('index', 'path', fallback=None))
+        journal = Journal(config.get('journal', 'path',
+                                     fallback=os.path.join(base_path, 'journal', 'inflight.sqlite')),
+                          config.get('journal', 'policy', fallback='skip'),
+                          config.getint('journal', 'retention_days', fallback=0))
+        if journal.policy not in ('skip', 'rerun-failed', 'force'):
+            raise SettingsError('journal policy must be one of skip, rerun-failed, force')
+        http = None
+        if 'http' in config:
+            section = config['http']
+            http = Http(section.getint('pool_size', fallback=None),
+                        section.getfloat('connect_timeout', fallback=None),
+                        section.getfloat('read_timeout', fallback=None),
+                        tuple((k[len('read_timeout.'):], float(v)) for k, v in section.items()
+                              if k.startswith('read_timeout.')))
+        sdk = None
+        if 'sdk' in config:
+            section = config['sdk']
+            sdk = Sdk(section['ADBPath'], section['AAPTPath'], section.get('ADBServer', None))
+        elif sdk_path is not None and os.path.isfile(sdk_path):
+            sdk = load_sdk(sdk_path)
+        metrics = Metrics(config.getint('metrics', 'port', fallback=None),
+                          config.get('metrics', 'textfile', fallback=None))
+        results = Results(config.get('results', 'compression', fallback='none'))
+        if results.compression not in ('none', 'gzip', 'zstd'):
+            raise SettingsError('results compression must be one of none, gzip, zstd')
+        artifacts = Artifacts(tuple(_list(config.get('artifacts', 'names', fallback=''))),
+                              config.getint('artifacts', 'workers', fallback=4))
+        for name in artifacts.names:
+            if name not in ('screenshot-phase-one', 'screenshot-phase-two', 'raw-phase-one', 'raw-phase-two'):
+                raise SettingsError('unknown artifact %s' % name)
+        return Settings(path, sdk_path, mtime, Base(base_path, config['base']['results_output']), testing_env,
+                        testing, rabbitmq, storage, prefetch, cache, index, journal, http, sdk, metrics, results,
+                        artifacts)
+    except KeyError as e:
+        raise SettingsError('%s: missing section or value %s' % (path, e))
+    except ValueError as e:
+        raise SettingsError('%s: %s' % (path, e))
+
+
+def load_sdk(path):
+    """Sdk of a file holding only the sdk section (the tools config file)"""
+    if not os.path.isfile(path):
+        raise SettingsError('%s is not a valid file or path to file' % path)
+    config = configparser.ConfigParser()
+    config.read(path)
+    if 'sdk' not in config:
+        raise SettingsError('Config file %s does not contain an sdk section' % path)
+    section = config['sdk']
+    for key in ('ADBPath', 'AAPTPath'):
+        if key not in section:
+            raise SettingsError('Config file %s does not have an %s value in the sdk section' % (path, key))
+    return Sdk(section['ADBPath'], section['AAPTPath'], section.get('ADBServer', None))
+
+
+def init(path, sdk_path=None):
+    """Loads the settings shared by every module, or returns them when the same files are already loaded (any
+    sdk file when sdk_path is None)"""
+    global _current, _checked
+    with _lock:
+        if _current is None or _current.path != path or sdk_path not in (None, _current.sdk_path):
+            _current = load(path, sdk_path)
+            _checked = time.time()
+            listeners = list(_listeners)
+        else:
+            return _current
+    for callback in listeners:
+        callback(_current)
+    return _current
+
+
+def loaded():
+    return _current is not None
+
+
+def current():
+    """Shared settings, reloaded when their files changed since they were read"""
+    global _current, _checked
+    with _lock:
+        settings = _current
+        if settings is None:
+            raise SettingsError('Settings not yet loaded, need to init() first')
+        if time.time() - _checked < CHECK_INTERVAL:
+            return settings
+        _checked = time.time()
+    try:
+        if _mtime(settings.path, settings.sdk_path) == settings.mtime:
+            return settings
+        reloaded = load(settings.path, settings.sdk_path)
+    except (SettingsError, OSError) as e:
+        log('SETTINGS', 'Reload failed, keeping the previous settings: %s' % e)
+        return settings
+    with _lock:
+        if _current is not settings:  # reloaded by another thread meanwhile
+            return _current
+        _current = reloaded
+        listeners = list(_listeners)
+    log('SETTINGS', 'Reloaded %s' % settings.path)
+    for callback in listeners:
+        callback(reloaded)
+    return reloaded
+
+
+def on_reload(callback):
+    """callback(settings) is called with every Settings loaded from now on"""
+    with _lock:
+        _listeners.append(callback)
+
+
+# Unit testing
+import unittest
+
+
+class Test_Settings(unittest.TestCase):
+    def setUp(self):
+        global CHECK_INTERVAL
+        self.saved = (CHECK_INTERVAL, _current, _checked, list(_listeners))
+        CHECK_INTERVAL = 0
+
+    def tearDown(self):
+        global CHECK_INTERVAL, _current, _checked
+        (CHECK_INTERVAL, _current, _checked, _listeners[:]) = self.saved
+
+    def test_reload(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'executor.config')
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'executor.config')) as f:
+                text = f.read()
+            with open(path, 'w') as f:
+                f.write(text)
+            reloads = []
+            on_reload(reloads.append)
+            settings = init(path)
+            self.assertEqual((settings.testing.phase_one_timeout, settings.prefetch.lookahead), (20, 1))
+            self.assertEqual(settings.testing_env.terminals, (Terminal('c448e545', '4000'),))
+            self.assertIs(current(), settings)
+            # Asserting a changed file is swapped in, and an invalid one is ignored
+            with open(path, 'w') as f:
+                f.write(text.replace('phase-one_timeout = 20', 'phase-one_timeout = 30'))
+            os.utime(path, (settings.mtime + 10, settings.mtime + 10))
+            self.assertEqual(current().testing.phase_one_timeout, 30)
+            with open(path, 'w') as f:
+                f.write(text.replace('phase-one_timeout = 20', 'phase-one_timeout = x'))
+            os.utime(path, (settings.mtime + 20, settings.mtime + 20))
+            self.assertEqual(current().testing.phase_one_timeout, 30)
+            self.assertEqual([s.testing.phase_one_timeout for s in reloads], [20, 30])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,479 @@
+##########################################################################
+#                    LOCAL TESTING SERVER STAND-IN                       #
+##########################################################################
+# Answers the testing server REST API used by traffico.Traffic (/config, /upload, /phase-one, /phase-two,
+# /analysis, /result, /sanitize ...) without any device behind it, plus the job endpoints of the phases:
+#   /phase-one/submit, /phase-two/submit -> {"Ok": true, "Job": id}
+#   /job/<id>                           -> {"State": "running"|"done"|"cancelled", "Progress": 0..1, Ok, Msg, Code}
+#   /job/<id>/cancel
+# A phase lasts its timeout parameter multiplied by phase_scale. /ready answers Ok once ready_delay seconds
+# went by since the last /result. latencies and failure_rates, keyed by endpoint name ('config', 'upload',
+# 'phase-one' ...), add a delay to every request of an endpoint and make a share of them answer Ok false.
+# /result answers a report of result_records JSON lines. The artifacts (/screenshot-phase-one, /raw-phase-two
+# ...) are artifact_size bytes, raw captures are sent gzip encoded when asked, and Range is honoured; the first
+# transfer of the artifacts in drop_once is cut in the middle. Uploads are deduplicated by hash:
+#   /upload/hash?sha256=     -> {"Ok": true, "Known": bool}, a known APK is taken as the APK of the session
+#   /upload/stream?sha256=   <- chunked body of the APK, checked against its sha256
+#   /setup?sha256=&timeout=  -> {"Ok": true, "Session": id, "Job": id of phase one}, or {"Ok": false, "Missing": true}
+#                               when the APK is not known and not in the body
+#
+# StorageServer serves synthetic APKs (a valid manifest plus apk_size bytes of payload) on the storage server
+# API used by apistorage.Storage, and write_fake_sdk writes adb and aapt stand-in binaries.
+#
+# AdbServer is a fake adb server speaking the adb host protocol (see adbclient) for a set of FakeDevice.
+import gzip
+import hashlib
+import http.server
+import io
+import itertools
+import json
+import os
+import random
+import re
+import socketserver
+import stat
+import struct
+import threading
+import time
+import urllib.parse
+import zipfile
+import axml
+
+# Code of an injected failure per endpoint, as the testing server reports it
+FAILURE_CODES = {'phase-one': 20, 'setup': 20}
+
+
+class Job:
+    def __init__(self, duration):
+        self.duration = duration
+        self.started = time.time()
+        self.cancelled = threading.Event()
+        self.state = 'running'
+        th = threading.Thread(target=self.run, daemon=True)
+        th.start()
+
+    def run(self):
+        if self.cancelled.wait(self.duration):
+            self.state = 'cancelled'
+        else:
+            self.state = 'done'
+
+    def status(self):
+        data = {'State': self.state, 'Progress': min(1.0, (time.time() - self.started) / max(self.duration, 1e-6))}
+        if self.state == 'done':
+            data.update({'Ok': True, 'Msg': 'Phase finished', 'Code': 0})
+        elif self.state == 'cancelled':
+            data.update({'Ok': False, 'Msg': 'Phase cancelled', 'Code': 50})
+        return data
+
+
+class TestingServer:
+    def __init__(self, host='127.0.0.1', port=0, phase_scale=1.0, ready_delay=0, latencies=None, failure_rates=None,
+                 seed=None, result_records=1, artifact_size=0):
+        self.phase_scale = phase_scale
+        self.ready_delay = ready_delay
+        self.latencies = latencies or {}
+        self.failure_rates = failure_rates or {}
+        self.random = random.Random(seed)
+        self.report = b''.join(json.dumps({'record': i, 'host': 'tracker{}.example.com'.format(i % 7),
+                                           'pii': ['AAID', 'IMEI'][:i % 3]}).encode('utf-8') + b'\n'
+                               for i in range(result_records))
+        self.artifact_size = artifact_size
+        self.artifacts = {}
+        self.drop_once = set()
+        self.uploads = {}  # sha256 -> size of the APKs received
+        self.uploaded_bytes = 0
+        self.last_result = 0
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.requests = []
+        self.httpd = http.server.ThreadingHTTPServer((host, port), self.handler())
+        self.httpd.daemon_threads = True
+        self.host, self.port = self.httpd.server_address[:2]
+
+    def start(self):
+        th = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        th.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for job in self.jobs.values():
+            job.cancelled.set()
+
+    def phase_duration(self, params):
+        return float(params.get('timeout', 0)) * self.phase_scale
+
+    def artifact(self, path, headers):
+        """Answer of an artifact request: (status, content type, body, headers)"""
+        encoding = 'gzip' if path.startswith('/raw-') and 'gzip' in headers.get('Accept-Encoding', '') else None
+        if (path, encoding) not in self.artifacts:
+            if path.startswith('/raw-'):  # captures compress well
+                data = b''.join(b'%08d GET http://tracker.example.com/%d\n' % (i, i % 97)
+                                for i in range(self.artifact_size // 40 + 1))[:self.artifact_size]
+            else:
+                data = random.Random(path).randbytes(self.artifact_size)
+            self.artifacts[(path, encoding)] = gzip.compress(data, mtime=0) if encoding else data
+        data = self.artifacts[(path, encoding)]
+        extra = [('Content-Encoding', encoding)] if encoding else []
+        match = re.match(r'bytes=(\d+)-$', headers.get('Range', ''))
+        if match is None:
+            return 200, 'application/octet-stream', data, extra
+        start = int(match.group(1))
+        if start >= len(data):
+            return 416, 'application/octet-stream', b'', [('Content-Range', 'bytes */{}'.format(len(data)))]
+        return 206, 'application/octet-stream', data[start:], extra + [
+            ('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))]
+
+    def answer(self, method, path, params, body, headers=None):
+        """Returns (status, content type, body) or (status, content type, body, headers) for a request"""
+        self.requests.append(path)
+        ok = {'Ok': True, 'Msg': 'Ok', 'Code': 0}
+        parts = path.strip('/').split('/')
+        endpoint = parts[0]
+        time.sleep(self.latencies.get(endpoint, 0))
+        if self.random.random() < self.failure_rates.get(endpoint, 0):
+            return 200, 'application/json', {'Ok': False, 'Msg': 'Injected {} failure'.format(endpoint),
+                                             'Code': FAILURE_CODES.get(endpoint, 0)}
+        if path == '/setup':
+            if body:
+                self.uploaded_bytes += len(body)
+                if hashlib.sha256(body).hexdigest() != params.get('sha256'):
+                    return 200, 'application/json', {'Ok': False, 'Msg': 'APK hash mismatch', 'Code': 70}
+                self.uploads[params['sha256']] = len(body)
+            if params.get('sha256') not in self.uploads:
+                return 200, 'application/json', {'Ok': False, 'Msg': 'APK not on the server', 'Code': 70,
+                                                  'Missing': True}
+            job = str(next(self.ids))
+            self.jobs[job] = Job(self.phase_duration(params))
+            return 200, 'application/json', dict(ok, Session=job, Job=job)
+        if path == '/upload/hash':
+            return 200, 'application/json', dict(ok, Known=params.get('sha256') in self.uploads)
+        if path == '/upload/stream':
+            self.uploaded_bytes += len(body)
+            if hashlib.sha256(body).hexdigest() != params.get('sha256'):
+                return 200, 'application/json', {'Ok': False, 'Msg': 'APK hash mismatch', 'Code': 0}
+            self.uploads[params['sha256']] = len(body)
+            return 200, 'application/json', ok
+        if path in ('/config', '/upload', '/analysis', '/cert', '/hooker', '/sanitize'):
+            return 200, 'application/json', ok
+        if path in ('/phase-one', '/phase-two'):
+            time.sleep(self.phase_duration(params))
+            return 200, 'application/json', ok
+        if len(parts) == 2 and parts[1] == 'submit' and parts[0] in ('phase-one', 'phase-two'):
+            job = str(next(self.ids))
+            self.jobs[job] = Job(self.phase_duration(params))
+            return 200, 'application/json', {'Ok': True, 'Msg': 'Job submitted', 'Code': 0, 'Job': job}
+        if parts[0] == 'job' and len(parts) >= 2 and parts[1] in self.jobs:
+            job = self.jobs[parts[1]]
+            if len(parts) == 3 and parts[2] == 'cancel':
+                job.cancelled.set()
+                return 200, 'application/json', {'Ok': True, 'Msg': 'Job cancelled'}
+            return 200, 'application/json', job.status()
+        if path == '/ready':
+            return 200, 'application/json', dict(ok, Ok=time.time() - self.last_result >= self.ready_delay)
+        if path == '/result':
+            self.last_result = time.time()
+            return 200, 'text/plain', self.report
+        if path.startswith('/screenshot-') or path.startswith('/raw-'):
+            return self.artifact(path, headers or {})
+        return 404, 'application/json', {'Ok': False, 'Msg': 'Unknown endpoint {}'.format(path), 'Code': 0}
+
+    def handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body go out in separate writes, delayed acks would add 40 ms to every answer
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def serve(self, method):
+                url = urllib.parse.urlsplit(self.path)
+                params = dict(urllib.parse.parse_qsl(url.query))
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    body = self.chunked()
+                else:
+                    length = int(self.headers.get('Content-Length', 0))
+                    body = self.rfile.read(length) if length > 0 else b''
+                answer = server.answer(method, url.path, params, body, self.headers)
+                (status, content_type, data) = answer[:3]
+                if not isinstance(data, bytes):
+                    data = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                for header in answer[3] if len(answer) > 3 else []:
+                    self.send_header(*header)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                if url.path in server.drop_once:
+                    server.drop_once.discard(url.path)
+                    self.wfile.write(data[:len(data) // 2])
+                    self.close_connection = True
+                    return
+                self.wfile.write(data)
+
+            def chunked(self):
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                    if size == 0:
+                        while self.rfile.readline() not in (b'\r\n', b'\n', b''):  # trailers
+                            pass
+                        return b''.join(chunks)
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+
+            def do_GET(self):
+                self.serve('GET')
+
+            def do_POST(self):
+                self.serve('POST')
+
+        return Handler
+
+
+def synthetic_apk(app, version, size, seed=0):
+    """Bytes of an APK of app with a binary manifest and size bytes of incompressible payload"""
+    version_code = int(version) if str(version).isdigit() else 1
+    manifest = axml.build([('manifest', {'package': app, 'versionCode': version_code}, 0),
+                           ('uses-permission', {'name': 'android.permission.INTERNET'}, 1)])
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as z:
+        z.writestr('AndroidManifest.xml', manifest)
+        z.writestr('assets/payload.bin', random.Random('{}/{}/{}'.format(app, version, seed)).randbytes(size))
+    return buffer.getvalue()
+
+
+class StorageServer:
+    """Storage server serving a synthetic APK for every (app, version), with Range support. A share
+    unavailable_rate of the APKs is answered with the null sentinel, every request waits latency seconds"""
+    def __init__(self, host='127.0.0.1', port=0, apk_size=1024 * 1024, latency=0, unavailable_rate=0, seed=None):
+        self.apk_size = apk_size
+        self.latency = latency
+        self.unavailable_rate = unavailable_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.apks = {}  # (app, version) -> bytes, None when unavailable
+        self.requests = []
+        self.httpd = http.server.ThreadingHTTPServer((host, port), self.handler())
+        self.httpd.daemon_threads = True
+        self.host, self.port = self.httpd.server_address[:2]
+
+    def start(self):
+        th = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        th.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def apk(self, app, version):
+        with self.lock:
+            if (app, version) not in self.apks:
+                available = self.random.random() >= self.unavailable_rate
+                self.apks[(app, version)] = synthetic_apk(app, version, self.apk_size) if available else None
+            return self.apks[(app, version)]
+
+    def handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body go out in separate writes, delayed acks would add 40 ms to every answer
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def send(self, status, data, headers=()):
+                self.send_response(status)
+                for header in headers:
+                    self.send_header(*header)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                server.requests.append(self.path)
+                time.sleep(server.latency)
+                parts = urllib.parse.urlsplit(self.path).path.strip('/').split('/')
+                if len(parts) == 4 and parts[:2] == ['app', 'apk']:
+                    data = server.apk(parts[2], parts[3])
+                    if data is None:
+                        return self.send(200, b'null\n')
+                    match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+                    if match is None:
+                        return self.send(200, data)
+                    start = int(match.group(1))
+                    if start >= len(data):
+                        return self.send(416, b'', [('Content-Range', 'bytes */{}'.format(len(data)))])
+                    return self.send(206, data[start:], [('Content-Range', 'bytes {}-{}/{}'.format(
+                        start, len(data) - 1, len(data)))])
+                if len(parts) == 3 and parts[:2] == ['app', 'versioncode']:
+                    return self.send(200, b'[1]')
+                self.send(404, b'')
+
+        return Handler
+
+
+FAKE_ADB = '''#!/bin/sh
+# adb stand-in: every device is connected and booted, every command succeeds
+case "$*" in
+    *devices*) printf 'List of devices attached\n' ;;
+    *boot_completed*) echo 1 ;;
+esac
+exit 0
+'''
+
+FAKE_AAPT = '''#!/bin/sh
+# aapt stand-in: the package is the name of the APK file
+echo "package: name='$(basename "$3" .apk)' versionCode='1'"
+exit 0
+'''
+
+
+def write_fake_sdk(folder):
+    """Writes adb and aapt stand-ins into folder. Returns their paths"""
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for (name, script) in (('adb', FAKE_ADB), ('aapt', FAKE_AAPT)):
+        path = os.path.join(folder, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        paths.append(path)
+    return tuple(paths)
+
+
+class FakeDevice:
+    """Device behind the fake adb server. Shell commands are answered by shell(command) -> (exit code, output),
+    which echoes the command unless replaced; output may also be an iterable of chunks sent as they are produced,
+    until the client closes the connection. Files pushed and pulled live in the files dict"""
+    def __init__(self, serial, shell_v2=True):
+        self.serial = serial
+        self.features = 'shell_v2,cmd' if shell_v2 else 'cmd'
+        self.files = {}
+        self.commands = []
+        self.reboots = 0
+
+    def shell(self, command):
+        return 0, command.encode('utf-8') + b'\n'
+
+
+class AdbServer:
+    def __init__(self, devices, host='127.0.0.1', port=0):
+        self.devices = {d.serial: d for d in devices}
+        self.connections = 0
+        self.server = socketserver.ThreadingTCPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address[:2]
+
+    def start(self):
+        th = threading.Thread(target=self.server.serve_forever, daemon=True)
+        th.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handler(self):
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def recv(self, n):
+                data = b''
+                while len(data) < n:
+                    chunk = self.request.recv(n - len(data))
+                    if not chunk:
+                        raise EOFError()
+                    data += chunk
+                return data
+
+            def okay(self, payload=None):
+                self.request.sendall(b'OKAY' + (b'%04x' % len(payload) + payload if payload is not None else b''))
+
+            def fail(self, message):
+                message = message.encode('utf-8')
+                self.request.sendall(b'FAIL' + b'%04x' % len(message) + message)
+
+            def handle(self):
+                server.connections += 1
+                device = None
+                try:
+                    while True:
+                        request = self.recv(int(self.recv(4), 16)).decode('utf-8')
+                        if request == 'host:devices':
+                            listing = ''.join('{}\tdevice\n'.format(serial) for serial in server.devices)
+                            return self.okay(listing.encode('utf-8'))
+                        if request.startswith('host-serial:') and request.endswith(':features'):
+                            serial = request[len('host-serial:'):-len(':features')]
+                            if serial not in server.devices:
+                                return self.fail("device '{}' not found".format(serial))
+                            return self.okay(server.devices[serial].features.encode('utf-8'))
+                        if request.startswith('host:transport:'):
+                            device = server.devices.get(request[len('host:transport:'):])
+                            if device is None:
+                                return self.fail("device '{}' not found".format(request[len('host:transport:'):]))
+                            self.okay()
+                            continue
+                        if device is None:
+                            return self.fail('unknown host service')
+                        if request.startswith('shell,v2,raw:') and 'shell_v2' in device.features:
+                            self.okay()
+                            device.commands.append(request[len('shell,v2,raw:'):])
+                            (exit_code, output) = device.shell(request[len('shell,v2,raw:'):])
+                            for chunk in [output] if isinstance(output, bytes) else output:
+                                self.request.sendall(struct.pack('<BI', 1, len(chunk)) + chunk)
+                            self.request.sendall(struct.pack('<BI', 3, 1) + bytes([exit_code]))
+                            return
+                        if request.startswith('shell:') or request.startswith('exec:'):
+                            self.okay()
+                            device.commands.append(request.split(':', 1)[1])
+                            output = device.shell(request.split(':', 1)[1])[1]
+                            for chunk in [output] if isinstance(output, bytes) else output:
+                                self.request.sendall(chunk)
+                            return
+                        if request.startswith('reboot:'):
+                            device.reboots += 1
+                            return self.okay()
+                        if request == 'sync:':
+                            self.okay()
+                            return self.sync(device)
+                        return self.fail('unknown service {}'.format(request))
+                except (EOFError, OSError):  # client gone
+                    return
+
+            def sync(self, device):
+                while True:
+                    (request_id, length) = struct.unpack('<4sI', self.recv(8))
+                    if request_id == b'QUIT':
+                        return
+                    path = self.recv(length).decode('utf-8')
+                    if request_id == b'SEND':
+                        path = path.rsplit(',', 1)[0]
+                        data = b''
+                        while True:
+                            (request_id, length) = struct.unpack('<4sI', self.recv(8))
+                            if request_id == b'DONE':
+                                break
+                            data += self.recv(length)
+                        device.files[path] = data
+                        self.request.sendall(b'OKAY' + struct.pack('<I', 0))
+                    elif request_id == b'RECV':
+                        if path not in device.files:
+                            message = b'No such file or directory'
+                            self.request.sendall(b'FAIL' + struct.pack('<I', len(message)) + message)
+                            return
+                        data = device.files[path]
+                        for i in range(0, len(data), 65536):
+                            self.request.sendall(b'DATA' + struct.pack('<I', len(data[i:i + 65536])) +
+                                                 data[i:i + 65536])
+                        self.request.sendall(b'DONE' + struct.pack('<I', 0))
+
+        return Handler
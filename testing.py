@@ -1,25 +1,11 @@
-import configparser
-
 import traffico as tr
+import httppool
+import settings
+import metrics
 import time
 import os
 import sys
-
-BASE_PATH = None
-TESTING_SERVER_IP = None
-TESTING_SERVER_PORT = None
-TESTING_DEVICE = None
-PHASE_ONE_TIMEOUT = 10
-PERMISSIONS = True
-REBOOT = False
-
-PHASE_TWO_TIMEOUT = 10
-MONKEY = True
-logger = None
-RESULTS_OUTPUT = None
-
-TESTING_LABEL = None
-TIMEOUT_BEFORE_SANITIZATION = 20
+import threading
 
 SUCCESS = 0
 SOFT_FAIL = 1
@@ -28,147 +14,260 @@ DEVICE_NOT_CONNECTED_ERROR = 10
 APP_INSTALL_FAIL_ERROR = 20
 MITM_PROXY_START_ERROR = 30
 SERVER_CONNECTION_ERROR = 40
+PHASE_CANCELLED_ERROR = 50
+CONFIG_ERROR = 60
+UPLOAD_ERROR = 70
 
 CONTAINER = 'traffic'
 
-def parse_config(config_file):
-    global BASE_PATH, TESTING_SERVER_IP, TESTING_SERVER_PORT, \
-        TESTING_DEVICE, RESULTS_OUTPUT, PHASE_ONE_TIMEOUT, PHASE_TWO_TIMEOUT, PERMISSIONS, REBOOT, \
-        MONKEY, TESTING_LABEL
 
-    config = configparser.ConfigParser()
-    config.read(config_file)
+class TestSession:
+    """Tests apps on one device through its testing server. Every run takes the shared settings as they are
+    when it starts, so sessions of several devices can run side by side in the same process and a reloaded
+    configuration applies from the next app on"""
+    def __init__(self, logger, device=None, port=None):
+        self.logger = logger
+        # in device-pool mode the consumer picks the terminal and its testing server port
+        self.terminal = device
+        self.terminal_port = port
+        # sanitization of the last app, when it runs in the background
+        self.sanitizer = None
+        self.configure(settings.current())
 
-    BASE_PATH = config['base']['base_path']
-    RESULTS_OUTPUT = config['base']['results_output']
+    def configure(self, config):
+        self.results_output = config.base.results_output
+        self.server_ip = config.testing_env.server_ip
+        self.device = self.terminal if self.terminal is not None else config.testing_env.terminal
+        self.port = self.terminal_port if self.terminal_port is not None else config.testing_env.server_port
+        self.phase_one_timeout = config.testing.phase_one_timeout
+        self.phase_two_timeout = config.testing.phase_two_timeout
+        self.permissions = config.testing.permissions
+        self.reboot = config.testing.reboot
+        self.monkey = config.testing.monkey
+        self.label = config.testing.label
+        self.async_phases = config.testing.async_phases
+        self.phase_grace = config.testing.phase_grace
+        self.sanitize_deadline = config.testing.sanitize_deadline
+        self.overlap_sanitize = config.testing.overlap_sanitize
+        self.combined_setup = config.testing.combined_setup
+        self.result_compression = config.results.compression
+        # screenshots and raw captures fetched after every app; their pool is sized by the first session using it
+        self.artifacts = config.artifacts.names
+        self.artifact_workers = config.artifacts.workers
 
-    TESTING_SERVER_IP = config['testing_env']['testing_server_ip']
-    TESTING_SERVER_PORT = config['testing_env']['testing_server_port']
-    TESTING_DEVICE = config['testing_env']['testing_terminal']
-    PHASE_ONE_TIMEOUT = int(config['testing']['phase-one_timeout'])
-    PHASE_TWO_TIMEOUT = int(config['testing']['phase-two_timeout'])
-    PERMISSIONS = True if config['testing']['permissions'] == "True" else False
-    REBOOT = True if config['testing']['reboot'] == "True" else False
-    MONKEY = True if config['testing']['monkey'] == "True" else False
-    TESTING_LABEL = config['testing']['testing_label']
+    def sanitize(self, t, app, version):
+        """Waits for the testing terminal to be ready, up to sanitize_deadline seconds, then sanitizes it"""
+        (ready, waited) = t.waitReady(self.sanitize_deadline)
+        metrics.observe_stage('sanitize_wait', waited, self.device, metrics.SUCCESS if ready else metrics.TIMEOUT)
+        (success, result) = self.timed('sanitize', t.sanitize)
+        extra = {'apk': app, 'version': version, 'testing_label': self.label, 'container': CONTAINER,
+                 'device': self.device, 'sanitize_ready': ready, 'sanitize_wait_secs': round(waited, 2)}
+        if not success:
+            extra['exception_message'] = result
+            self.logger.error('Testing terminal sanitization failed', extra=extra)
+        else:
+            self.logger.debug('Testing terminal has been sanitized', extra=extra)
 
+    def fetch_artifacts(self, t, data_dir, app, version):
+        """Downloads the screenshots and raw captures enabled, side by side, into the results folder"""
+        started = time.time()
+        fetched = t.artifacts(data_dir, self.artifacts, self.artifact_workers)
+        failed = {name: result for name, (success, result) in fetched.items() if not success}
+        metrics.observe_stage('artifacts', time.time() - started, self.device,
+                              metrics.FAILURE if failed else metrics.SUCCESS)
+        extra = {'apk': app, 'version': version, 'testing_label': self.label, 'container': CONTAINER,
+                 'device': self.device, 'artifacts_secs': round(time.time() - started, 2),
+                 'artifacts_bytes': sum(result['size'] for (success, result) in fetched.values() if success)}
+        if failed:
+            extra['exception_message'] = '; '.join('{}: {}'.format(k, v) for k, v in sorted(failed.items()))
+            self.logger.error('Artifacts retrieval failed', extra=extra)
+        else:
+            self.logger.debug('Artifacts have been stored', extra=extra)
 
-def traffic_testing(apk, version, app, logger_in):
-    global RESULTS_OUTPUT, logger
-    logger = logger_in
-    cwd = os.path.dirname(os.path.abspath(sys.argv[0]))
-    parse_config(os.path.join(cwd, 'executor.config'))
-    if not os.path.isfile(apk):
-        logger.error('APK traffic analysis failed', extra={'reason': 'Invalid APK path', 'apk': app, 'version': version, 'container': CONTAINER})
-        return HARD_FAIL
-    # data_dir = os.path.join(RESULTS_OUTPUT, app, version)
-    # if not os.path.isdir(data_dir):
-    #     os.makedirs(data_dir)
-    # data_dir = os.path.join(data_dir, 'testing-%s' % TESTING_LABEL)
-    # if not os.path.isdir(data_dir):
-    #     os.makedirs(data_dir)
-
-    t = tr.Traffic(TESTING_SERVER_IP, TESTING_SERVER_PORT, TESTING_DEVICE, apk, TESTING_LABEL, version, app)
-    (success, result) = t.configure()
-    if not success:
-        logger.error('APK traffic analysis failed', extra={'reason': 'App to be tested and testing terminal setup failed',
-                                                             'apk': app, 'version': version,
-                                                             'testing_label': TESTING_LABEL,
-                                                             'container': CONTAINER,
-                                                             'exception_message': result,
-                                                             'device': TESTING_DEVICE})
-        return HARD_FAIL
-    else:
-        logger.debug('App to be tested and testing terminal have been setup', extra={'apk': app, 'version': version,
-                                                           'testing_label': TESTING_LABEL,
-                                                           'container': CONTAINER,
-                                                           'device': TESTING_DEVICE})
-    (success, result) = t.upload()
-    if not success:
-        logger.error('APK traffic analysis failed', extra={'reason': 'Application upload failed',
-                                                           'apk': app, 'version': version, 'container': CONTAINER,
-                                                           'testing_label': TESTING_LABEL,'exception_message': result,
-                                                           'device': TESTING_DEVICE})
-        return HARD_FAIL
-    else:
-        logger.debug('App to be evaluated has been uploaded', extra={'apk': app, 'version': version,
-                                                                                    'testing_label': TESTING_LABEL,
-                                                                                    'container': CONTAINER,
-                                                                                    'device': TESTING_DEVICE})
-    (success, result, code) = t.phaseOne(timeout=PHASE_ONE_TIMEOUT, permissions=PERMISSIONS, reboot=REBOOT)
-    if not success:
-        if code == DEVICE_NOT_CONNECTED_ERROR:
-            reason = 'Device is not connected'
-        elif code == MITM_PROXY_START_ERROR:
-            reason = 'Mitm proxy start failed'
-        elif code == APP_INSTALL_FAIL_ERROR:
-            reason = 'App installation failed'
-        elif code == SERVER_CONNECTION_ERROR:
-            reason = 'Connection to REST server failed'
+    def timed(self, stage, function, *args, **kwargs):
+        """Calls a Traffic request, timed as a pipeline stage with the outcome of its Ok"""
+        started = time.time()
+        result = function(*args, **kwargs)
+        metrics.observe_stage(stage, time.time() - started, self.device,
+                              metrics.SUCCESS if result[0] else metrics.FAILURE)
+        return result
+
+    def setup(self, t, app, version):
+        """Configures the testing terminal, uploads the APK and runs phase one: in a single request to start it
+        when combined_setup is set and the testing server supports it. Returns (exit code when the app cannot be
+        tested, result of phase one)"""
+        if self.combined_setup:
+            (success, result, code) = self.timed('setup', t.setup, self.phase_one_timeout,
+                                                 permissions=self.permissions, reboot=self.reboot)
+            extra = {'apk': app, 'version': version, 'testing_label': self.label, 'container': CONTAINER,
+                     'device': self.device}
+            if success:
+                self.logger.debug('App to be tested has been set up and phase one started',
+                                  extra=dict(extra, apk_uploaded=result['uploaded']))
+                return None, self.timed('phase_one', t.waitJob, result['job'],
+                                        deadline=self.phase_one_timeout + self.phase_grace)
+            if code in (CONFIG_ERROR, UPLOAD_ERROR):
+                reason = 'App to be tested and testing terminal setup failed' if code == CONFIG_ERROR \
+                    else 'Application upload failed'
+                self.logger.error('APK traffic analysis failed', extra=dict(extra, reason=reason, exitcode=code,
+                                                                            exception_message=result))
+                return HARD_FAIL, None
+            if code != tr.SETUP_UNSUPPORTED:  # failed to start phase one
+                return None, (success, result, code)
+        (success, result) = self.timed('configure', t.configure)
+        if not success:
+            self.logger.error('APK traffic analysis failed', extra={'reason': 'App to be tested and testing terminal setup failed',
+                                                                 'apk': app, 'version': version,
+                                                                 'testing_label': self.label,
+                                                                 'container': CONTAINER,
+                                                                 'exception_message': result,
+                                                                 'device': self.device})
+            return HARD_FAIL, None
+        else:
+            self.logger.debug('App to be tested and testing terminal have been setup', extra={'apk': app, 'version': version,
+                                                               'testing_label': self.label,
+                                                               'container': CONTAINER,
+                                                               'device': self.device})
+        (success, result) = self.timed('upload', t.upload)
+        if not success:
+            self.logger.error('APK traffic analysis failed', extra={'reason': 'Application upload failed',
+                                                               'apk': app, 'version': version, 'container': CONTAINER,
+                                                               'testing_label': self.label,'exception_message': result,
+                                                               'device': self.device})
+            return HARD_FAIL, None
         else:
-            reason = 'Unknown failure during idle traffic capture'
-        logger.error('APK traffic analysis failed', extra={'reason': reason,
-                                                             'apk': app, 'version': version, 'container': CONTAINER,
-                                                             'testing_label': TESTING_LABEL, 'exception_message': result,
-                                                             'exitcode': code, 'device': TESTING_DEVICE})
-        if code == DEVICE_NOT_CONNECTED_ERROR or code == MITM_PROXY_START_ERROR or code == SERVER_CONNECTION_ERROR:
+            self.logger.debug('App to be evaluated has been uploaded', extra={'apk': app, 'version': version,
+                                                                                        'testing_label': self.label,
+                                                                                        'container': CONTAINER,
+                                                                                        'device': self.device})
+        return None, self.timed('phase_one', t.phaseOne, timeout=self.phase_one_timeout, permissions=self.permissions,
+                                reboot=self.reboot, deadline=self.phase_one_timeout + self.phase_grace)
+
+    def wait_sanitized(self):
+        """Returns once the background sanitization of the last app, if any, is over"""
+        if self.sanitizer is not None:
+            self.sanitizer.join()
+            self.sanitizer = None
+
+    def run(self, apk, version, app):
+        self.wait_sanitized()
+        self.configure(settings.current())
+        if not os.path.isfile(apk):
+            self.logger.error('APK traffic analysis failed', extra={'reason': 'Invalid APK path', 'apk': app, 'version': version, 'container': CONTAINER})
             return HARD_FAIL
+        data_dir = os.path.join(self.results_output, app, version, 'testing-%s' % self.label)
+
+        t = tr.Traffic(self.server_ip, self.port, self.device, apk, self.label, version, app, jobs=self.async_phases)
+        (exit_code, phase_one) = self.setup(t, app, version)
+        if exit_code is not None:
+            return exit_code
+        (success, result, code) = phase_one
+        if not success:
+            if code == DEVICE_NOT_CONNECTED_ERROR:
+                reason = 'Device is not connected'
+            elif code == MITM_PROXY_START_ERROR:
+                reason = 'Mitm proxy start failed'
+            elif code == APP_INSTALL_FAIL_ERROR:
+                reason = 'App installation failed'
+            elif code == SERVER_CONNECTION_ERROR:
+                reason = 'Connection to REST server failed'
+            elif code == PHASE_CANCELLED_ERROR:
+                reason = 'Idle phase cancelled after its deadline'
+            else:
+                reason = 'Unknown failure during idle traffic capture'
+            self.logger.error('APK traffic analysis failed', extra={'reason': reason,
+                                                                 'apk': app, 'version': version, 'container': CONTAINER,
+                                                                 'testing_label': self.label, 'exception_message': result,
+                                                                 'exitcode': code, 'device': self.device})
+            if code == DEVICE_NOT_CONNECTED_ERROR or code == MITM_PROXY_START_ERROR or code == SERVER_CONNECTION_ERROR:
+                return HARD_FAIL
+            else:
+                return SOFT_FAIL
+        else:
+            self.logger.debug('Idle phase traffic has been captured', extra={'apk': app, 'version': version,
+                                                                         'testing_label': self.label,
+                                                                         'container': CONTAINER,
+                                                                         'device': self.device})
+        (success, result, code) = self.timed('phase_two', t.phaseTwo, timeout=self.phase_two_timeout,
+                                                 monkey=self.monkey, deadline=self.phase_two_timeout + self.phase_grace)
+        if not success:
+            self.logger.error('Second phase traffic capture failed', extra={'reason': 'REST-Phase-Two request failed',
+                                                                 'apk': app, 'version': version, 'container': CONTAINER,
+                                                                 'testing_label': self.label, 'exception_message': result,
+                                                                 'exitcode': code, 'device': self.device})
         else:
-            return SOFT_FAIL
-    else:
-        logger.debug('Idle phase traffic has been captured', extra={'apk': app, 'version': version,
-                                                                     'testing_label': TESTING_LABEL,
-                                                                     'container': CONTAINER,
-                                                                     'device': TESTING_DEVICE})
-    (success, result, code) = t.phaseTwo(timeout=PHASE_TWO_TIMEOUT, monkey=MONKEY)
-    if not success:
-        logger.error('Second phase traffic capture failed', extra={'reason': 'REST-Phase-Two request failed',
-                                                             'apk': app, 'version': version, 'container': CONTAINER,
-                                                             'testing_label': TESTING_LABEL, 'exception_message': result,
-                                                             'exitcode': code, 'device': TESTING_DEVICE})
-    else:
-        logger.debug('Second phase traffic has been captured', extra={'apk': app, 'version': version,
-                                                                     'testing_label': TESTING_LABEL,
-                                                                     'container': CONTAINER,
-                                                                     'device': TESTING_DEVICE})
-    (success, result) = t.analysis()
-    if not success:
-        logger.error('APK traffic analysis failed', extra={'reason': 'The analysis of captured traffic failed',
-                                                            'apk': app, 'version': version, 'container': CONTAINER,
-                                                            'testing_label': TESTING_LABEL, 'exception_message': result,
-                                                            'device': TESTING_DEVICE})
-    else:
-        logger.debug('Captured traffic has been analysed', extra={'apk': app, 'version': version,
-                                                                     'testing_label': TESTING_LABEL,
-                                                                     'container': CONTAINER,
-                                                                     'device': TESTING_DEVICE})
-    (success, result) = t.result()
-    if not success:
-        logger.error('Reading results failed', extra={'reason': 'REST-Reading-results request failed',
-                                                                   'apk': app, 'version': version,
-                                                                   'container': CONTAINER,
-                                                                   'testing_label': TESTING_LABEL,
-                                                                   'exception_message': result,
-                                                                   'device': TESTING_DEVICE})
-    else:
-        print(result)
-    '''(success, result) = t.screenshotPhaseOne(RESULTS_OUTPUT)
-    if not success:
-        logger.error('Error Reading screenshots Phase One : {} -> {}'.format(name, result))
-    (success, result) = t.screenshotPhaseTwo(RESULTS_OUTPUT)
-    if not success:
-        logger.error('Error Reading screenshots Phase Two : {} -> {}'.format(name, result))'''
-    # (success, result) = t.rawPhaseOne(data_dir)
-    # if not success:
-    #     logger.error('Error Reading Raw Data Phase One : {} -> {}'.format(name, result))
-    # (success, result) = t.rawPhaseTwo(data_dir)
-    # if not success:
-    #     logger.error('Error Reading Raw Data Phase Two : {} -> {}'.format(name, result))
-    time.sleep(TIMEOUT_BEFORE_SANITIZATION)
-    t.sanitize()
-    logger.info('APK traffic analysis has been completed', extra={'apk': app, 'version': version, 'testing_label': TESTING_LABEL,
-                                              'container': CONTAINER, 'device': TESTING_DEVICE})
-    return SUCCESS
+            self.logger.debug('Second phase traffic has been captured', extra={'apk': app, 'version': version,
+                                                                         'testing_label': self.label,
+                                                                         'container': CONTAINER,
+                                                                         'device': self.device})
+        (success, result) = self.timed('analysis', t.analysis)
+        if not success:
+            self.logger.error('APK traffic analysis failed', extra={'reason': 'The analysis of captured traffic failed',
+                                                                'apk': app, 'version': version, 'container': CONTAINER,
+                                                                'testing_label': self.label, 'exception_message': result,
+                                                                'device': self.device})
+        else:
+            self.logger.debug('Captured traffic has been analysed', extra={'apk': app, 'version': version,
+                                                                         'testing_label': self.label,
+                                                                         'container': CONTAINER,
+                                                                         'device': self.device})
+        try:
+            os.makedirs(data_dir, exist_ok=True)
+            (success, result) = self.timed('result', t.result, data_dir, self.result_compression)
+        except OSError as e:
+            (success, result) = (False, str(e))
+        if not success:
+            self.logger.error('Reading results failed', extra={'reason': 'REST-Reading-results request failed',
+                                                                       'apk': app, 'version': version,
+                                                                       'container': CONTAINER,
+                                                                       'testing_label': self.label,
+                                                                       'exception_message': result,
+                                                                       'device': self.device})
+        else:
+            self.logger.debug('Results have been stored', extra={'apk': app, 'version': version,
+                                                                 'testing_label': self.label, 'container': CONTAINER,
+                                                                 'device': self.device, 'result_path': result['path'],
+                                                                 'result_size': result['size'],
+                                                                 'result_stored': result['stored'],
+                                                                 'result_sha256': result['sha256'],
+                                                                 'result_records': result['records']})
+        if self.artifacts:
+            self.fetch_artifacts(t, data_dir, app, version)
+        if self.overlap_sanitize:
+            # the app is reported done while the terminal is sanitized, so its ack and the download of the next
+            # APK overlap with the sanitization; the next run on this device waits for it
+            self.sanitizer = threading.Thread(target=self.sanitize, args=(t, app, version), daemon=True)
+            self.sanitizer.start()
+        else:
+            self.sanitize(t, app, version)
+        self.logger.info('APK traffic analysis has been completed', extra={'apk': app, 'version': version, 'testing_label': self.label,
+                                                  'container': CONTAINER, 'device': self.device,
+                                                  'http_connections': httppool.stats()})
+        return SUCCESS
+
+
+def config_path():
+    cwd = os.path.dirname(os.path.abspath(sys.argv[0]))
+    return os.path.join(cwd, 'executor.config')
+
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def session(logger_in, device=None, port=None):
+    """TestSession of a device (the configured terminal by default), created the first time it is asked for"""
+    with sessions_lock:
+        if (device, port) not in sessions:
+            if not settings.loaded():
+                settings.init(config_path())
+            sessions[(device, port)] = TestSession(logger_in, device, port)
+        sessions[(device, port)].logger = logger_in
+        return sessions[(device, port)]
+
+
+def traffic_testing(apk, version, app, logger_in, device=None, port=None):
+    return session(logger_in, device, port).run(apk, version, app)
 
 # test
 # traffic_testing('/privapp/apk/com.netflix.Speedtest.apk')
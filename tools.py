@@ -2,18 +2,32 @@
 #                          ADB and AAPT WRAPPERS                         #
 ##########################################################################
 import os
-import configparser
-import multiprocessing
 import time
 from datetime import datetime, timedelta
 import subprocess
 import random
+import queue
+import re
+import struct
 import sys
+import zlib
+import cmdengine
+import adbclient
+import axml
+import threading
+import settings
+import metrics
 
 adb = None
 aapt = None
+# host protocol client, used instead of the adb binary when the sdk section sets ADBServer = host:port
+adb_client = None
 
 device_serial = None
+sdk_applied = None
+
+# every adb command runs on this engine, which reports per-command latency through adb_stats()
+engine = cmdengine.CommandEngine()
 
 
 def log(tag, message):
@@ -23,29 +37,41 @@ def log(tag, message):
     print('(%s) %s -- %s' % (tag, utc_str, message))
 
 
-def parse_config(config_file):
-    assert os.path.isfile(config_file), '%s is not a valid file or path to file' % config_file
+def configure(sdk):
+    """Sets the adb and aapt binaries, and the adb server client, of a settings.Sdk"""
+    assert os.path.isfile(sdk.adb_path), 'adb binary not found in %s' % sdk.adb_path
+    assert os.path.isfile(sdk.aapt_path), 'aapt binary not found in %s' % sdk.aapt_path
 
-    config = configparser.ConfigParser()
-    config.read(config_file)
+    global adb, aapt, adb_client, sdk_applied
+    sdk_applied = sdk
+    adb = sdk.adb_path
+    aapt = sdk.aapt_path
+    if sdk.adb_server is not None:
+        (host, port) = sdk.adb_server.rsplit(':', 1)
+        if adb_client is None or (adb_client.host, adb_client.port) != (host, int(port)):
+            adb_client = adbclient.AdbClient(host, int(port))
+    else:
+        adb_client = None
 
-    assert 'sdk' in config.sections(), 'Config file %s does not contain an sdk section' % config_file
-    assert 'ADBPath' in config['sdk'], 'Config file %s does not have an ADBPath value in the sdk section' % config_file
-    assert 'AAPTPath' in config[
-        'sdk'], 'Config file %s does not have an AAPTPath value in the sdk seciton' % config_file
 
-    adb_path = config['sdk']['ADBPath']
-    aapt_path = config['sdk']['AAPTPath']
+def apply(new_settings):
+    # called on every settings reload, a broken sdk section is reported and the current binaries are kept
+    if new_settings.sdk is not None and new_settings.sdk != sdk_applied:
+        try:
+            configure(new_settings.sdk)
+        except AssertionError as e:
+            log('SDK-ERROR', str(e))
 
-    assert os.path.isfile(adb_path), 'adb binary not found in %s' % adb_path
-    assert os.path.isfile(aapt_path), 'aapt binary not found in %s' % aapt_path
 
-    global adb, aapt
-    adb = adb_path
-    aapt = aapt_path
+settings.on_reload(apply)
+
+
+def parse_config(config_file):
+    configure(settings.load_sdk(config_file))
 
 
 def init(config_file, device=None):
+    """Reads the sdk configuration and sets the device of the module level adb_* functions. Returns its AdbDevice"""
     parse_config(config_file)
 
     global device_serial
@@ -55,6 +81,7 @@ def init(config_file, device=None):
         (success, device_serial) = adb_shell('getprop ro.serialno')
         assert success, 'Unable to get device serial number through adb getprop ro.serialno'
     device_serial = device_serial.lower().strip()
+    return default_device()
 
 
 #########################################################3
@@ -79,18 +106,54 @@ def aapt_call(command, args):
 
 last_badging_apk = None
 last_badging = None
+badging_lock = threading.Lock()
+# persistent apkindex.ApkIndex shared with the caller, metadata is then extracted once per APK content
+apk_index = None
+
+
+def apk_manifest(apk_file):
+    """Manifest record (package, version_code, version_name, permissions, launchable_activity) read in-process
+    from the APK. None when the manifest cannot be decoded, then the aapt_* helpers fall back to aapt"""
+    try:
+        if apk_index is not None:
+            record = apk_index.lookup(apk_file)
+            if record['package'] is None:  # only the aapt badging of this APK is known
+                return None
+            return axml.Manifest(record['package'], record['version_code'], record['version_name'],
+                                 record['permissions'], record['launchable_activity'])
+        return axml.manifest(apk_file)
+    except (axml.ManifestError, OSError) as e:
+        log('AXML-ERROR', str(e))
+        return None
 
 
 def aapt_badging(apk_file):
     global last_badging_apk, last_badging
-    if last_badging_apk is None or apk_file != last_badging_apk:
-        last_badging = aapt_call('d', ['badging', apk_file])
-        last_badging_apk = apk_file
-    return last_badging
+    sha256 = None
+    if apk_index is not None:
+        sha256 = axml.apk_hash(apk_file)
+        record = apk_index.get(sha256)
+        if record is not None and record['badging'] is not None:
+            return record['badging']
+    with badging_lock:
+        if last_badging_apk is not None and apk_file == last_badging_apk:
+            return last_badging
+    badging = aapt_call('d', ['badging', apk_file])
+    with badging_lock:
+        (last_badging_apk, last_badging) = (apk_file, badging)
+    if sha256 is not None and badging is not None:
+        if apk_index.get(sha256) is None:
+            apk_index.put(sha256, size=os.path.getsize(apk_file), badging=badging)
+        else:
+            apk_index.set_badging(sha256, badging)
+    return badging
 
 
 def aapt_permissions(apk_file):
     assert os.path.isfile(apk_file), '%s is not a valid APK path' % apk_file
+    record = apk_manifest(apk_file)
+    if record is not None:
+        return list(record.permissions)
     output = aapt_badging(apk_file)
     permissions = []
     if output is not None:
@@ -102,6 +165,9 @@ def aapt_permissions(apk_file):
 
 def aapt_package(apk_file):
     assert os.path.isfile(apk_file), '%s is not a valid APK path' % apk_file
+    record = apk_manifest(apk_file)
+    if record is not None:
+        return record.package
     output = aapt_badging(apk_file)
     package = None
     if output is not None:
@@ -114,6 +180,9 @@ def aapt_package(apk_file):
 
 def aapt_version_code(apk_file):
     assert os.path.isfile(apk_file), '%s is not a valid APK path' % apk_file
+    record = apk_manifest(apk_file)
+    if record is not None:
+        return record.version_code
     output = aapt_badging(apk_file)
     version_code = None
     if output is not None:
@@ -129,289 +198,702 @@ def aapt_version_code(apk_file):
 #        ADB WRAPPERS     #
 ###########################
 
-def adb_call(command, args=None, ret_queue=None):
-    global adb, device_serial
+NATIVE_COMMANDS = ('devices', 'shell', 'push', 'pull', 'install')
+
+# verbose monkey output lines: an injected event, the app crashed or stopped responding, monkey could not run the
+# app, and the final count of injected events, the only one to match the events monkey injected
+# progress of a run: a switch, or any sending but the moves and the ends of a gesture already counted at its
+# ACTION_DOWN (trackball events, only ever moves, are not counted)
+MONKEY_EVENT = re.compile(r'^:(Switch|Sending (?!\w+ \(ACTION_(?!DOWN\))))')
+MONKEY_CRASH = re.compile(r'^// CRASH')
+MONKEY_ANR = re.compile(r'^// NOT RESPONDING|^ANR in ')
+MONKEY_NOT_FOUND = re.compile(r'^\*\* No activities found to run|^\*\* Monkey aborted|Error: .*not found')
+MONKEY_INJECTED = re.compile(r'^Events injected: (\d+)')
+# what stops a streamed monkey run early
+MONKEY_STOP = ('crash', 'anr', 'not_found')
+
+# screencap pixel formats (android.graphics.PixelFormat) handled, all of 4 bytes per pixel
+PIXEL_RGBA_8888 = 1
+PIXEL_RGBX_8888 = 2
+PIXEL_BGRA_8888 = 5
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_END = b'\x00\x00\x00\x00IEND\xaeB`\x82'  # the empty IEND chunk closing every PNG
+
+
+class AdbDevice:
+    """One device driven through adb. Every device keeps its own serial, adb binary and host protocol client (the
+    module ones when not given), so several devices can be driven from the same process; lock serializes the
+    multi-step sequences (install, reboot, unlock ...) run on the device"""
+    def __init__(self, serial=None, adb_path=None, client=None):
+        self.serial = serial.lower().strip() if serial else None
+        self.adb_path = adb_path
+        self.adb_client = client
+        self.lock = threading.RLock()
+
+    @property
+    def adb(self):
+        return self.adb_path if self.adb_path is not None else adb
+
+    @property
+    def client(self):
+        return self.adb_client if self.adb_client is not None else adb_client
+
+    def command(self, command, args=None):
+        assert self.adb is not None, 'ADB configuration not yet initialized, need to init() first'
+        adb_cmd = [self.adb, '-s', self.serial, command] if self.serial is not None else [self.adb, command]
+        if args is not None:
+            adb_cmd.extend(args)
+        return adb_cmd
+
+    def native(self, command, args, timeout_secs=None):
+        """Runs an adb command through the host protocol client. Returns (success, output, timed_out)"""
+        args = list(args) if args is not None else []
+        started = time.time()
+        success = True
+        timed_out = False
+        try:
+            if command == 'devices':
+                result = self.client.devices()
+            elif command == 'shell':
+                (exit_code, result) = self.client.shell(self.serial, ' '.join(args), timeout_secs=timeout_secs)
+                success = exit_code in (0, None)
+            elif command == 'push':
+                result = '%d bytes pushed' % self.client.push(self.serial, args[0], args[1], timeout_secs=timeout_secs)
+            elif command == 'pull':
+                result = '%d bytes pulled' % self.client.pull(self.serial, args[0], args[1], timeout_secs=timeout_secs)
+            else:  # install [options] apk_file
+                (exit_code, result) = self.client.install(self.serial, args[-1], args[:-1], timeout_secs=timeout_secs)
+                success = exit_code in (0, None) and b'Success' in result
+        except adbclient.AdbTimeout:
+            (success, timed_out, result) = (False, True, None)
+        except (adbclient.AdbError, OSError) as e:
+            (success, result) = (False, str(e))
+        if isinstance(result, bytes):
+            result = result.decode('UTF-8', 'backslashreplace')
+        engine.record(command, time.time() - started, success, timed_out)
+        return success, result, timed_out
+
+    def observe(self, command, latency, success, timed_out=False):
+        outcome = metrics.TIMEOUT if timed_out else metrics.SUCCESS if success else metrics.FAILURE
+        metrics.observe_adb(command, latency, self.serial, outcome)
+
+    def call(self, command, args=None):
+        if self.client is not None and command in NATIVE_COMMANDS:
+            log('ADB', '%s %s' % (command, args))
+            started = time.time()
+            (success, result, timed_out) = self.native(command, args)
+            self.observe(command, time.time() - started, success, timed_out)
+            return success, result
+        adb_cmd = self.command(command, args)
+        log('ADB', str(adb_cmd))
+        cmd = engine.run(adb_cmd, tag=command)
+        self.observe(command, cmd.latency, cmd.success, cmd.timed_out)
+        return cmd.success, cmd.text()
+
+    def call_timeout(self, command, args, timeout_secs=90, quit_on_fail=False):
+        log('ADB', 'Starting command "%s" with timeout %d' % (command, timeout_secs))
+        started = time.time()
+        if self.client is not None and command in NATIVE_COMMANDS:
+            (success, result, timed_out) = self.native(command, args, timeout_secs=timeout_secs)
+        else:
+            cmd = engine.run(self.command(command, args), timeout_secs=timeout_secs, tag=command)
+            (success, result, timed_out) = (cmd.success, cmd.text(), cmd.timed_out)
+        if timed_out:
+            log('ADB', 'Command "%s" timed out' % command)
 
-    assert adb is not None, 'ADB configuration not yet initialized, need to init() first'
-    adb_cmd = [adb, '-s', device_serial, command] if device_serial is not None else [adb, command]
-    if args is not None:
-        adb_cmd.extend(args)
-    log('ADB', str(adb_cmd))
-    result = None
-    success = True
-    try:
-        result = subprocess.check_output(adb_cmd, stderr=subprocess.STDOUT).decode('UTF-8', 'backslashreplace')
-    except Exception as e:
-        # print(str(e))
-        result = str(e)  # e.output.decode('UTF-8', 'backslashreplace')
-        success = False
+        self.observe(command, time.time() - started, success, timed_out)
+        log('ADB', 'Command "%s" terminated in %.2fs' % (command, time.time() - started))
 
-    if ret_queue is not None:
-        ret_queue.put('{}:{}'.format(success, result))
+        if timed_out and quit_on_fail:
+            log('CRASH', 'Failed on command "%s", rebooting' % command)
+            sys.exit(1)
 
-    return success, result
+        if not timed_out:
+            return success, result
+        else:
+            return False, None
+
+    def shell(self, args, timeout_secs=10, retry_limit=3):
+        (success, ret) = self.call_timeout('shell', args, timeout_secs=timeout_secs)
+
+        while not success and retry_limit > 0:
+            (success, ret) = self.call_timeout('shell', args, timeout_secs=timeout_secs)
+            retry_limit = retry_limit - 1
+
+        return success, ret
+
+    def shell_batch(self, commands, delays=0, timeout_secs=None, retry_limit=0):
+        """Runs a list of shell commands in a single adb shell session. delays are the seconds slept on the device
+        after each command (a number for all of them or one per command). Returns (success, results), success
+        meaning every command ran, with one {'command', 'output', 'exit_code'} per command; exit_code is None for
+        commands that did not run"""
+        if not isinstance(delays, (list, tuple)):
+            delays = [delays] * len(commands)
+        marker = '__batch_%x__' % random.getrandbits(48)
+        script = []
+        for i, command in enumerate(commands):
+            # every command is followed by a delimiter line carrying its index and exit code
+            script.append("( %s ) ; printf '\\n%s %d %%d\\n' $?" % (command, marker, i))
+            if delays[i] > 0:
+                script.append('sleep %s' % delays[i])
+        if timeout_secs is None:
+            timeout_secs = 10 + 2 * len(commands) + sum(delays)
+        (success, ret) = self.shell([' ; '.join(script)], timeout_secs=timeout_secs, retry_limit=retry_limit)
+
+        results = [{'command': command, 'output': None, 'exit_code': None} for command in commands]
+        if ret is not None:
+            parts = re.split('\r?\n%s (\\d+) (\\d+)\r?\n' % marker, ret)
+            # parts: output of command 0, index, exit code, output of command 1, index, exit code, ...
+            for n in range(0, len(parts) - 2, 3):
+                i = int(parts[n + 1])
+                results[i]['output'] = parts[n]
+                results[i]['exit_code'] = int(parts[n + 2])
+        success = success and all(r['exit_code'] is not None for r in results)
+        return success, results
+
+    def shell_stream(self, args, timeout_secs=None):
+        """Starts a shell command whose output is read as it arrives: lines(stream) iterates it line by line and
+        stream.cancel() ends the command. Returns the stream, with its timed_out flag"""
+        if self.client is not None:
+            return self.client.shell_stream(self.serial, ' '.join(args), timeout_secs=timeout_secs)
+        return engine.submit(self.command('shell', args), timeout_secs=timeout_secs, tag='shell', stream=True)
+
+    def exec_stream(self, args, timeout_secs=None):
+        """Starts a command through exec-out, its binary output read as it arrives (see shell_stream)"""
+        if self.client is not None:
+            return self.client.exec_stream(self.serial, ' '.join(args), timeout_secs=timeout_secs)
+        return engine.submit(self.command('exec-out', args), timeout_secs=timeout_secs, tag='exec-out', stream=True)
+
+    def exec_out(self, args, out_file=None, timeout_secs=10):
+        """Runs a command through exec-out, its output streamed into out_file (through a .part file renamed once
+        complete) or kept in memory. Returns (success, out_file or the output)"""
+        started = time.time()
+        (success, timed_out) = (False, False)
+        try:
+            stream = self.exec_stream(args, timeout_secs=timeout_secs)
+            if out_file is None:
+                result = b''.join(stream.chunks())
+            else:
+                with open(out_file + '.part', 'wb') as f:
+                    for chunk in stream.chunks():
+                        f.write(chunk)
+                result = out_file
+            (success, timed_out) = (stream.success, stream.timed_out)
+            if not success:
+                result = 'exec-out %s failed%s' % (args[0], ' (timed out)' if timed_out else '')
+        except (adbclient.AdbError, OSError) as e:
+            result = str(e)
+        if out_file is not None and os.path.isfile(out_file + '.part'):
+            if success:
+                os.replace(out_file + '.part', out_file)
+            else:
+                os.remove(out_file + '.part')
+        self.observe('exec-out', time.time() - started, success, timed_out)
+        return success, result
+
+    def shutdown(self):
+        self.shell(['reboot', ' -p'])
+
+    def isconnected(self):
+        (success, result) = self.call('devices')
+        if result is not None:
+            device_found = result.lower().find(self.serial) >= 0
+        else:
+            device_found = None
+        return device_found
+
+    def isbooted(self):
+        (success, result) = self.shell(['getprop', ' sys.boot_completed'])
+
+        return success and result.strip() == '1'
+
+    def wait_boot(self, timeout_secs=240):
+        end_time = datetime.now() + timedelta(seconds=timeout_secs)
+
+        log('WAITBOOT', 'Checking if device is booted')
+
+        while (not (self.isconnected() and self.isbooted())):
+            # Re-issue the reboot command if it's taking too long
+            if (datetime.now() > end_time and self.isconnected()):
+                log('REBOOT', 'Retrying reboot after taking longer than %d seconds' % timeout_secs)
+                self.shell(['reboot'])
+                end_time = datetime.now() + timedelta(seconds=timeout_secs)
+
+            time.sleep(2)
+
+        log('WAITBOOT', 'Device is booted')
+
+    def reboot(self, wait=False, unlock=False, password=None):
+        with self.lock:
+            log('REBOOT', 'Reboot device')
+            self.shell(['reboot'])
+
+            if wait:
+                self.wait_boot()
+                if unlock and password is not None:
+                    self.shell_batch(['input touchscreen swipe 930 880 930 380', 'input text {}'.format(password),
+                                      'input tap 855 988'])
+
+    def grant_permission(self, apk_file):
+        with self.lock:
+            assert os.path.isfile(apk_file), '%s is not a valid APK path'
+
+            log('GRANT_PERM', 'Calling aapt on %s' % apk_file)
+            package = aapt_package(apk_file)
+            log('GRANT_PERM', 'Granting all permissions %s' % package)
+            permissions = aapt_permissions(apk_file)
+            (success, results) = self.shell_batch(['pm grant {} {}'.format(package, perm) for perm in permissions])
+            permissions_nogranted = []
+            for perm, result in zip(permissions, results):
+                if result['exit_code'] != 0:
+                    # Ignore error raised by trying to turn on non-toggleable permissions
+                    print(result['output'])
+                    permissions_nogranted.append(perm)
+            return permissions, permissions_nogranted
+
+    def install(self, apk_file, grant_all_perms=False):
+        with self.lock:
+            assert os.path.isfile(apk_file), '%s is not a valid APK path'
+
+            log('INSTALL', 'Calling aapt on %s' % apk_file)
+            package = aapt_package(apk_file)
+            log('INSTALL', 'Installing %s' % package)
+            (success, output) = self.call_timeout('install', ['-r', apk_file], timeout_secs=60)
+            installed = self.package_installed(package)
+            if not installed:
+                if grant_all_perms:
+                    return (False, output, None, None)
+                else:
+                    return (False, output)
+            if installed and grant_all_perms:
+                success = True
+                (permissions, permissions_nogranted) = self.grant_permission(apk_file)
+                return success, output, permissions, permissions_nogranted
+            return success, output
+
+    def install_auto(self, apk_file, grant_all_perms=False, timeout_secs=90, quit_on_fail=False):
+        with self.lock:
+            cmd = engine.submit(self.command('install', ['-r', apk_file]), timeout_secs=timeout_secs, tag='install')
+            log('INSTALL', 'Calling aapt on %s' % apk_file)
+            package = aapt_package(apk_file)
+            log('INSTALL', 'Installing %s with timeout %d' % (package, timeout_secs))
+
+            while not cmd.done.is_set() and not self.package_installed(package):
+                cmd.wait(4)
+                # self.shell(['input tap 391 1960'], retry_limit=0)  # this is for the first phone Xiaomi XYZ
+                self.shell(['input tap 201 1270'], retry_limit=0)  # This is for redmi 7a
+
+            if cmd.timed_out:
+                log('ADB', 'Install "%s" timed out' % package)
+            self.observe('install', cmd.latency, cmd.success, cmd.timed_out)
+            installed = self.package_installed(package)
+            if not installed:
+                if grant_all_perms:
+                    return (False, None, None, None)
+                else:
+                    return (False, None)
+            if installed and grant_all_perms:
+                success = True
+                (permissions, permissions_nogranted) = self.grant_permission(apk_file)
+                return success, None, permissions, permissions_nogranted
+            return not cmd.timed_out, None
+
+    def start_app(self, package):
+        with self.lock:
+            # Always start from the home screen
+            self.shell(['input', 'keyevent', '3'])
+            time.sleep(2)
+            (success, output) = self.shell(['monkey', '-p', package, '-c', 'android.intent.category.LAUNCHER', '1'])
+            return (success, output)
+
+    def package_installed(self, package):
+        (success, output) = self.shell(['pm', 'list packages', package])
+        return success and len(output) > 0
+
+    def clear_screen(self):
+        with self.lock:
+            # Just bang on the "enter" button from the Home Screen a bunch of times
+            self.shell_batch(['input keyevent 3'] + ['input keyevent 66'] * 10 + ['input keyevent 3'],
+                             delays=[2] + [1] * 10 + [2])
+
+    def is_wifi_connected(self, enable_wifi=False):
+        if (enable_wifi):
+            self.shell(['svc wifi enable'])  # Ensure wi-fi is on before checking
+            time.sleep(20)
+
+        (success, result) = self.shell(["dumpsys wifi | grep 'mNetworkInfo' | cut -d ',' -f2 | cut -d '/' -f2"])
+        return success and result.strip() == 'CONNECTED'
+
+    def is_screen_on(self):
+        (success, result) = self.shell(["dumpsys power | grep 'Display Power' | cut -d'=' -f2"])
+        return success and result.strip() == 'ON'
+
+    def screen_turn_on(self):
+        if not self.is_screen_on():
+            self.shell(['input keyevent 26'])
+
+    def screen_turn_off(self):
+        if self.is_screen_on():
+            self.shell(['input keyevent 26'])
+
+    def is_unlocked(self):
+        (success, result) = self.shell(["dumpsys power | grep 'mHoldingDisp' | cut -d'=' -f2"])
+        return success and result.strip() == 'true'
+
+    def unlock(self, password):
+        with self.lock:
+            if not self.is_screen_on():
+                self.screen_turn_on()
+            self.shell_batch(['input touchscreen swipe 930 880 930 380', 'input text {}'.format(password),
+                              'input tap 855 988'])
+
+    def screenshot(self, out_file=None, timeout_secs=10):
+        """PNG of the screen streamed from the device, with no file on the device, into out_file or memory when
+        out_file is None. Returns (success, out_file or the PNG)"""
+        log('SCREENSHOT', 'Screenshot %s' % out_file)
+        (success, result) = self.exec_out(['screencap', '-p'], out_file, timeout_secs=timeout_secs)
+        if success:
+            if out_file is not None:
+                with open(out_file, 'rb') as f:
+                    head = f.read(len(PNG_SIGNATURE))
+                    f.seek(max(0, os.path.getsize(out_file) - len(PNG_END)))
+                    tail = f.read()
+            else:
+                (head, tail) = (result[:len(PNG_SIGNATURE)], result[-len(PNG_END):])
+            if head != PNG_SIGNATURE or tail != PNG_END:
+                if out_file is not None:
+                    os.remove(out_file)
+                return False, 'screencap output is not a complete PNG'
+        return success, result
+
+    def screencap(self, timeout_secs=10):
+        """Raw screen capture, left to the host to encode (see png), which is faster than a PNG encoded on the
+        device. RGBX and BGRA captures are converted. Returns (success, (width, height, RGBA pixels) or message)"""
+        (success, data) = self.exec_out(['screencap'], timeout_secs=timeout_secs)
+        if not success:
+            return False, data
+        if len(data) < 12:
+            return False, 'screencap output too short'
+        (width, height, pixel_format) = struct.unpack('<III', data[:12])
+        if pixel_format not in (PIXEL_RGBA_8888, PIXEL_RGBX_8888, PIXEL_BGRA_8888):
+            return False, 'unsupported pixel format {}'.format(pixel_format)
+        # the header is width, height and pixel format, plus the color space from Android 9 on
+        if len(data) - width * height * 4 not in (12, 16):
+            return False, 'screencap output of unexpected size'
+        pixels = data[len(data) - width * height * 4:]
+        if pixel_format == PIXEL_RGBX_8888:
+            pixels = bytearray(pixels)
+            pixels[3::4] = b'\xff' * (width * height)
+        elif pixel_format == PIXEL_BGRA_8888:
+            pixels = bytearray(pixels)
+            (pixels[0::4], pixels[2::4]) = (pixels[2::4], pixels[0::4])
+        return True, (width, height, bytes(pixels))
+
+    def is_portrait(self):
+        (success, result) = self.shell(['dumpsys input | grep SurfaceOrientation'])
+        return success and result.strip().endswith('0')
+
+    def monkey(self, package, seed=None, delay_ms=1000, event_count=100, pct_trackball=0, pct_nav=0, pct_majornav=0,
+                   pct_syskeys=0, pct_flip=0, pct_anyevent=0, timeout_secs=None, stop_on=MONKEY_STOP):
+        """Runs monkey on package, reading its verbose output as it arrives. The run is stopped as soon as one of
+        stop_on happens: the app crashed, stopped responding (anr) or could not be found. Returns the summary:
+        events injected (as monkey counts them, None when the run ended before its final count), progress (the
+        events seen, as they arrive), events_per_sec, crashes, anrs, not_found, stopped (the reason or None),
+        finished, timed_out, failed (the connection to the device broke before the end) and duration"""
+        seed = seed if seed is not None else random.randrange(999999999999)
+        timeout_secs = timeout_secs if timeout_secs is not None else 30 + event_count * delay_ms / 1000
+
+        log('MONKEY', 'Seed=%d' % seed)
+        log('MONKEY', 'DelayMS=%d' % delay_ms)
+        log('MONKEY', 'EventCount=%d' % event_count)
+
+        monkey_args = 'monkey \
+                       -s %d \
+                       -p %s \
+                       --throttle %s \
+                       --pct-trackball %d \
+                       --pct-nav %d \
+                       --pct-majornav %d \
+                       --pct-syskeys %d \
+                       --pct-flip %d \
+                       --pct-anyevent %d  \
+                       --ignore-crashes --ignore-timeouts --ignore-security-exceptions -v %d' % \
+                      (seed, package, delay_ms, pct_trackball, pct_nav, pct_majornav, pct_syskeys, pct_flip,
+                       pct_anyevent, event_count)
+        summary = {'events': None, 'progress': 0, 'crashes': 0, 'anrs': 0, 'not_found': False, 'stopped': None,
+                   'finished': False}
+        started = time.time()
+        try:
+            stream = self.shell_stream([monkey_args], timeout_secs=timeout_secs)
+        except (adbclient.AdbError, OSError) as e:
+            log('MONKEY', 'Monkey failed to start: %s' % e)
+            stream = None
+        for line in lines(stream) if stream is not None else []:
+            reason = None
+            injected = MONKEY_INJECTED.match(line)
+            if MONKEY_EVENT.match(line):
+                summary['progress'] += 1
+            elif MONKEY_CRASH.match(line):
+                summary['crashes'] += 1
+                reason = 'crash'
+            elif MONKEY_ANR.match(line):
+                summary['anrs'] += 1
+                reason = 'anr'
+            elif MONKEY_NOT_FOUND.search(line):
+                summary['not_found'] = True
+                reason = 'not_found'
+            elif injected:
+                summary['events'] = int(injected.group(1))
+            elif line.startswith('// Monkey finished'):
+                summary['finished'] = True
+            if reason is not None and reason in stop_on:
+                log('MONKEY', 'Stopping monkey on %s: %s' % (reason, line))
+                summary['stopped'] = reason
+                stream.cancel()
+                break
+        summary['duration'] = time.time() - started
+        events = summary['events'] if summary['events'] is not None else summary['progress']
+        summary['events_per_sec'] = round(events / max(summary['duration'], 1e-6), 2)
+        summary['timed_out'] = bool(stream is not None and stream.timed_out)
+        summary['failed'] = stream is None or stream.failed
+        outcome = metrics.TIMEOUT if summary['timed_out'] else \
+            metrics.SUCCESS if summary['stopped'] or (summary['finished'] and not summary['failed']) else \
+            metrics.FAILURE
+        metrics.observe_adb('monkey', summary['duration'], self.serial, outcome)
+        log('MONKEY', 'Monkey summary: %s' % summary)
+        return summary
+
+
+class ScreenCapture:
+    """Periodic screenshots of a device while a phase runs: frames captures interval seconds apart (or spread over
+    duration seconds), taken raw by a capture thread and encoded to PNG and written into folder by another one.
+    A frame that finds the bounded queue of frames to encode full is dropped, so the captures keep their pace
+    and never hold the test up"""
+    def __init__(self, device, folder, frames, interval=None, duration=None, prefix='frame', queue_size=4):
+        self.device = device
+        self.folder = folder
+        self.frames = frames
+        self.interval = interval if interval is not None else duration / frames
+        self.prefix = prefix
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.counters = {'captured': 0, 'dropped': 0, 'failed': 0}
+        self.files = []
+        self.threads = [threading.Thread(target=self._capture, daemon=True),
+                        threading.Thread(target=self._write, daemon=True)]
+
+    def start(self):
+        os.makedirs(self.folder, exist_ok=True)
+        for th in self.threads:
+            th.start()
+        return self
+
+    def wait(self):
+        """Returns the summary once every frame is taken and written"""
+        for th in self.threads:
+            th.join()
+        with self.lock:
+            return dict(self.counters, written=len(self.files), files=list(self.files))
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stop(self):
+        """Ends the capture early, the frames taken are still written. Returns the summary"""
+        self.stopping.set()
+        return self.wait()
+
+    def _capture(self):
+        started = time.time()
+        for n in range(self.frames):
+            if self.stopping.wait(max(0, started + n * self.interval - time.time())):
+                break
+            (success, result) = self.device.screencap()
+            if not success:
+                self.count('failed')
+                log('SCREENSHOT', 'Frame %d failed: %s' % (n, result))
+                continue
+            try:
+                self.pending.put_nowait((n, result))
+                self.count('captured')
+            except queue.Full:
+                self.count('dropped')
+        self.pending.put(None)
+
+    def _write(self):
+        # keeps draining the queue whatever happens to a frame, the capture thread ends on a blocking put
+        while True:
+            frame = self.pending.get()
+            if frame is None:
+                return
+            (n, (width, height, pixels)) = frame
+            path = os.path.join(self.folder, '%s-%03d.png' % (self.prefix, n))
+            try:
+                with open(path + '.part', 'wb') as f:
+                    f.write(png(width, height, pixels))
+                os.replace(path + '.part', path)
+            except OSError as e:
+                self.count('failed')
+                log('SCREENSHOT', 'Frame %d not written: %s' % (n, e))
+                continue
+            with self.lock:
+                self.files.append(path)
+
+
+def png(width, height, pixels, level=6):
+    """PNG of RGBA pixels"""
+    stride = width * 4
+    rows = b''.join(b'\x00' + pixels[y * stride:(y + 1) * stride] for y in range(height))
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    return PNG_SIGNATURE + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(rows, level)) + chunk(b'IEND', b'')
+
+
+def lines(stream):
+    """Lines of a streamed shell command as they arrive"""
+    pending = b''
+    for chunk in stream.chunks():
+        pending += chunk
+        *complete, pending = pending.split(b'\n')
+        for line in complete:
+            yield line.decode('UTF-8', 'backslashreplace').rstrip('\r')
+    if pending:
+        yield pending.decode('UTF-8', 'backslashreplace').rstrip('\r')
+
+
+devices = {}
+devices_lock = threading.Lock()
+
+
+def device(serial, adb_path=None, client=None):
+    """AdbDevice of a serial, created the first time it is asked for"""
+    serial = serial.lower().strip()
+    with devices_lock:
+        if serial not in devices:
+            devices[serial] = AdbDevice(serial, adb_path, client)
+        return devices[serial]
+
+
+def default_device():
+    """Device of the module level adb_* functions, the one given to init()"""
+    if device_serial is None:
+        return AdbDevice()
+    return device(device_serial)
+
+
+def adb_command(command, args=None):
+    return default_device().command(command, args)
+
+
+def adb_native(command, args, timeout_secs=None):
+    return default_device().native(command, args, timeout_secs)
+
+
+def adb_call(command, args=None):
+    return default_device().call(command, args)
 
 
 def adb_call_timeout(command, args, timeout_secs=90, quit_on_fail=False):
-    ret = multiprocessing.Queue()
-    proc = multiprocessing.Process(target=adb_call, args=(command, args), kwargs={'ret_queue': ret})
-    log('ADB', 'Starting command "%s" with timeout %d' % (command, timeout_secs))
-    proc.start()
-
-    end_time = datetime.now() + timedelta(seconds=timeout_secs)
-    success = True
-    while proc.is_alive():
-        time.sleep(2)
-        if datetime.now() > end_time:
-            log('ADB', 'Command "%s" timed out' % command)
+    return default_device().call_timeout(command, args, timeout_secs, quit_on_fail)
 
-            proc.terminate()
-            proc.join()
 
-            success = False
-
-    log('ADB', 'Command "%s" terminated' % command)
-
-    if not success and quit_on_fail:
-        log('CRASH', 'Failed on command "%s", rebooting' % command)
-        sys.exit(1)
-
-    if success:
-        out = ret.get_nowait().split(':')
-        success = True if out[0] == "True" else False
-        return success, out[1]
-    else:
-        return success, None
+def adb_stats():
+    return engine.stats()
 
 
 def adb_shell(args, timeout_secs=10, retry_limit=3):
-    (success, ret) = adb_call_timeout('shell', args, timeout_secs=timeout_secs)
+    return default_device().shell(args, timeout_secs, retry_limit)
 
-    while not success and retry_limit > 0:
-        (success, ret) = adb_call_timeout('shell', args, timeout_secs=timeout_secs)
-        retry_limit = retry_limit - 1
 
-    return success, ret
+def adb_shell_batch(commands, delays=0, timeout_secs=None, retry_limit=0):
+    return default_device().shell_batch(commands, delays, timeout_secs, retry_limit)
 
 
 def adb_shutdown():
-    adb_shell(['reboot', ' -p'])
+    return default_device().shutdown()
 
 
 def adb_isconnected():
-    global device_serial
-    (success, result) = adb_call('devices')
-    if result is not None:
-        device_found = result.lower().find(device_serial) >= 0
-    else:
-        device_found = None
-    return device_found
+    return default_device().isconnected()
 
 
 def adb_isbooted():
-    (success, result) = adb_shell(['getprop', ' sys.boot_completed'])
-
-    return success and result.strip() == '1'
+    return default_device().isbooted()
 
 
 def adb_wait_boot(timeout_secs=240):
-    end_time = datetime.now() + timedelta(seconds=timeout_secs)
-
-    log('WAITBOOT', 'Checking if device is booted')
-
-    while (not (adb_isconnected() and adb_isbooted())):
-        # Re-issue the reboot command if it's taking too long
-        if (datetime.now() > end_time and adb_isconnected()):
-            log('REBOOT', 'Retrying reboot after taking longer than %d seconds' % timeout_secs)
-            adb_shell(['reboot'])
-            end_time = datetime.now() + timedelta(seconds=timeout_secs)
-
-        time.sleep(2)
-
-    log('WAITBOOT', 'Device is booted')
+    return default_device().wait_boot(timeout_secs)
 
 
 def adb_reboot(wait=False, unlock=False, password=None):
-    log('REBOOT', 'Reboot device')
-    adb_shell(['reboot'])
+    return default_device().reboot(wait, unlock, password)
 
-    if wait:
-        adb_wait_boot()
-        if unlock and password is not None:
-            adb_shell(['input touchscreen swipe 930 880 930 380'], retry_limit=0)
-            adb_shell(['input text {}'.format(password)], retry_limit=0)
-            adb_shell(['input tap 855 988'], retry_limit=0)
 
 def adb_grant_permission(apk_file):
-    assert os.path.isfile(apk_file), '%s is not a valid APK path'
-
-    log('GRANT_PERM', 'Calling aapt on %s' % apk_file)
-    package = aapt_package(apk_file)
-    log('GRANT_PERM', 'Granting all permissions %s' % package)
-    permissions = aapt_permissions(apk_file)
-    permissions_nogranted = []
-    for perm in permissions:
-        try:
-            adb_shell(['pm', 'grant', package, perm], retry_limit=0)
-        except subprocess.CalledProcessError as e:
-            # Ignore error raised by trying to turn on non-toggleable permissions
-            print(e.output.decode('UTF-8', 'backslashreplace'))
-            permissions_nogranted.append(perm)
-            continue
-    return permissions, permissions_nogranted
+    return default_device().grant_permission(apk_file)
 
 
 def adb_install(apk_file, grant_all_perms=False):
-    assert os.path.isfile(apk_file), '%s is not a valid APK path'
-
-    log('INSTALL', 'Calling aapt on %s' % apk_file)
-    package = aapt_package(apk_file)
-    log('INSTALL', 'Installing %s' % package)
-    (success, output) = adb_call_timeout('install', ['-r', apk_file], timeout_secs=60)
-    installed = adb_package_installed(package)
-    if not installed:
-        if grant_all_perms:
-            return (False, output, None, None)
-        else:
-            return (False, output)
-    if installed and grant_all_perms:
-        success = True
-        (permissions, permissions_nogranted) = adb_grant_permission(apk_file)
-        return success, output, permissions, permissions_nogranted
-    return success, output
+    return default_device().install(apk_file, grant_all_perms)
 
 
 def adb_install_auto(apk_file, grant_all_perms=False, timeout_secs=90, quit_on_fail=False):
-    ret = multiprocessing.Queue()
-    proc = multiprocessing.Process(target=adb_call, args=('install', ['-r', apk_file]), kwargs={'ret_queue': ret})
-    log('INSTALL', 'Calling aapt on %s' % apk_file)
-    package = aapt_package(apk_file)
-    log('INSTALL', 'Installing %s with timeout %d' % (package, timeout_secs))
-    proc.start()
-
-    end_time = datetime.now() + timedelta(seconds=timeout_secs)
-    success = True
-    while proc.is_alive() and not adb_package_installed(package):
-        time.sleep(4)
-        # adb_shell(['input tap 391 1960'], retry_limit=0)  # this is for the first phone Xiaomi XYZ
-        adb_shell(['input tap 201 1270'], retry_limit=0)  # This is for redmi 7a
-
-        if datetime.now() > end_time:
-            log('ADB', 'Install "%s" timed out' % package)
-            proc.terminate()
-            proc.join()
-            success = False
-    installed = adb_package_installed(package)
-    if not installed:
-        if grant_all_perms:
-            return (False, None, None, None)
-        else:
-            return (False, None)
-    if installed and grant_all_perms:
-        success = True
-        (permissions, permissions_nogranted) = adb_grant_permission(apk_file)
-        return success, None, permissions, permissions_nogranted
-    return success, None
+    return default_device().install_auto(apk_file, grant_all_perms, timeout_secs, quit_on_fail)
 
 
 def adb_start_app(package):
-    # Always start from the home screen
-    adb_shell(['input', 'keyevent', '3'])
-    time.sleep(2)
-    (success, output) = adb_shell(['monkey', '-p', package, '-c', 'android.intent.category.LAUNCHER', '1'])
-    return (success, output)
+    return default_device().start_app(package)
 
 
 def adb_package_installed(package):
-    (success, output) = adb_shell(['pm', 'list packages', package])
-    return success and len(output) > 0
+    return default_device().package_installed(package)
 
 
 def adb_clear_screen():
-    # Just bang on the "enter" button from the Home Screen a bunch of times
-    adb_shell(['input keyevent 3'])
-    time.sleep(2)
-
-    for n in range(10):
-        adb_shell(['input keyevent 66'])
-        time.sleep(1)
-
-    adb_shell(['input keyevent 3'])
-    time.sleep(2)
+    return default_device().clear_screen()
 
 
 def adb_is_wifi_connected(enable_wifi=False):
-    if (enable_wifi):
-        adb_shell(['svc wifi enable'])  # Ensure wi-fi is on before checking
-        time.sleep(20)
-
-    (success, result) = adb_shell(["dumpsys wifi | grep 'mNetworkInfo' | cut -d ',' -f2 | cut -d '/' -f2"])
-    return success and result.strip() == 'CONNECTED'
+    return default_device().is_wifi_connected(enable_wifi)
 
 
 def adb_is_screen_on():
-    (success, result) = adb_shell(["dumpsys power | grep 'Display Power' | cut -d'=' -f2"])
-    return success and result.strip() == 'ON'
+    return default_device().is_screen_on()
 
 
 def adb_screen_turn_on():
-    if not adb_is_screen_on():
-        adb_shell(['input keyevent 26'])
+    return default_device().screen_turn_on()
 
 
 def adb_screen_turn_off():
-    if adb_is_screen_on():
-        adb_shell(['input keyevent 26'])
+    return default_device().screen_turn_off()
+
 
 def adb_is_unlocked():
-    (success, result) = adb_shell(["dumpsys power | grep 'mHoldingDisp' | cut -d'=' -f2"])
-    return success and result.strip() == 'true'
+    return default_device().is_unlocked()
 
 
 def adb_unlock(password):
-    if not adb_is_screen_on():
-        adb_screen_turn_on()
-    adb_shell(['input touchscreen swipe 930 880 930 380'], retry_limit=0)
-    adb_shell(['input text {}'.format(password)], retry_limit=0)
-    adb_shell(['input tap 855 988'], retry_limit=0)
+    return default_device().unlock(password)
 
-def adb_screenshot(out_file):
-    log('SCREENSHOT', 'Screenshot %s' % out_file)
-    screen_tmp = '/sdcard/int-transfer.png.tmp'
 
-    (success, ret) = adb_shell(['screencap', '-p', screen_tmp])
-    if success:
-        adb_call_timeout('pull', [screen_tmp, out_file], timeout_secs=10)
-        adb_shell(['rm %s' % screen_tmp])
+def adb_screenshot(out_file=None):
+    return default_device().screenshot(out_file)
 
 
 def adb_is_portrait():
-    (success, result) = adb_shell(['dumpsys input | grep SurfaceOrientation'])
-    return success and result.strip().endswith('0')
+    return default_device().is_portrait()
 
 
 def adb_monkey(package, seed=None, delay_ms=1000, event_count=100, pct_trackball=0, pct_nav=0, pct_majornav=0,
-               pct_syskeys=0, pct_flip=0, pct_anyevent=0):
-    seed = seed if seed is not None else random.randrange(999999999999)
-
-    log('MONKEY', 'Seed=%d' % seed)
-    log('MONKEY', 'DelayMS=%d' % delay_ms)
-    log('MONKEY', 'EventCount=%d' % event_count)
-
-    monkey_args = 'monkey \
-                   -s %d \
-                   -p %s \
-                   --throttle %s \
-                   --pct-trackball %d \
-                   --pct-nav %d \
-                   --pct-majornav %d \
-                   --pct-syskeys %d \
-                   --pct-flip %d \
-                   --pct-anyevent %d  \
-                   --ignore-crashes --ignore-timeouts --ignore-security-exceptions -v %d' % \
-                  (seed, package, delay_ms, pct_trackball, pct_nav, pct_majornav, pct_syskeys, pct_flip, pct_anyevent,
-                   event_count)
-    adb_shell([monkey_args], timeout_secs=120, retry_limit=0)
+               pct_syskeys=0, pct_flip=0, pct_anyevent=0, timeout_secs=None, stop_on=MONKEY_STOP):
+    return default_device().monkey(package, seed, delay_ms, event_count, pct_trackball, pct_nav, pct_majornav,
+                                   pct_syskeys, pct_flip, pct_anyevent, timeout_secs, stop_on)
 
 
 ##################################3
@@ -465,3 +947,135 @@ def call_sh_output(command, timeout_secs=10):
 # adb_shell(['input text 5131'], retry_limit=0)
 # adb_shell(['input keyevent 66'], retry_limit=0)
 #adb_call("install", ['r-', 'base.apk'])
+
+
+# Unit testing
+import unittest
+
+
+class Test_AdbDevice(unittest.TestCase):
+    def setUp(self):
+        import standin
+        self.device = standin.FakeDevice('serial1')
+        self.legacy = standin.FakeDevice('serial2', shell_v2=False)
+        self.server = standin.AdbServer([self.device, self.legacy]).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_devices(self):
+        client = adbclient.AdbClient(self.server.host, self.server.port)
+        # Asserting two devices are driven side by side, each one with its own serial
+        (a, b) = (AdbDevice('serial1', client=client), AdbDevice('serial2', client=client))
+        threads = [threading.Thread(target=d.shell_batch, args=(['echo {}'.format(d.serial)] * 3,)) for d in (a, b)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        self.assertEqual(len(self.device.commands), 1)
+        self.assertIn('echo serial1', self.device.commands[0])
+        self.assertIn('echo serial2', self.legacy.commands[0])
+        self.assertTrue(a.isconnected() and b.isconnected())
+        a.reboot()
+        self.assertEqual((self.device.commands[-1], len(self.legacy.commands)), ('reboot', 1))
+        client.close()
+
+    def test_monkey(self):
+
+        def monkey(command):
+            def output():
+                for i in range(500):
+                    yield b':Sending Touch (ACTION_DOWN): 0:(100.0,200.0)\n'
+                    yield b':Sending Touch (ACTION_UP): 0:(100.0,200.0)\n'
+                    yield b':Sending Trackball (ACTION_MOVE): 0:(-3.0,2.0)\n'
+                    if i == 40 and command.split()[:3] == ['monkey', '-s', '1']:
+                        raise ConnectionAbortedError()
+                    if i == 20:
+                        yield b'// CRASH: com.example.app (pid 1234)\n// Short Msg: java.lang.NullPointerException\n'
+                    time.sleep(0.01)
+                yield b'Events injected: 500\n// Monkey finished\n'
+            return 0, output()
+        self.device.shell = monkey
+        self.legacy.shell = monkey
+        client = adbclient.AdbClient(self.server.host, self.server.port)
+        # Asserting the monkey output is read as it arrives and the run stops on the crash, on both protocols
+        for serial in ('serial1', 'serial2'):
+            started = time.time()
+            summary = AdbDevice(serial, client=client).monkey('com.example.app', delay_ms=10, event_count=500)
+            self.assertLess(time.time() - started, 2, 'It does not stop monkey on a crash')
+            self.assertEqual((summary['stopped'], summary['crashes'], summary['progress']), ('crash', 1, 21))
+            self.assertIsNone(summary['events'])
+            self.assertGreater(summary['events_per_sec'], 0)
+        # Asserting a run without crash goes to the end, its events being the count monkey reports
+        summary = AdbDevice('serial1', client=client).monkey('com.example.app', stop_on=())
+        self.assertEqual((summary['finished'], summary['events'], summary['stopped']), (True, 500, None))
+        self.assertEqual(summary['progress'], 500)
+        self.assertFalse(summary['failed'])
+        # Asserting a run whose connection breaks before the exit status does not pass for finished
+        summary = AdbDevice('serial1', client=client).monkey('com.example.app', seed=1, stop_on=())
+        self.assertEqual((summary['finished'], summary['failed'], summary['events']), (False, True, None))
+        self.assertEqual(summary['progress'], 41)
+        client.close()
+
+    def test_screenshot(self):
+        import shutil
+        import tempfile
+        pixels = bytes(range(256)) * 75  # 80 x 60 RGBA
+        screen = png(80, 60, pixels)
+
+        def screencap(command):
+            if command == 'screencap -p':
+                return 0, (screen[i:i + 1000] for i in range(0, len(screen), 1000))
+            time.sleep(0.02)
+            return 0, struct.pack('<IIII', 80, 60, 1, 0) + pixels
+        self.device.shell = screencap
+        client = adbclient.AdbClient(self.server.host, self.server.port)
+        device = AdbDevice('serial1', client=client)
+        # Asserting the PNG is streamed into memory or a file, with no file left on the device
+        self.assertEqual(device.screenshot(), (True, screen))
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'screen.png')
+            self.assertEqual(device.screenshot(path), (True, path))
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), screen)
+            self.assertNotIn('rm', ' '.join(self.device.commands))
+            # Asserting the periodic capture takes every frame and encodes the raw ones on the host
+            summary = ScreenCapture(device, os.path.join(folder, 'phase-one'), 5, interval=0.05).start().wait()
+            self.assertEqual((summary['captured'], summary['dropped'], summary['written']), (5, 0, 5))
+            for path in summary['files']:
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), screen)
+            summary = ScreenCapture(device, os.path.join(folder, 'phase-two'), 100, duration=100).start().stop()
+            self.assertEqual(summary['written'], 1)
+            # Asserting frames that cannot be written are counted and the capture still ends
+            capture = ScreenCapture(device, os.path.join(folder, 'phase-three'), 5, interval=0.05).start()
+            shutil.rmtree(os.path.join(folder, 'phase-three'))
+            summary = capture.wait()
+            self.assertEqual(summary['written'] + summary['failed'], 5)
+            self.assertGreaterEqual(summary['failed'], 4)
+            # Asserting a truncated PNG is not kept
+            screen = screen[:-20]
+            self.assertFalse(device.screenshot(path)[0])
+            self.assertFalse(os.path.exists(path))
+        client.close()
+
+
+    def test_screencap(self):
+        header = []
+        pixels = bytes([1, 2, 3, 4]) * 6  # 3 x 2
+        self.device.shell = lambda command: (0, header[-1] + pixels)
+        client = adbclient.AdbClient(self.server.host, self.server.port)
+        device = AdbDevice('serial1', client=client)
+        # Asserting RGBX and BGRA captures are converted to RGBA, with or without the color space
+        for (pixel_format, converted) in ((PIXEL_RGBA_8888, [1, 2, 3, 4]), (PIXEL_RGBX_8888, [1, 2, 3, 255]),
+                                          (PIXEL_BGRA_8888, [3, 2, 1, 4])):
+            for extra in (b'', struct.pack('<I', 0)):
+                header.append(struct.pack('<III', 3, 2, pixel_format) + extra)
+                self.assertEqual(device.screencap(), (True, (3, 2, bytes(converted) * 6)))
+        # Asserting any other pixel format is reported instead of encoded wrong
+        header.append(struct.pack('<IIII', 3, 2, 4, 0))
+        self.assertEqual(device.screencap(), (False, 'unsupported pixel format 4'))
+        client.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,17 +4,59 @@
 #                             TRAFFIC ANALYSIS WRAPPERS
 #############################################################################
 import io
+import gzip
+import hashlib
 import multiprocessing
+import queue
 import shutil
+import threading
 import zipfile
 import time
-import requests
+import axml
+import httppool
 import json
 import os
+import requests
+import urllib3
+import workers
+try:
+    import zstandard
+except ImportError:  # zstd results need the zstandard package
+    zstandard = None
+
+DEVICE_NOT_CONNECTED_ERROR = 10
+APP_INSTALL_FAIL_ERROR = 20
+MITM_PROXY_START_ERROR = 30
+SERVER_CONNECTION_ERROR = 40
+PHASE_CANCELLED_ERROR = 50
+# codes of the combined setup: configuration or APK transfer failed, testing server without setup endpoint
+CONFIG_ERROR = 60
+UPLOAD_ERROR = 70
+SETUP_UNSUPPORTED = 80
+
+POLL_INTERVAL = 2
+# a job about to end, from its progress, is polled sooner, but not more often than this
+MIN_POLL_INTERVAL = 0.05
+POLL_ERRORS = 3
+# readiness polling before sanitization: first interval, doubled up to the maximum
+READY_INTERVAL = 0.5
+READY_MAX_INTERVAL = 4
+# results are streamed to disk in blocks of this size, whatever their length
+BUFFER_SIZE = 1024 * 1024
+# file extension of every result compression
+COMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+# artifacts of a test and the name of their file, {} being the APK name
+ARTIFACTS = {'screenshot-phase-one': '{}-fp-screenshoot', 'screenshot-phase-two': '{}-sp.screenshot',
+             'raw-phase-one': '{}-raw-first.out', 'raw-phase-two': '{}-raw-second.out'}
+# artifacts of every device are fetched by a single pool, of this size unless its first user asks for another
+ARTIFACT_WORKERS = 4
+RESUME_RETRIES = 3
+_artifact_pool = None
+_artifact_lock = threading.Lock()
 
 
 class Traffic:
-    def __init__(self, server, port, device, apk, testing_label, version, app):
+    def __init__(self, server, port, device, apk, testing_label, version, app, jobs=False):
         self.server = server
         self.port = port
         self.device = device
@@ -22,11 +64,13 @@ class Traffic:
         self.testing_label = testing_label
         self.version = version
         self.app = app
+        # job mode: phases are submitted as jobs and polled, instead of a GET held open for the whole phase
+        self.jobs = jobs
 
     def configure(self):
         data = {}
         try:
-            res = requests.get('http://{}:{}/config'.format(self.server, self.port),
+            res = httppool.get(self.server, self.port, '/config',
                                params={'ip': self.device, 'testing_label': self.testing_label, 'version': self.version,
                                        'app': self.app})
             data = json.loads(res.text)
@@ -39,7 +83,7 @@ class Traffic:
     def configure2(self, name):
         data = {}
         try:
-            res = requests.get('http://{}:{}/config'.format(self.server, self.port), params={'ip': self.device, 'name': name, 'testing_label': self.testing_label, 'version': self.version})
+            res = httppool.get(self.server, self.port, '/config', params={'ip': self.device, 'name': name, 'testing_label': self.testing_label, 'version': self.version})
             data = json.loads(res.text)
         except Exception as e:
             data['Ok'] = False
@@ -47,22 +91,73 @@ class Traffic:
         finally:
             return data['Ok'], data['Msg']
 
-    def upload(self):
+    def upload(self, sha256=None, progress=None):
+        """Sends the APK to the testing server. The server is asked first whether it already holds an APK with
+        the same sha256, which it then takes as is; otherwise the APK is streamed in blocks as a chunked body.
+        progress(sent, total), if given, is called after every block. Servers without the hash endpoint get the
+        legacy multipart upload"""
         data = {}
         try:
-            file = {'apk': open(self.apk, 'rb')}
-            res = requests.post('http://{}:{}/upload'.format(self.server, self.port), files=file)
-            data = json.loads(res.text)
+            sha256 = sha256 if sha256 is not None else axml.apk_hash(self.apk)
+            res = httppool.get(self.server, self.port, '/upload/hash', params={'sha256': sha256})
+            if res.status_code == 404:
+                with open(self.apk, 'rb') as f:
+                    res = httppool.post(self.server, self.port, '/upload', files={'apk': f})
+                data = json.loads(res.text)
+            elif json.loads(res.text).get('Known'):
+                data = {'Ok': True, 'Msg': 'APK already on the testing server'}
+            else:
+                with open(self.apk, 'rb') as f:
+                    res = httppool.post(self.server, self.port, '/upload/stream',
+                                        params={'sha256': sha256, 'name': self.apkName()},
+                                        data=blocks(f, os.fstat(f.fileno()).st_size, progress))
+                data = json.loads(res.text)
         except Exception as e:
             data['Ok'] = False
             data['Msg'] = str(e)
         finally:
             return data['Ok'], data['Msg']
 
-    def phaseOne(self, timeout, permissions=True, reboot=False):
+    def setup(self, timeout, permissions=True, reboot=False, sha256=None, progress=None):
+        """Configures the testing terminal, sends the APK and starts phase one as a job, in a single request. The
+        APK travels with it only when the testing server does not hold one with the same sha256 yet. Returns
+        (Ok, session handle: session, job and uploaded, or message, Code); Code is one of the phase one codes,
+        CONFIG_ERROR, UPLOAD_ERROR, or SETUP_UNSUPPORTED for a testing server without the setup endpoint"""
+        data = {}
+        try:
+            sha256 = sha256 if sha256 is not None else axml.apk_hash(self.apk)
+            params = {'ip': self.device, 'testing_label': self.testing_label, 'version': self.version,
+                      'app': self.app, 'sha256': sha256, 'name': self.apkName(), 'timeout': timeout,
+                      'permissions': permissions, 'reboot': reboot}
+            res = httppool.post(self.server, self.port, '/setup', params=params)
+            uploaded = False
+            if res.status_code == 404:
+                data = {'Ok': False, 'Msg': 'Testing server without setup endpoint', 'Code': SETUP_UNSUPPORTED}
+                return
+            data = json.loads(res.text)
+            if data.get('Missing'):
+                with open(self.apk, 'rb') as f:
+                    res = httppool.post(self.server, self.port, '/setup', params=params,
+                                        data=blocks(f, os.fstat(f.fileno()).st_size, progress))
+                data = json.loads(res.text)
+                uploaded = True
+            if data['Ok']:
+                data['Msg'] = {'session': data['Session'], 'job': data['Job'], 'uploaded': uploaded}
+        except Exception as e:
+            data['Ok'] = False
+            data['Msg'] = str(e)
+            data['Code'] = SERVER_CONNECTION_ERROR
+        finally:
+            return data['Ok'], data['Msg'], data.get('Code', 0)
+
+    def phaseOne(self, timeout, permissions=True, reboot=False, deadline=None):
+        if self.jobs:
+            (success, result, code) = self.submitPhase('phase-one', {'timeout': timeout, 'permissions': permissions,
+                                                                     'reboot': reboot})
+            return self.waitJob(result, deadline) if success else (success, result, code)
         data = {}
         try:
-            res = requests.get('http://{}:{}/phase-one'.format(self.server, self.port), params={'timeout': timeout,
+            res = httppool.get(self.server, self.port, '/phase-one', params={'timeout': timeout,
                                                                                                 'permissions': permissions,
                                                                                                 'reboot': reboot})
             data = json.loads(res.text)
@@ -73,10 +168,13 @@ class Traffic:
         finally:
             return data['Ok'], data['Msg'], data['Code']
 
-    def phaseTwo(self, timeout, monkey=True):
+    def phaseTwo(self, timeout, monkey=True, deadline=None):
+        if self.jobs:
+            (success, result, code) = self.submitPhase('phase-two', {'timeout': timeout, 'monkey': monkey})
+            return self.waitJob(result, deadline) if success else (success, result, code)
         data = {}
         try:
-            res = requests.get('http://{}:{}/phase-two'.format(self.server, self.port), params={'timeout': timeout, 'monkey': monkey})
+            res = httppool.get(self.server, self.port, '/phase-two', params={'timeout': timeout, 'monkey': monkey})
             data = json.loads(res.text)
         except Exception as e:
             data['Ok'] = False
@@ -85,93 +183,119 @@ class Traffic:
         finally:
             return data['Ok'], data['Msg'], data['Code']
 
-    def analysis(self):
+    def submitPhase(self, phase, params):
+        """Starts a phase as a job on the testing server, returning its job id in place of the message"""
         data = {}
         try:
-            res = requests.get('http://{}:{}/analysis'.format(self.server, self.port))
+            res = httppool.get(self.server, self.port, '/{}/submit'.format(phase), params=params)
             data = json.loads(res.text)
+            if data['Ok']:
+                data['Msg'] = data['Job']
         except Exception as e:
             data['Ok'] = False
             data['Msg'] = str(e)
+            data['Code'] = SERVER_CONNECTION_ERROR
         finally:
-            return data['Ok'], data['Msg']
+            return data['Ok'], data['Msg'], data.get('Code', 0)
 
-    def result(self, folder=None):
-        data = {'Ok': True}
+    def pollJob(self, job):
+        """State of a job: 'running', 'done' or 'cancelled', with the phase result (Ok, Msg, Code) and Progress"""
+        data = {}
         try:
-            res = requests.get('http://{}:{}/result'.format(self.server, self.port))
-            data['Msg'] = res.text
-            if folder is not None:
-                with open('{}/{}-pii.privapp.log'.format(folder, os.path.basename(self.apk.decode('utf-8'))), 'wb') as f:
-                    for chunk in res.iter_content(chunk_size=128):
-                        f.write(chunk)
+            res = httppool.get(self.server, self.port, '/job/{}'.format(job))
+            data = json.loads(res.text)
         except Exception as e:
+            data['State'] = 'error'
             data['Ok'] = False
             data['Msg'] = str(e)
+            data['Code'] = SERVER_CONNECTION_ERROR
         finally:
-            return data['Ok'], data['Msg']
+            return data
 
-    def screenshotPhaseOne(self, folder):
-        data = {'Ok': True, 'Msg': None}
+    def cancelJob(self, job):
+        data = {}
         try:
-            res = requests.get('http://{}:{}/screenshot-phase-one'.format(self.server, self.port), stream=True)
-            if res.status_code == 200:
-                # with open('{}/{}-first.tar'.format(folder, os.path.basename(self.apk.decode('utf-8'))), 'wb') as f:
-                with open(os.path.join(folder, "{}-fp-screenshoot".format(os.path.basename(self.apk))), 'wb') as f:
-                    res.raw.decode_content = False
-                    shutil.copyfileobj(res.raw, f)
-                    #for chunk in res.iter_content(chunk_size=128):
-                    #    f.write(chunk)
+            res = httppool.get(self.server, self.port, '/job/{}/cancel'.format(job))
+            data = json.loads(res.text)
         except Exception as e:
             data['Ok'] = False
             data['Msg'] = str(e)
         finally:
-            return (data['Ok'], data['Msg'])
+            return data['Ok'], data['Msg']
 
-    def screenshotPhaseTwo(self, folder):
-        data = {'Ok': True, 'Msg': None}
+    def waitJob(self, job, deadline=None, interval=None, progress=None):
+        """Polls a job until it is over. A job still running after deadline seconds is cancelled. progress, if
+        given, is called with every poll answer"""
+        results = supervise({job: (self, job, deadline)}, interval=interval, progress=progress)
+        return results[job]
+
+    def analysis(self):
+        data = {}
         try:
-            res = requests.get('http://{}:{}/screenshot-phase-two'.format(self.server, self.port), stream=True)
-            if res.status_code == 200:
-                with open('{}/{}-sp.screenshot'.format(folder, os.path.basename(self.apk.decode('utf-8'))), 'wb') as f:
-                    for chunk in res.iter_content(chunk_size=128):
-                        f.write(chunk)
+            res = httppool.get(self.server, self.port, '/analysis')
+            data = json.loads(res.text)
         except Exception as e:
             data['Ok'] = False
             data['Msg'] = str(e)
         finally:
-            return (data['Ok'], data['Msg'])
+            return data['Ok'], data['Msg']
 
-    def rawPhaseOne(self, folder):
-        data = {'Ok': True, 'Msg': None}
+    def apkName(self):
+        # the APK path may be str or bytes
+        return os.fsdecode(os.path.basename(self.apk))
+
+    def result(self, folder=None, compression='none'):
+        """Streams the PII report into <folder>/<apk>-pii.privapp.log, compressed when asked, or only through its
+        hash when folder is None. Returns (Ok, summary of the report) instead of the report itself"""
+        data = {'Ok': True}
         try:
-            res = requests.get('http://{}:{}/raw-phase-one'.format(self.server, self.port), stream=True)
-            with open('{}/{}-raw-first.out'.format(folder, os.path.basename(self.apk.decode('utf-8'))), 'wb') as f:
-                for chunk in res.iter_content(chunk_size=128):
-                    f.write(chunk)
+            res = httppool.get(self.server, self.port, '/result', stream=True)
+            res.raise_for_status()
+            path = os.path.join(folder, '{}-pii.privapp.log'.format(self.apkName())) if folder is not None else None
+            data['Msg'] = save(res, path, compression)
         except Exception as e:
             data['Ok'] = False
             data['Msg'] = str(e)
         finally:
-            return (data['Ok'], data['Msg'])
+            return data['Ok'], data['Msg']
 
-    def rawPhaseTwo(self, folder):
-        data = {'Ok': True, 'Msg': None}
+    def artifact(self, name, folder):
+        """Downloads an artifact (see ARTIFACTS) into folder. Returns (Ok, summary: path, size)"""
+        data = {'Ok': True}
         try:
-            res = requests.get('http://{}:{}/raw-phase-two'.format(self.server, self.port), stream=True)
-            with open('{}/{}-raw-second.out'.format(folder, os.path.basename(self.apk.decode('utf-8'))), 'wb') as f:
-                for chunk in res.iter_content(chunk_size=128):
-                    f.write(chunk)
+            path = os.path.join(folder, ARTIFACTS[name].format(self.apkName()))
+            data['Msg'] = {'path': path, 'size': fetch(self.server, self.port, '/{}'.format(name), path)}
         except Exception as e:
             data['Ok'] = False
             data['Msg'] = str(e)
         finally:
-            return (data['Ok'], data['Msg'])
+            return data['Ok'], data['Msg']
+
+    def artifacts(self, folder, names=None, pool_size=ARTIFACT_WORKERS):
+        """Downloads the artifacts named (all of them by default) side by side on the artifact pool, of pool_size
+        threads when this call creates it. Returns name -> (Ok, Msg) of every artifact"""
+        names = list(names) if names is not None else list(ARTIFACTS)
+        done = queue.Queue()
+        for name in names:
+            artifact_pool(pool_size).submit(lambda n: done.put((n, self.artifact(n, folder))), name)
+        return dict(done.get() for _ in names)
+
+    def screenshotPhaseOne(self, folder):
+        return self.artifact('screenshot-phase-one', folder)
+
+    def screenshotPhaseTwo(self, folder):
+        return self.artifact('screenshot-phase-two', folder)
+
+    def rawPhaseOne(self, folder):
+        return self.artifact('raw-phase-one', folder)
+
+    def rawPhaseTwo(self, folder):
+        return self.artifact('raw-phase-two', folder)
 
     def cert(self):
         data = {}
         try:
-            res = requests.get('http://{}:{}/cert'.format(self.server, self.port))
+            res = httppool.get(self.server, self.port, '/cert')
             data = json.loads(res.text)
         except Exception as e:
             data['Ok'] = False
@@ -182,7 +306,7 @@ class Traffic:
     def hooker(self):
         data = {}
         try:
-            res = requests.get('http://{}:{}/hooker'.format(self.server, self.port))
+            res = httppool.get(self.server, self.port, '/hooker')
             data = json.loads(res.text)
         except Exception as e:
             data['Ok'] = False
@@ -190,11 +314,205 @@ class Traffic:
         finally:
             return (data['Ok'], data['Msg'])
 
+    def ready(self):
+        """Whether the testing terminal is done with the app and can be sanitized. None when the testing server
+        has no readiness endpoint"""
+        try:
+            res = httppool.get(self.server, self.port, '/ready', timeout=(httppool.CONNECT_TIMEOUT, 10))
+            if res.status_code == 404:
+                return None
+            return json.loads(res.text)['Ok']
+        except Exception as e:
+            return False
+
+    def waitReady(self, deadline, interval=None):
+        """Polls the readiness of the testing terminal with a growing interval for up to deadline seconds.
+        Returns (ready, seconds waited); a testing server without readiness endpoint is waited for the whole
+        deadline"""
+        interval = interval if interval is not None else READY_INTERVAL
+        started = time.time()
+        while True:
+            ready = self.ready()
+            if ready:
+                return True, time.time() - started
+            remaining = deadline - (time.time() - started)
+            if remaining <= 0:
+                return False, time.time() - started
+            if ready is None:
+                time.sleep(remaining)
+                return False, time.time() - started
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, READY_MAX_INTERVAL)
+
     def sanitize(self):
+        data = {}
         try:
-            res = requests.get('http://{}:{}/sanitize'.format(self.server, self.port))
+            res = httppool.get(self.server, self.port, '/sanitize')
+            data = json.loads(res.text)
         except Exception as e:
-            print(str(e))
+            data['Ok'] = False
+            data['Msg'] = str(e)
+        finally:
+            return data['Ok'], data['Msg']
+
+
+def save(res, path, compression='none'):
+    """Streams the body of a response into path plus the extension of the compression, through a .part file
+    renamed once complete, holding a single block in memory. path None only reads the body. Returns its summary:
+    path, size, stored (bytes on disk), sha256 and records (lines)"""
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression {}'.format(compression))
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression needs the zstandard package')
+    h = hashlib.sha256()
+    (size, records, last) = (0, 0, b'\n')
+    if path is not None:
+        path = path + COMPRESSIONS[compression]
+        part = path + '.part'
+        f = open(part, 'wb', buffering=BUFFER_SIZE)
+        if compression == 'gzip':
+            out = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6, mtime=0)
+        elif compression == 'zstd':
+            out = zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+        else:
+            out = f
+    complete = False
+    try:
+        for chunk in res.iter_content(chunk_size=BUFFER_SIZE):
+            if not chunk:
+                continue
+            h.update(chunk)
+            size += len(chunk)
+            records += chunk.count(b'\n')
+            last = chunk[-1:]
+            if path is not None:
+                out.write(chunk)
+        complete = True
+    finally:
+        res.close()
+        if path is not None:
+            if out is not f:
+                out.close()
+            f.close()
+            if not complete:
+                os.remove(part)
+    if last != b'\n':  # last record without a line end
+        records += 1
+    stored = None
+    if path is not None:
+        os.replace(part, path)
+        stored = os.path.getsize(path)
+    return {'path': path, 'size': size, 'stored': stored, 'sha256': h.hexdigest(), 'records': records}
+
+
+def fetch(server, port, resource, path, retries=RESUME_RETRIES):
+    """Downloads a resource into path, asking for a gzip transfer. The body is kept as sent into a part file
+    (path.part, or path.gz.part for a gzip body) renamed or decompressed into path once complete, so path is
+    always whole. A transfer cut short is resumed with a Range request, also when a previous call left its part
+    behind. Returns the size of the file"""
+    size = 0
+    encoding = None
+    for candidate in ('identity', 'gzip'):
+        part = path + ('.gz.part' if candidate == 'gzip' else '.part')
+        if os.path.isfile(part):
+            (encoding, size) = (candidate, os.path.getsize(part))
+            break
+    while True:
+        headers = {'Accept-Encoding': 'gzip'}
+        if size > 0:
+            headers['Range'] = 'bytes={}-'.format(size)
+        try:
+            res = httppool.get(server, port, resource, headers=headers, stream=True)
+            if res.status_code == 416 and size > 0:  # the part already holds the whole body
+                res.close()
+                break
+            res.raise_for_status()
+            received = 'gzip' if res.headers.get('Content-Encoding', '').lower() == 'gzip' else 'identity'
+            if size > 0 and (res.status_code != 206 or received != encoding):  # not resumable, from scratch
+                os.remove(path + ('.gz.part' if encoding == 'gzip' else '.part'))
+                size = 0
+            encoding = received
+            part = path + ('.gz.part' if encoding == 'gzip' else '.part')
+            with open(part, 'ab' if size > 0 else 'wb', buffering=BUFFER_SIZE) as f:
+                for chunk in res.raw.stream(BUFFER_SIZE, decode_content=False):
+                    f.write(chunk)
+                    size += len(chunk)
+            res.close()
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                urllib3.exceptions.ProtocolError, urllib3.exceptions.ReadTimeoutError):
+            if retries <= 0:
+                raise
+            retries = retries - 1
+            part = path + ('.gz.part' if encoding == 'gzip' else '.part')
+            size = os.path.getsize(part) if encoding is not None and os.path.isfile(part) else 0
+    if encoding == 'gzip':
+        with gzip.open(path + '.gz.part', 'rb') as src, open(path + '.tmp', 'wb') as dst:
+            shutil.copyfileobj(src, dst, BUFFER_SIZE)
+        os.replace(path + '.tmp', path)
+        os.remove(path + '.gz.part')
+    else:
+        os.replace(path + '.part', path)
+    return os.path.getsize(path)
+
+
+def blocks(f, total, progress=None):
+    """Body of a chunked upload: the file in BUFFER_SIZE blocks"""
+    sent = 0
+    for block in iter(lambda: f.read(BUFFER_SIZE), b''):
+        yield block
+        sent += len(block)
+        if progress is not None:
+            progress(sent, total)
+
+
+def artifact_pool(size=ARTIFACT_WORKERS):
+    """The pool shared by the artifacts of every device, sized once when it is first asked for"""
+    global _artifact_pool
+    with _artifact_lock:
+        if _artifact_pool is None:
+            _artifact_pool = workers.WorkerPool(size, 'artifacts')
+        return _artifact_pool
+
+
+def supervise(jobs, interval=None, progress=None):
+    """Polls from a single thread the phase jobs of many devices. jobs maps a name to (traffic, job, deadline),
+    deadline being the seconds the job may run or None. Returns name -> (Ok, Msg, Code) once every job is over;
+    jobs past their deadline are cancelled and reported with PHASE_CANCELLED_ERROR"""
+    interval = interval if interval is not None else POLL_INTERVAL
+    started = time.time()
+    running = dict(jobs)
+    errors = {name: 0 for name in jobs}
+    results = {}
+    while running:
+        wait = interval
+        for name, (traffic, job, deadline) in list(running.items()):
+            data = traffic.pollJob(job)
+            if progress is not None:
+                progress(name, data)
+            if 0 < data.get('Progress', 0) < 1:
+                elapsed = time.time() - started
+                wait = min(wait, max(elapsed * (1 - data['Progress']) / data['Progress'], MIN_POLL_INTERVAL))
+            if data['State'] == 'error':
+                errors[name] += 1
+                if errors[name] < POLL_ERRORS:
+                    continue
+            elif data['State'] == 'running':
+                errors[name] = 0
+                if deadline is None or time.time() - started < deadline:
+                    continue
+                traffic.cancelJob(job)
+                data = {'Ok': False, 'Msg': 'Phase cancelled after {} seconds'.format(deadline),
+                        'Code': PHASE_CANCELLED_ERROR}
+            elif data['State'] == 'cancelled':
+                data.setdefault('Code', PHASE_CANCELLED_ERROR)
+            results[name] = (data['Ok'], data['Msg'], data.get('Code', 0))
+            del running[name]
+        if running:
+            time.sleep(wait)
+    return results
+
+
 # data = json.loads(res.text)
 
 # TESTING
@@ -238,3 +556,151 @@ def virtualtest(app):
 # 50918aee9906
 # manualPhaseTwo("com.cardinalblue.piccollage.google")
 # manualPhaseOne('com.blyts.chinchon')
+
+
+# Unit testing
+import unittest
+
+
+class ServerTestCase(unittest.TestCase):
+    """Tests run against a standin.TestingServer started with server_options, stopped after every test"""
+    server_options = {}
+
+    def setUp(self):
+        import standin
+        self.server = standin.TestingServer(**self.server_options).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def traffic(self, apk=None, jobs=False):
+        return Traffic(self.server.host, self.server.port, 'device', apk, 'label', 1, 'app', jobs=jobs)
+
+
+class Test_Jobs(ServerTestCase):
+    server_options = {'phase_scale': 0.01}
+
+    def setUp(self):
+        global POLL_INTERVAL
+        (self.poll_interval, POLL_INTERVAL) = (POLL_INTERVAL, 0.05)
+        super().setUp()
+
+    def tearDown(self):
+        global POLL_INTERVAL
+        POLL_INTERVAL = self.poll_interval
+        super().tearDown()
+
+    def test_jobs(self):
+        # Asserting a submitted phase is polled until it is over
+        self.assertEqual(self.traffic(jobs=True).phaseOne(10, deadline=5)[0], True)
+        # Asserting a phase past its deadline is cancelled
+        (success, result, code) = self.traffic(jobs=True).phaseTwo(1000, deadline=0.2)
+        self.assertEqual((success, code), (False, PHASE_CANCELLED_ERROR), 'It does not cancel a stuck phase')
+        # Asserting a single thread supervises the phases of several devices
+        jobs = {}
+        for name in ('a', 'b', 'c'):
+            t = self.traffic(jobs=True)
+            jobs[name] = (t, t.submitPhase('phase-one', {'timeout': 20})[1], 5)
+        results = supervise(jobs)
+        self.assertEqual(sorted(results), ['a', 'b', 'c'])
+        self.assertTrue(all(r[0] for r in results.values()))
+
+
+class Test_Ready(ServerTestCase):
+    server_options = {'ready_delay': 0.3}
+
+    def test_ready(self):
+        t = self.traffic()
+        t.result()
+        # Asserting the wait ends once the terminal is ready, well before the deadline
+        (ready, waited) = t.waitReady(5, interval=0.05)
+        self.assertTrue(ready)
+        self.assertTrue(0.2 < waited < 2)
+        self.assertEqual(t.sanitize(), (True, 'Ok'))
+        t.result()
+        self.assertEqual(t.waitReady(0.1, interval=0.05)[0], False)
+
+
+class Test_Result(ServerTestCase):
+    server_options = {'result_records': 5000}
+
+    def test_result(self):
+        import tempfile
+        t = self.traffic('/staging/1/com.example.app')
+        with tempfile.TemporaryDirectory() as folder:
+            # Asserting the report is stored compressed and only its summary is returned
+            (success, summary) = t.result(folder, 'gzip')
+            self.assertTrue(success)
+            self.assertEqual(summary['path'], os.path.join(folder, 'com.example.app-pii.privapp.log.gz'))
+            self.assertEqual((summary['size'], summary['records']), (len(self.server.report), 5000))
+            self.assertLess(summary['stored'], summary['size'])
+            with gzip.open(summary['path']) as f:
+                self.assertEqual(hashlib.sha256(f.read()).hexdigest(), summary['sha256'])
+            self.assertEqual(os.listdir(folder), ['com.example.app-pii.privapp.log.gz'])
+            self.assertEqual(t.result()[1]['path'], None)
+
+
+class Test_Artifacts(ServerTestCase):
+    server_options = {'artifact_size': 300000}
+
+    def test_artifacts(self):
+        import tempfile
+        self.server.latencies = {'screenshot-phase-one': 0.3, 'screenshot-phase-two': 0.3, 'raw-phase-one': 0.3,
+                                 'raw-phase-two': 0.3}
+        self.server.drop_once = {'/raw-phase-one', '/screenshot-phase-two'}
+        t = self.traffic('/staging/1/com.example.app')
+        with tempfile.TemporaryDirectory() as folder:
+            # Asserting the artifacts are fetched side by side, cut transfers resumed, and stored decompressed
+            started = time.time()
+            fetched = t.artifacts(folder)
+            self.assertLess(time.time() - started, 1.0, 'It does not fetch the artifacts side by side')
+            self.assertTrue(all(success for (success, result) in fetched.values()), fetched)
+            with open(fetched['raw-phase-one'][1]['path'], 'rb') as f:
+                self.assertTrue(f.read().startswith(b'00000000 GET http://tracker.example.com/0\n'))
+            self.assertEqual(fetched['raw-phase-one'][1]['size'], 300000)
+            self.assertEqual(fetched['screenshot-phase-two'][1]['size'], 300000)
+            self.assertEqual(sorted(self.server.requests).count('/raw-phase-one'), 2)
+            self.assertEqual(len(os.listdir(folder)), 4)
+
+
+class Test_Upload(ServerTestCase):
+    def test_upload(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as folder:
+            apk = os.path.join(folder, 'com.example.app')
+            with open(apk, 'wb') as f:
+                f.write(os.urandom(3 * BUFFER_SIZE + 5))
+            t = self.traffic(apk)
+            # Asserting the APK is streamed in blocks once, then taken from the server by its hash
+            progress = []
+            self.assertEqual(t.upload(progress=lambda sent, total: progress.append(sent)), (True, 'Ok'))
+            self.assertEqual(progress[-1], os.path.getsize(apk))
+            self.assertEqual(len(progress), 4)
+            self.assertEqual(t.upload()[0], True)
+            self.assertEqual(self.server.uploaded_bytes, os.path.getsize(apk))
+            self.assertEqual(self.server.requests.count('/upload/stream'), 1)
+
+
+class Test_Setup(ServerTestCase):
+    server_options = {'phase_scale': 0.01}
+
+    def test_setup(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as folder:
+            apk = os.path.join(folder, 'com.example.app')
+            with open(apk, 'wb') as f:
+                f.write(os.urandom(100000))
+            t = self.traffic(apk)
+            # Asserting the APK is sent along only when missing, and phase one is started as a job
+            (success, handle, code) = t.setup(20)
+            self.assertEqual((success, handle['uploaded']), (True, True))
+            self.assertEqual(t.waitJob(handle['job'], deadline=5)[0], True)
+            self.assertEqual(t.setup(20)[1]['uploaded'], False)
+            self.assertEqual(self.server.uploaded_bytes, 100000)
+            # Asserting a failed installation keeps its phase one code
+            self.server.failure_rates = {'setup': 1}
+            self.assertEqual(t.setup(20)[::2], (False, APP_INSTALL_FAIL_ERROR))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,6 +13,8 @@ def log(tag, message):
 #                         AAPT WRAPPERS                 #
 ##########################################################
 import subprocess
+import axml
+import threading
 
 
 def aapt_call(command, args):
@@ -33,18 +35,35 @@ def aapt_call(command, args):
 
 last_badging_apk = None
 last_badging = None
+badging_lock = threading.Lock()
+
+
+def apk_manifest(apk_file):
+    """Manifest record (package, version_code, version_name, permissions, launchable_activity) read in-process
+    from the APK. None when the manifest cannot be decoded, then the aapt_* helpers fall back to aapt"""
+    try:
+        return axml.manifest(apk_file)
+    except (axml.ManifestError, OSError) as e:
+        log('AXML-ERROR', str(e))
+        return None
 
 
 def aapt_badging(apk_file):
     global last_badging_apk, last_badging
-    if last_badging_apk is None or apk_file != last_badging_apk:
-        last_badging = aapt_call('d', ['badging', apk_file])
-        last_badging_apk = apk_file
-    return last_badging
+    with badging_lock:
+        if last_badging_apk is not None and apk_file == last_badging_apk:
+            return last_badging
+    badging = aapt_call('d', ['badging', apk_file])
+    with badging_lock:
+        (last_badging_apk, last_badging) = (apk_file, badging)
+    return badging
 
 
 def aapt_permissions(apk_file):
     assert os.path.isfile(apk_file), '%s is not a valid APK path' % apk_file
+    record = apk_manifest(apk_file)
+    if record is not None:
+        return list(record.permissions)
     output = aapt_badging(apk_file)
     permissions = []
     if output is not None:
@@ -56,6 +75,9 @@ def aapt_permissions(apk_file):
 
 def aapt_package(apk_file):
     assert os.path.isfile(apk_file), '%s is not a valid APK path' % apk_file
+    record = apk_manifest(apk_file)
+    if record is not None:
+        return record.package
     output = aapt_badging(apk_file)
     package = None
     if output is not None:
@@ -68,6 +90,9 @@ def aapt_package(apk_file):
 
 def aapt_version_code(apk_file):
     assert os.path.isfile(apk_file), '%s is not a valid APK path' % apk_file
+    record = apk_manifest(apk_file)
+    if record is not None:
+        return record.version_code
     output = aapt_badging(apk_file)
     version_code = None
     if output is not None:
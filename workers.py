@@ -0,0 +1,119 @@
+##########################################################################
+#                         BOUNDED WORKER POOL                            #
+##########################################################################
+# A fixed set of threads taking tasks from a queue. The consumer sizes every pool to the broker credit it
+# serves, so in-flight work is capped by the pool whatever the broker delivers, and finished tasks leave
+# nothing behind (no thread object per message). A task that raises is logged with its traceback, to the logger
+# of the pool when it has one.
+import queue
+import threading
+import time
+import traceback
+
+
+class WorkerPool:
+    def __init__(self, size, name='worker', logger=None):
+        self.size = size
+        self.name = name
+        self.logger = logger
+        self.tasks = queue.Queue()
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+        self.busy_secs = 0.0
+        self.started = time.time()
+        self.threads = []
+        for i in range(size):
+            th = threading.Thread(target=self._work, name='{}-{}'.format(name, i), daemon=True)
+            th.start()
+            self.threads.append(th)
+
+    def submit(self, function, *args):
+        self.tasks.put((function, args))
+
+    def free(self):
+        """Workers not running a task nor having one waiting for them"""
+        with self.lock:
+            return max(0, self.size - self.busy - self.tasks.qsize())
+
+    def gauges(self):
+        """Queue depth, busy workers, utilization (busy / size now) and the share of worker time spent busy
+        since the pool started"""
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-6) * max(self.size, 1)
+            return {'{}_size'.format(self.name): self.size,
+                    '{}_queued'.format(self.name): self.tasks.qsize(),
+                    '{}_busy'.format(self.name): self.busy,
+                    '{}_utilization'.format(self.name): round(self.busy / max(self.size, 1), 3),
+                    '{}_busy_share'.format(self.name): round(self.busy_secs / elapsed, 3),
+                    '{}_completed'.format(self.name): self.completed,
+                    '{}_failed'.format(self.name): self.failed}
+
+    def stop(self):
+        """Lets the queued tasks finish, then ends the workers"""
+        for _ in self.threads:
+            self.tasks.put(None)
+        for th in self.threads:
+            th.join()
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            (function, args) = task
+            with self.lock:
+                self.busy += 1
+            started = time.time()
+            failed = False
+            try:
+                function(*args)
+            except Exception as e:
+                failed = True
+                if self.logger is not None:
+                    self.logger.error('Task failed', exc_info=True, extra={'pool': self.name,
+                                                                          'exception_message': str(e)})
+                else:
+                    traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.busy -= 1
+                    self.completed += 1
+                    self.failed += 1 if failed else 0
+                    self.busy_secs += time.time() - started
+
+
+# Unit testing
+import unittest
+
+
+class Test_WorkerPool(unittest.TestCase):
+    def test_pool(self):
+        pool = WorkerPool(2, 'test')
+        release = threading.Event()
+        running = []
+
+        def task(n):
+            running.append(n)
+            release.wait(5)
+        for n in range(5):
+            pool.submit(task, n)
+        time.sleep(0.2)
+        # Asserting no more than the pool size runs at once, the rest waits in the queue
+        gauges = pool.gauges()
+        self.assertEqual((len(running), gauges['test_busy'], gauges['test_queued']), (2, 2, 3))
+        self.assertEqual(pool.free(), 0)
+        release.set()
+        import logging
+        with self.assertLogs('workers-test', 'ERROR') as logs:
+            pool.logger = logging.getLogger('workers-test')
+            pool.submit(lambda: 1 / 0)
+            pool.stop()
+        self.assertIn('ZeroDivisionError', logs.output[0])
+        gauges = pool.gauges()
+        self.assertEqual((gauges['test_completed'], gauges['test_failed'], gauges['test_busy']), (6, 1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()